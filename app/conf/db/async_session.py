@@ -0,0 +1,17 @@
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.conf.settings import settings
+from app.utils.query_budget import instrument_queries
+from app.utils.metrics import TimedAsyncQueuePool, instrument_engine
+
+# PostgreSQL Client (asyncpg), keeps DB round trips off the event loop
+async_engine = create_async_engine(settings.SQLALCHEMY_ASYNC_DATABASE_URI, poolclass=TimedAsyncQueuePool,
+                                   pool_pre_ping=True, pool_size=settings.POOL_SIZE, max_overflow=0,
+                                   pool_timeout=settings.DB_POOL_TIMEOUT,
+                                   connect_args={'server_settings': {
+                                       'statement_timeout': str(settings.DB_STATEMENT_TIMEOUT)}}
+                                   if settings.DB_STATEMENT_TIMEOUT else {})
+instrument_queries(async_engine.sync_engine)
+instrument_engine(async_engine.sync_engine, 'async')
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession,
+                                 autocommit=False, autoflush=False, expire_on_commit=False)
@@ -0,0 +1,140 @@
+"""
+Read replicas: health and lag are checked in background, read sessions send SELECTs to the least busy
+replica that is alive and not behind more than REPLICA_MAX_LAG seconds, otherwise to primary.
+
+Read session (ReadSessionLocal, deps.get_read_db) keeps one replica for the whole session, so a request
+sees one snapshot, and switches to primary for good after its first write (read-your-writes).
+Plain SessionLocal never touches replicas.
+"""
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Sequence
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+from app.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 0 on primary and on replica that has replayed everything it received, NULL if it has not replayed anything yet
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class Replica:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.name = f'{engine.url.host}:{engine.url.port or 5432}/{engine.url.database}'
+        self.healthy = False  # until the first check
+        self.lag: Optional[float] = None
+
+        @event.listens_for(engine, 'handle_error')
+        def mark_down(exception_context):
+            # don't wait for the next check to stop sending reads to a replica that went away
+            if exception_context.is_disconnect:
+                self.healthy = False
+
+    def busy(self) -> int:
+        pool = self.engine.pool
+        return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+
+class ReplicaSet:
+    def __init__(self, engines: Sequence[Engine], max_lag: float, check_interval: float):
+        """
+        :param engines: engines of replicas, usually with the same pool settings as primary
+        :param max_lag: replica behind more than this many seconds gets no reads
+        :param check_interval: seconds between health checks
+        """
+        self.replicas = [Replica(engine) for engine in engines]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._pid: Optional[int] = None
+        registry.collectors.append(self.collect)
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    def ensure_started(self):
+        """Checker thread is started lazily in every worker, engines' pools are not shared across fork"""
+        if not self.replicas or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='replica-health', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def check(self):
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    lag = connection.execute(LAG_QUERY).scalar()
+            except Exception as e:
+                if replica.healthy:
+                    logger.warning('Replica %s is down: %s', replica.name, e)
+                replica.healthy, replica.lag = False, None
+                continue
+            replica.lag = float(lag) if lag is not None else None
+            healthy = replica.lag is not None and replica.lag <= self.max_lag
+            if healthy != replica.healthy:
+                logger.warning('Replica %s is %s, lag %s s', replica.name, 'up' if healthy else 'behind', replica.lag)
+            replica.healthy = healthy
+
+    def available(self) -> List[Replica]:
+        return [replica for replica in self.replicas if replica.healthy]
+
+    def choose(self) -> Optional[Replica]:
+        """Least busy healthy replica, None - read from primary"""
+        self.ensure_started()
+        available = self.available()
+        if not available:
+            if self.replicas:
+                registry.inc('db_replica_fallbacks_total')
+            return None
+        return min(available, key=lambda replica: replica.busy())
+
+    def collect(self, target):
+        for replica in self.replicas:
+            labels = (('replica', replica.name),)
+            target.set('db_replica_healthy', labels, int(replica.healthy))
+            target.set('db_replica_lag_seconds', labels, replica.lag if replica.lag is not None else -1)
+
+
+class RoutingSession(Session):
+    """
+    Session bound to primary that sends SELECTs to a replica until the first write.
+    statement.execution_options(primary=True) keeps a single read on primary
+    """
+
+    def __init__(self, *args, replicas: Optional[ReplicaSet] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+        self.replica: Optional[Replica] = None
+        self.replica_chosen = False
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        if self.wrote or not self.replicas:
+            return primary
+        if self._flushing or not isinstance(clause, Select):
+            # text() is not routed; after flush or DML the session reads its own writes from primary
+            self.wrote = self._flushing or getattr(clause, 'is_dml', False)
+            return primary
+        if clause.get_execution_options().get('primary'):
+            return primary
+        if not self.replica_chosen:
+            self.replica = self.replicas.choose()
+            self.replica_chosen = True
+        return self.replica.engine if self.replica is not None else primary
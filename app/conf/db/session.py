@@ -1,9 +1,44 @@
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session, sessionmaker
 from app.conf.settings import settings
+from app.conf.db.replicas import ReplicaSet, RoutingSession
+from app.utils.query_budget import instrument_queries
+from app.utils.metrics import TimedQueuePool, instrument_engine
+
+
+def make_engine(url: str, label: str) -> sqlalchemy.engine.Engine:
+    engine = create_engine(url, poolclass=TimedQueuePool,
+                           pool_pre_ping=True, pool_size=settings.POOL_SIZE, max_overflow=0,
+                           pool_timeout=settings.DB_POOL_TIMEOUT,
+                           connect_args={'options': f'-c statement_timeout={settings.DB_STATEMENT_TIMEOUT}'}
+                           if settings.DB_STATEMENT_TIMEOUT else {})
+    instrument_queries(engine)
+    instrument_engine(engine, label)
+    return engine
+
 
 # PostgreSQL Client
-engine = create_engine(settings.SQLALCHEMY_DATABASE_URI,
-                       pool_pre_ping=True, pool_size=settings.POOL_SIZE, max_overflow=0)
+engine = make_engine(settings.SQLALCHEMY_DATABASE_URI, 'sync')
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+replica_set = ReplicaSet(
+    [make_engine(url.strip(), f'replica{index}')
+     for index, url in enumerate(settings.DATABASE_REPLICA_URLS.split(',')) if url.strip()],
+    max_lag=settings.REPLICA_MAX_LAG,
+    check_interval=settings.REPLICA_CHECK_INTERVAL,
+)
+# reads from replica until the first write, see app.conf.db.replicas
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine,
+                                class_=RoutingSession, replicas=replica_set)
+
+
+def set_statement_timeout(session: Session, timeout_ms: int):
+    """
+    statement_timeout for every transaction of this session only, SET LOCAL doesn't leak to
+    the pooled connection. For AsyncSession pass its sync_session
+    """
+    @event.listens_for(session, 'after_begin')
+    def set_local_timeout(session, transaction, connection):
+        connection.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                           {'timeout': str(timeout_ms)})
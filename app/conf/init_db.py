@@ -10,59 +10,54 @@ from app.conf.permission_settings import (AVAILABLE_ROLES, AVAILABLE_PERMISSIONS
 from app.conf.settings import settings
 
 
+def sync_roles_and_permissions(db: Session) -> None:
+    """
+    Declarative sync of roles, permissions and their links with permission_settings.
+    Missing rows are added with a few bulk INSERT ... ON CONFLICT DO NOTHING, links of configured roles
+    which are not in PERMISSION_X_ROLE any more are removed with one DELETE, all in one transaction,
+    so statement count doesn't depend on size of permission matrix. Roles which links changed get
+    permissions_version bumped. Roles and permissions rows are never removed or updated.
+    """
+    logging.info('Start Syncing Roles and Permissions')
+
+    crud.role.create_many(db, [
+        schemas.RoleCreate(name=role_name, description=meta['description'], access_level=meta['access_level'])
+        for role_name, meta in AVAILABLE_ROLES.items()
+    ], conflict_columns=('name',), with_commit=False)
+
+    crud.permission.create_many(db, [
+        schemas.PermissionCreate(name=permission_name, description=permission_description)
+        for permission_name, permission_description in AVAILABLE_PERMISSIONS.items()
+    ], conflict_columns=('name',), with_commit=False)
+
+    role_ids = crud.role.get_ids_by_name(db)
+    permission_ids = crud.permission.get_ids_by_name(db)
+
+    links = [
+        schemas.PermissionXRoleCreate(permission_id=permission_ids[permission_name], role_id=role_ids[role_name])
+        for role_name, role_permissions in PERMISSION_X_ROLE.items()
+        for permission_name in role_permissions
+    ]
+    results = crud.permission_x_role.create_many(db, links, conflict_columns=('permission_id', 'role_id'),
+                                                 with_commit=False)
+
+    created_links = [links[result.index] for result in results if result.status == 'created']
+    configured_role_ids = {role_ids[role_name] for role_name in {*AVAILABLE_ROLES, *PERMISSION_X_ROLE}}
+    changed_role_ids = crud.permission_x_role.remove_stale(
+        db, role_ids=configured_role_ids, keep=[(link.permission_id, link.role_id) for link in links]
+    )
+    changed_role_ids.update(link.role_id for link in created_links)
+    if changed_role_ids:
+        crud.role.bump_permissions_version(db, role_ids=changed_role_ids)
+
+    db.commit()
+    logging.info('End Syncing Roles and Permissions, %s new permission links, %s roles changed',
+                 len(created_links), len(changed_role_ids))
+
+
 def init_db(db: Session) -> None:
 
-    logging.info('Start Creating Roles')
-    for role_name, meta in AVAILABLE_ROLES.items():
-        role = crud.role.get_by_name(db, name=role_name)
-        if not role:
-            role_in = schemas.RoleCreate(
-                name=role_name,
-                description=meta['description'],
-                access_level=meta['access_level']
-            )
-            role = crud.role.create(db, obj_in=role_in)
-
-    logging.info('End Creating Roles')
-    # Create permissions
-
-    logging.info('Start Creating Permissions')
-    for permission_name, permission_description in AVAILABLE_PERMISSIONS.items():
-        permission = crud.permission.get_by_name(db, name=permission_name)
-        if not permission:
-            permission_in = schemas.PermissionCreate(
-                name=permission_name,
-                description=permission_description
-            )
-            permission = crud.permission.create(db, obj_in=permission_in)
-
-    logging.info('End Creating Permissions')
-
-    logging.info('Start Adding the Permission to Role')
-
-    all_available_roles = crud.role.get_all(db)
-
-    all_available_permissions = crud.permission.get_all(db)
-
-    map_permission = {item.name: item.id for item in all_available_permissions}
-
-    for role in all_available_roles:
-        current_role_permissions = PERMISSION_X_ROLE[role.name]
-
-        for current_role_permission in current_role_permissions:
-            current_role_permission_id = map_permission[current_role_permission]
-            permission_x_role = crud.permission_x_role.\
-                get_by_permission_and_role(db,
-                                           permission_id=current_role_permission_id,
-                                           role_id=role.id)
-            if not permission_x_role:
-                permission_x_role_in = schemas.PermissionXRoleCreate(
-                    permission_id=current_role_permission_id,
-                    role_id=role.id
-                )
-                _ = crud.permission_x_role.create(db, obj_in=permission_x_role_in)
-
-        logging.info('End Adding the Permission to Role')
+    sync_roles_and_permissions(db)
 
     # Create First SuperUser
     logging.info('Start Create Superuser')
@@ -74,7 +69,8 @@ def init_db(db: Session) -> None:
             password=settings.FIRST_SUPERUSER_PASSWORD,
             is_superuser=True,
         )
-        superuser = crud.user.create(db, obj_in=user_in)
+        superuser = crud.user.create(db, obj_in=user_in, with_commit=False)
+        db.flush()
 
         superuser_role_id = crud.role.get_by_name(db, name='SUPERUSER').id
 
@@ -0,0 +1,146 @@
+"""
+Production server: pre-fork supervisor over uvicorn workers sharing one listening socket.
+
+    SIGTERM/SIGINT - graceful stop: workers stop accepting and finish in-flight requests
+    SIGHUP         - rolling restart: new worker is started before the old one is stopped
+    dead worker    - respawned (WORKER_MAX_REQUESTS recycles workers this way)
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from importlib.util import find_spec
+from multiprocessing.context import SpawnProcess
+from typing import List, Optional
+
+import uvicorn
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+from app.conf.settings import ENGINES_PER_WORKER, settings
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def server_config(workers: int) -> uvicorn.Config:
+    return uvicorn.Config(
+        'app.main:app',
+        host=settings.HOST,
+        port=int(settings.PORT),
+        workers=workers,
+        loop='uvloop' if find_spec('uvloop') else 'asyncio',
+        http='httptools' if find_spec('httptools') else 'h11',
+        timeout_keep_alive=settings.KEEP_ALIVE_TIMEOUT,
+        backlog=settings.BACKLOG,
+        limit_max_requests=settings.WORKER_MAX_REQUESTS or None,
+        proxy_headers=True,
+    )
+
+
+def check_connection_budget(workers: int):
+    """
+    Fail before forking if workers x pools can't get connections from Postgres.
+    If Postgres is not reachable now the check is skipped, workers will retry on their own.
+    """
+    needed = workers * ENGINES_PER_WORKER * settings.POOL_SIZE
+    engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, poolclass=NullPool)
+    try:
+        with engine.connect() as connection:
+            max_connections, reserved = connection.execute(text(
+                "SELECT current_setting('max_connections')::int, "
+                "current_setting('superuser_reserved_connections')::int"
+            )).one()
+    except Exception as e:
+        logger.warning('Connection budget is not checked, database is unavailable: %s', e)
+        return
+    finally:
+        engine.dispose()
+    available = max_connections - reserved
+    if needed > available:
+        raise SystemExit(
+            f'{workers} workers x {ENGINES_PER_WORKER} engines x POOL_SIZE {settings.POOL_SIZE} = {needed} '
+            f'connections, Postgres allows {available} (max_connections {max_connections} - {reserved} reserved). '
+            f'Lower WEB_CONCURRENCY or DB_POOL_SIZE'
+        )
+    logger.info('Workers need %s of %s Postgres connections', needed, available)
+
+
+def run_worker(config: uvicorn.Config, sockets: list):
+    """Worker process entry point: spawned, so it imports the app on its own"""
+    config.configure_logging()
+    uvicorn.Server(config=config).run(sockets=sockets)
+
+
+class Supervisor:
+    def __init__(self, config: uvicorn.Config):
+        self.config = config
+        self.socket = config.bind_socket()
+        self.processes: List[SpawnProcess] = []
+        self.should_exit = False
+        self.should_restart = False
+
+    def spawn(self) -> SpawnProcess:
+        process = multiprocessing.get_context('spawn').Process(
+            target=run_worker, kwargs={'config': self.config, 'sockets': [self.socket]}
+        )
+        process.start()
+        return process
+
+    def stop(self, process: SpawnProcess, timeout: Optional[float] = None):
+        process.terminate()  # uvicorn finishes in-flight requests on SIGTERM
+        process.join(settings.GRACEFUL_TIMEOUT if timeout is None else timeout)
+        if process.is_alive():
+            logger.warning('Worker %s did not stop in %s s, killing', process.pid, settings.GRACEFUL_TIMEOUT)
+            process.kill()
+            process.join()
+
+    def handle_exit(self, sig, frame):
+        self.should_exit = True
+
+    def handle_restart(self, sig, frame):
+        self.should_restart = True
+
+    def run(self):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.handle_exit)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        logger.info('Supervisor %s starts %s workers (loop %s, http %s)',
+                    os.getpid(), self.config.workers, self.config.loop, self.config.http)
+        self.processes = [self.spawn() for _ in range(self.config.workers)]
+
+        while not self.should_exit:
+            time.sleep(0.5)
+            if self.should_restart:
+                self.should_restart = False
+                self.rolling_restart()
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self.should_exit:
+                    logger.info('Worker %s exited with %s, starting new one', process.pid, process.exitcode)
+                    self.processes[index] = self.spawn()
+
+        logger.info('Supervisor %s stops workers', os.getpid())
+        for process in self.processes:
+            process.terminate()
+        deadline = time.monotonic() + settings.GRACEFUL_TIMEOUT
+        for process in self.processes:
+            self.stop(process, timeout=max(deadline - time.monotonic(), 0))
+        self.socket.close()
+
+    def rolling_restart(self):
+        """One worker at a time, the new one is up before the old one stops, so capacity never drops below N"""
+        logger.info('Rolling restart of %s workers', len(self.processes))
+        for index, old in enumerate(list(self.processes)):
+            if self.should_exit:
+                return
+            new = self.spawn()
+            time.sleep(settings.WORKER_BOOT_SECONDS)  # let it import the app before the old one leaves
+            self.processes[index] = new
+            self.stop(old)
+
+
+def run_production():
+    workers = settings.WEB_CONCURRENCY
+    config = server_config(workers)
+    check_connection_budget(workers)
+    Supervisor(config).run()
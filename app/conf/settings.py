@@ -4,6 +4,16 @@ from typing import Any, Dict, List, Optional, Union
 
 from pydantic import BaseSettings, PostgresDsn, validator, EmailStr, AnyHttpUrl
 
+# pool of one engine has at least MIN_POOL_SIZE connections; every worker has sync and async
+# engine, both with pool_size=POOL_SIZE and max_overflow=0
+MIN_POOL_SIZE = 5
+ENGINES_PER_WORKER = 2
+
+
+def auto_web_concurrency(db_pool_size: int) -> int:
+    """One worker per CPU, but no more than can have pools of MIN_POOL_SIZE within db_pool_size"""
+    return max(1, min(os.cpu_count() or 1, db_pool_size // (ENGINES_PER_WORKER * MIN_POOL_SIZE)))
+
 
 class Settings(BaseSettings):
     # Service Info
@@ -33,8 +43,85 @@ class Settings(BaseSettings):
     POSTGRES_PORT: str = os.getenv("POSTGRES_PORT", "5432")
 
     DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "20"))
-    WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", "1"))
-    POOL_SIZE: int = max(DB_POOL_SIZE // WEB_CONCURRENCY, 5)
+    # production workers, see app.conf.server; 0 - one per CPU as long as their pools fit DB_POOL_SIZE
+    WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", "1")) or auto_web_concurrency(DB_POOL_SIZE)
+    # per engine, so that sync and async pools of all workers together fit DB_POOL_SIZE
+    POOL_SIZE: int = max(DB_POOL_SIZE // (WEB_CONCURRENCY * ENGINES_PER_WORKER), MIN_POOL_SIZE)
+
+    @validator("WEB_CONCURRENCY", pre=True)
+    def default_web_concurrency(cls, v: Any, values: Dict[str, Any]) -> int:
+        # value from environment is parsed again by BaseSettings, keep 0 meaning auto
+        return int(v) or auto_web_concurrency(values["DB_POOL_SIZE"])
+
+    # seconds to wait for a free connection before 503, instead of hanging in threadpool
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "3"))
+    # ms for every statement, 0 - server default; per route see app.routers.deps.db_with_statement_timeout
+    DB_STATEMENT_TIMEOUT: int = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+    # admin reports may hold at most REPORT_CONNECTIONS of the pool, statements up to REPORT_STATEMENT_TIMEOUT ms
+    REPORT_CONNECTIONS: int = int(os.getenv("REPORT_CONNECTIONS", "0")) or max(POOL_SIZE // 4, 1)
+    REPORT_STATEMENT_TIMEOUT: int = int(os.getenv("REPORT_STATEMENT_TIMEOUT", "30000"))
+
+    @validator("REPORT_CONNECTIONS", pre=True)
+    def default_report_connections(cls, v: Any, values: Dict[str, Any]) -> int:
+        return int(v) or max(values["POOL_SIZE"] // 4, 1)
+
+    # read replicas, comma separated URLs, see app.conf.db.replicas; empty - everything is read from primary
+    DATABASE_REPLICA_URLS: str = os.getenv("DATABASE_REPLICA_URLS", "")
+    REPLICA_MAX_LAG: float = float(os.getenv("REPLICA_MAX_LAG", "5"))
+    REPLICA_CHECK_INTERVAL: float = float(os.getenv("REPLICA_CHECK_INTERVAL", "2"))
+
+    # longer than idle timeout of the proxy in front, so it doesn't hit closed connections
+    KEEP_ALIVE_TIMEOUT: int = int(os.getenv("KEEP_ALIVE_TIMEOUT", "65"))
+    BACKLOG: int = int(os.getenv("BACKLOG", "2048"))
+    # worker is replaced after this many requests, 0 - never
+    WORKER_MAX_REQUESTS: int = int(os.getenv("WORKER_MAX_REQUESTS", "0"))
+    GRACEFUL_TIMEOUT: int = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+    WORKER_BOOT_SECONDS: float = float(os.getenv("WORKER_BOOT_SECONDS", "3"))
+
+    # bcrypt thread pool, see app.utils.security.PasswordHasherPool
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", min(os.cpu_count() or 1, 4)))
+    PASSWORD_HASH_QUEUE_SIZE: int = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", "32"))
+
+    # admission control, see app.utils.admission: slots of concurrency class (0 - derived from hasher
+    # workers and pool size), queue of slots x ADMISSION_QUEUE_FACTOR, seconds in queue before 503
+    ADMISSION_CONTROL: bool = os.getenv("ADMISSION_CONTROL", "1") == "1"
+    ADMISSION_AUTH_LIMIT: int = int(os.getenv("ADMISSION_AUTH_LIMIT", "0"))
+    ADMISSION_DB_READ_LIMIT: int = int(os.getenv("ADMISSION_DB_READ_LIMIT", "0"))
+    ADMISSION_DB_WRITE_LIMIT: int = int(os.getenv("ADMISSION_DB_WRITE_LIMIT", "0"))
+    ADMISSION_QUEUE_FACTOR: int = int(os.getenv("ADMISSION_QUEUE_FACTOR", "4"))
+    ADMISSION_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+    ADMISSION_AUTH_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_AUTH_QUEUE_TIMEOUT", "2"))
+
+    # Bulk user import, see app.utils.user_import
+    USER_IMPORT_PROCESSES: int = int(os.getenv("USER_IMPORT_PROCESSES", os.cpu_count() or 1))
+    USER_IMPORT_BATCH_SIZE: int = int(os.getenv("USER_IMPORT_BATCH_SIZE", "500"))
+    USER_IMPORT_REPORTS_DIR: str = os.getenv("USER_IMPORT_REPORTS_DIR", "/tmp/mathsite_user_import")
+
+    # 'claims' - permissions are taken from JWT while role permissions_version is actual, 'db' - always from DB
+    AUTHORIZATION_MODE: str = os.getenv("AUTHORIZATION_MODE", "claims")
+    PERMISSION_VERSION_TTL: int = int(os.getenv("PERMISSION_VERSION_TTL", "30"))
+
+    # with several workers they exchange metrics snapshots through this dir, see app.utils.metrics
+    METRICS_DIR: str = os.getenv("METRICS_DIR", "/tmp/mathsite_metrics" if WEB_CONCURRENCY > 1 else "")
+    METRICS_FLUSH_INTERVAL: float = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+    # /metrics answers clients from these networks (comma separated) or with "Authorization: Bearer METRICS_TOKEN"
+    METRICS_ALLOWED_NETWORKS: str = os.getenv("METRICS_ALLOWED_NETWORKS", "127.0.0.0/8,::1/128")
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
+
+    # SQL statements per request, see app.utils.query_budget: 'off', 'log' or 'raise'
+    QUERY_BUDGET_MODE: str = os.getenv("QUERY_BUDGET_MODE", "off")
+    QUERY_BUDGET: int = int(os.getenv("QUERY_BUDGET", "30"))
+    QUERY_REPEAT_THRESHOLD: int = int(os.getenv("QUERY_REPEAT_THRESHOLD", "5"))
+    SLOW_QUERY_SECONDS: float = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
+    SLOW_QUERY_EXPLAIN: bool = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+
+    # parsed User-Agent strings kept in memory, see app.utils.services.parse_user_agent
+    USER_AGENT_CACHE_SIZE: int = int(os.getenv("USER_AGENT_CACHE_SIZE", "1024"))
+
+    # totals of LimitOffsetPage, see app.utils.counts: 'auto', 'exact', 'estimate' or 'cached'
+    COUNT_STRATEGY: str = os.getenv("COUNT_STRATEGY", "auto")
+    EXACT_COUNT_THRESHOLD: int = int(os.getenv("EXACT_COUNT_THRESHOLD", "10000"))
+    COUNT_CACHE_TTL: int = int(os.getenv("COUNT_CACHE_TTL", "60"))
 
     SQLALCHEMY_DATABASE_URI: Optional[PostgresDsn] = None
 
@@ -51,6 +138,21 @@ class Settings(BaseSettings):
             path=f'/{values.get("POSTGRES_DB") or ""}',
         )
 
+    SQLALCHEMY_ASYNC_DATABASE_URI: Optional[PostgresDsn] = None
+
+    @validator("SQLALCHEMY_ASYNC_DATABASE_URI", pre=True)
+    def assemble_async_db_connection(cls, v: Optional[str], values: Dict[str, Any]) -> Any:
+        if isinstance(v, str):
+            return v
+        return PostgresDsn.build(
+            scheme="postgresql+asyncpg",
+            user=values.get("POSTGRES_USER"),
+            password=values.get("POSTGRES_PASSWORD"),
+            host=values.get("POSTGRES_HOST"),
+            port=values.get("POSTGRES_PORT"),
+            path=f'/{values.get("POSTGRES_DB") or ""}',
+        )
+
     # Superuser
     FIRST_SUPERUSER: EmailStr = "admin@math.ru"
     FIRST_SUPERUSER_PASSWORD: str = "123123"
@@ -69,6 +171,26 @@ class Settings(BaseSettings):
     REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
     REDIS_PORT = os.getenv("REDIS_PORT", "6379")
 
+    # login attempts, see app.utils.rate_limit: 'memory' (per worker), 'redis' or 'off'
+    LOGIN_THROTTLE_BACKEND: str = os.getenv("LOGIN_THROTTLE_BACKEND", "memory")
+    LOGIN_IP_BURST: int = int(os.getenv("LOGIN_IP_BURST", "20"))
+    LOGIN_IP_PER_MINUTE: float = float(os.getenv("LOGIN_IP_PER_MINUTE", "10"))
+    LOGIN_ACCOUNT_BURST: int = int(os.getenv("LOGIN_ACCOUNT_BURST", "5"))
+    LOGIN_ACCOUNT_PER_MINUTE: float = float(os.getenv("LOGIN_ACCOUNT_PER_MINUTE", "2"))
+
+    # revoked tokens, see app.utils.denylist: 'memory' (one worker) or 'redis' (shared by workers)
+    TOKEN_DENYLIST_BACKEND: str = os.getenv("TOKEN_DENYLIST_BACKEND", "redis" if WEB_CONCURRENCY > 1 else "memory")
+    TOKEN_DENYLIST_CAPACITY: int = int(os.getenv("TOKEN_DENYLIST_CAPACITY", "100000"))
+    TOKEN_DENYLIST_ERROR_RATE: float = float(os.getenv("TOKEN_DENYLIST_ERROR_RATE", "0.001"))
+    TOKEN_DENYLIST_REBUILD_INTERVAL: float = float(os.getenv("TOKEN_DENYLIST_REBUILD_INTERVAL", "3600"))
+
+    @validator("TOKEN_DENYLIST_BACKEND", always=True)
+    def shared_token_denylist(cls, v: str, values: Dict[str, Any]) -> str:
+        # memory denylist is per process: token revoked in one worker would pass in the others
+        if v == "memory" and values.get("WEB_CONCURRENCY", 1) > 1:
+            raise ValueError("TOKEN_DENYLIST_BACKEND=memory works with one worker only, use redis")
+        return v
+
     # Sentry
     ON_PRODUCTION: bool = os.getenv('ON_PRODUCTION', True)  # Выставить на локальных машинах False
     SENTRY_RELEASE_VERSION: Optional[str] = None
@@ -112,6 +234,10 @@ class CookiesSettings(BaseSettings):
     # Disable CSRF Protection for this example. default is True
     authjwt_cookie_csrf_protect: bool = False
 
+    # logout revokes tokens by jti, see app.utils.denylist
+    authjwt_denylist_enabled: bool = True
+    authjwt_denylist_token_checks: set = {"access", "refresh"}
+
     # Change to "lax" in production to make your website more secure from CSRF Attacks, default is None
     authjwt_cookie_samesite: str = 'lax'
 
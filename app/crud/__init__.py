@@ -1,2 +1,3 @@
-from .crud_user import user
-from .crud_security import permission, permission_x_role, role, user_x_role
\ No newline at end of file
+from .crud_user import user, async_user
+from .crud_security import permission, permission_x_role, role, user_x_role
+from .crud_textbook import textbook
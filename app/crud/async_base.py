@@ -0,0 +1,107 @@
+from typing import Any, Dict, Generic, List, Optional, Tuple, Type, Union
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+from app.crud.base import (CreateSchemaType, LoaderProfilesMixin, ModelType, UpdateSchemaType,
+                           keyset_result, keyset_statement)
+
+
+class AsyncCRUDBase(LoaderProfilesMixin, Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
+	def __init__(self, model: Type[ModelType]):
+		"""
+		Same as CRUDBase but works over AsyncSession, so DB round trips don't block event loop.
+		Lazy relationships can't be loaded implicitly here, read them with loader profile.
+
+
+		:param model: A SQLAlchemy model class
+		"""
+		self.model = model
+
+	async def get(self, db: AsyncSession, obj_id: int, profile: Optional[str] = None) -> Optional[ModelType]:
+		result = await db.execute(
+			select(self.model).options(*self.loader_options(profile)).where(self.model.id == obj_id)
+		)
+		return result.scalars().first()
+
+	async def get_all(self, db: AsyncSession, profile: Optional[str] = None) -> List[ModelType]:
+		result = await db.execute(select(self.model).options(*self.loader_options(profile)))
+		return result.scalars().all()
+
+	async def get_multi(
+			self, db: AsyncSession, skip: int = 0, limit: int = 100, profile: Optional[str] = None
+	) -> List[ModelType]:
+		result = await db.execute(
+			select(self.model).options(*self.loader_options(profile)).offset(skip).limit(limit)
+		)
+		return result.scalars().all()
+
+	async def get_page(
+			self,
+			db: AsyncSession,
+			*,
+			limit: int = 50,
+			cursor: Optional[str] = None,
+			sort_column: str = 'id',
+			descending: bool = False
+	) -> Tuple[List[ModelType], Optional[str], Optional[str]]:
+		""" Keyset pagination, see CRUDBase.get_page """
+		statement, backwards = keyset_statement(self.model, limit=limit, cursor=cursor, sort_column=sort_column,
+												descending=descending)
+		result = await db.execute(statement)
+		return keyset_result(result.scalars().all(), limit=limit, cursor=cursor,
+							 sort_column=sort_column, backwards=backwards)
+
+	async def create(
+			self,
+			db: AsyncSession,
+			obj_in: CreateSchemaType,
+			with_commit: bool = True
+	) -> ModelType:
+		obj_in_data = jsonable_encoder(obj_in)
+		db_obj = self.model(**obj_in_data)  # type: ignore
+		db.add(db_obj)
+		if with_commit:
+			await db.commit()
+			await db.refresh(db_obj)
+		return db_obj
+
+	async def update(
+			self,
+			db: AsyncSession,
+			db_obj: ModelType,
+			obj_in: Union[UpdateSchemaType, Dict[str, Any]]
+	) -> ModelType:
+		obj_data = jsonable_encoder(db_obj)
+		if isinstance(obj_in, dict):
+			update_data = obj_in
+		else:
+			update_data = obj_in.dict(exclude_unset=True)
+		for field in obj_data:
+			if field in update_data:
+				setattr(db_obj, field, update_data[field])
+		db.add(db_obj)
+		await db.commit()
+		await db.refresh(db_obj)
+		return db_obj
+
+	async def remove(self, db: AsyncSession, obj_id: int, soft_delete=False) -> ModelType:
+		obj = await self.get(db, obj_id=obj_id)
+		if not obj:
+			raise HTTPException(
+				detail=f"Object with id '{obj_id}' was not found, nothing to delete",
+				status_code=status.HTTP_400_BAD_REQUEST
+			)
+		if soft_delete:
+			try:
+				obj.is_active = False
+			except Exception as e:
+				""" Object has no attr 'is_active' """
+				pass
+		else:
+			await db.delete(obj)
+		await db.commit()
+		return obj
@@ -1,20 +1,107 @@
-from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, Union
+from typing import Any, Dict, Generic, List, Optional, Sequence, Tuple, Type, TypeVar, Union
 from uuid import UUID
 
 from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Query, Session
+from sqlalchemy.sql import Select
 from starlette import status
 
 from app.conf.db.base_tablename_class import Base
+from app.schemas.bulk import BulkRowResult
+from app.utils.pagination import decode_cursor, encode_cursor
 
 ModelType = TypeVar("ModelType", bound=Base)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
 
+# postgres accepts at most 32767 bind parameters in one statement
+MAX_BIND_PARAMS = 32767
 
-class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
+
+def keyset_statement(
+		model: Type[ModelType],
+		*,
+		limit: int,
+		cursor: Optional[str],
+		sort_column: str,
+		descending: bool = False
+) -> Tuple[Select, bool]:
+	""" Build SELECT of one keyset page (plus one row to know if there is more), shared by sync and async CRUD """
+	if sort_column not in model.__table__.columns:
+		raise HTTPException(
+			detail=f"Unknown sort column '{sort_column}'",
+			status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
+		)
+	column = getattr(model, sort_column)
+	pk = model.id
+	keyset = tuple_(column, pk) if sort_column != 'id' else pk
+	
+	backwards = False
+	statement = select(model)
+	if cursor:
+		direction, key = decode_cursor(cursor)
+		backwards = direction == 'prev'
+	# index is scanned up when going forward in ascending order or back in descending one
+	scan_up = backwards == descending
+	if cursor:
+		key = tuple_(*key) if sort_column != 'id' else key[-1]
+		statement = statement.where(keyset > key if scan_up else keyset < key)
+	
+	order_by = (column, pk) if sort_column != 'id' else (pk,)
+	if not scan_up:
+		order_by = tuple(c.desc() for c in order_by)
+	return statement.order_by(*order_by).limit(limit + 1), backwards
+
+
+def keyset_result(
+		objs: List[ModelType],
+		*,
+		limit: int,
+		cursor: Optional[str],
+		sort_column: str,
+		backwards: bool
+) -> Tuple[List[ModelType], Optional[str], Optional[str]]:
+	""" Cut the extra row fetched by keyset_statement and make next/prev cursors """
+	has_more = len(objs) > limit
+	objs = list(objs[:limit])
+	
+	def make_cursor(obj: ModelType, direction: str) -> str:
+		return encode_cursor(direction, [jsonable_encoder(getattr(obj, sort_column)), obj.id])
+	
+	if not objs:
+		return objs, None, None
+	if backwards:
+		objs.reverse()
+		next_cursor = make_cursor(objs[-1], 'next')
+		prev_cursor = make_cursor(objs[0], 'prev') if has_more else None
+	else:
+		next_cursor = make_cursor(objs[-1], 'next') if has_more else None
+		prev_cursor = make_cursor(objs[0], 'prev') if cursor else None
+	return objs, next_cursor, prev_cursor
+
+
+class LoaderProfilesMixin:
+	"""
+	Named eager-loading profiles, e.g. {'principal': (joinedload(User.roles)...,)}.
+	Reads with profile load the whole relationship chain in fixed number of queries instead of lazy SELECTs.
+	"""
+	loader_profiles: Dict[str, Tuple[Any, ...]] = {}
+	
+	def loader_options(self, profile: Optional[str]) -> Tuple[Any, ...]:
+		if profile is None:
+			return ()
+		try:
+			return self.loader_profiles[profile]
+		except KeyError:
+			raise ValueError(f"Unknown loader profile '{profile}' for {self.__class__.__name__}")
+
+
+class CRUDBase(LoaderProfilesMixin, Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
 	def __init__(self, model: Type[ModelType]):
 		"""
 		CRUD object with default methods to Create, Read, Update, Delete (CRUD).
@@ -25,16 +112,47 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
 		"""
 		self.model = model
 	
-	def get(self, db: Session, obj_id: int) -> Optional[ModelType]:
-		return db.query(self.model).filter(self.model.id == obj_id).first()
+	def get(self, db: Session, obj_id: int, profile: Optional[str] = None) -> Optional[ModelType]:
+		return db.query(self.model).options(*self.loader_options(profile))\
+			.filter(self.model.id == obj_id).first()
 	
-	def get_all(self, db: Session) -> Optional[ModelType]:
-		return db.query(self.model).all()
+	def get_all(self, db: Session, profile: Optional[str] = None) -> Optional[ModelType]:
+		return db.query(self.model).options(*self.loader_options(profile)).all()
 	
 	def get_multi(
-			self, db: Session, skip: int = 0, limit: int = 100
+			self, db: Session, skip: int = 0, limit: int = 100, profile: Optional[str] = None
 	) -> List[ModelType]:
-		return db.query(self.model).offset(skip).limit(limit).all()
+		return db.query(self.model).options(*self.loader_options(profile))\
+			.offset(skip).limit(limit).all()
+	
+	def query_all(self, db: Session) -> Query:
+		""" Not executed query over the whole table, paginate it on the database side """
+		return db.query(self.model).order_by(self.model.id)
+	
+	def get_page(
+			self,
+			db: Session,
+			*,
+			limit: int = 50,
+			cursor: Optional[str] = None,
+			sort_column: str = 'id',
+			descending: bool = False
+	) -> Tuple[List[ModelType], Optional[str], Optional[str]]:
+		"""
+		Keyset (cursor) pagination: seek by (sort_column, id) instead of OFFSET, so every page
+		costs an index range scan no matter how deep it is.
+
+		:param limit: page size
+		:param cursor: opaque cursor from previous page (next_cursor or prev_cursor), None - first page
+		:param sort_column: name of indexed not null model column to sort by, id is used as tie-breaker,
+		 422 if model has no such column
+		:param descending: sort by (sort_column, id) descending
+		:return: objects of the page, next_cursor, prev_cursor
+		"""
+		statement, backwards = keyset_statement(self.model, limit=limit, cursor=cursor, sort_column=sort_column,
+												descending=descending)
+		objs = db.execute(statement).scalars().all()
+		return keyset_result(objs, limit=limit, cursor=cursor, sort_column=sort_column, backwards=backwards)
 	
 	def create(
 			self,
@@ -50,6 +168,135 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
 			db.refresh(db_obj)
 		return db_obj
 	
+	def to_row(self, obj_in: Union[CreateSchemaType, Dict[str, Any]]) -> Dict[str, Any]:
+		""" Column values of one row for bulk insert, override to prepare data like in create """
+		data = obj_in if isinstance(obj_in, dict) else obj_in.dict()
+		columns = self.model.__table__.columns
+		return {key: value for key, value in data.items() if key in columns}
+	
+	def to_rows(self, objs_in: Sequence[Union[CreateSchemaType, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+		""" Rows of bulk insert, override to prepare the whole batch at once """
+		return [self.to_row(obj_in) for obj_in in objs_in]
+	
+	def create_many(
+			self,
+			db: Session,
+			objs_in: Sequence[Union[CreateSchemaType, Dict[str, Any]]],
+			*,
+			conflict_columns: Optional[Sequence[str]] = None,
+			batch_size: int = 1000,
+			with_commit: bool = True
+	) -> List[BulkRowResult]:
+		"""
+		Multi-row INSERT ... RETURNING, one round trip and one commit per batch.
+
+		:param conflict_columns: unique columns, rows conflicting on them are skipped (ON CONFLICT DO NOTHING).
+		 Without them any constraint violation fails the whole batch, its rows get status 'error'
+		:param batch_size: rows per statement, lowered automatically to fit postgres bind parameters limit
+		:param with_commit: commit every batch, else caller owns the transaction and errors are raised
+		:return: outcome for every row of objs_in
+		"""
+		return self._insert_many(db, objs_in, index_elements=conflict_columns, update_columns=None,
+								 batch_size=batch_size, with_commit=with_commit)
+	
+	def upsert_many(
+			self,
+			db: Session,
+			objs_in: Sequence[Union[CreateSchemaType, Dict[str, Any]]],
+			*,
+			index_elements: Sequence[str],
+			update_columns: Optional[Sequence[str]] = None,
+			batch_size: int = 1000,
+			with_commit: bool = True
+	) -> List[BulkRowResult]:
+		"""
+		INSERT ... ON CONFLICT (index_elements) DO UPDATE ... RETURNING in batches.
+
+		:param index_elements: columns of unique index to detect existing rows
+		:param update_columns: columns to overwrite in existing rows, all inserted columns by default
+		:return: outcome for every row of objs_in, 'created' or 'updated'
+		"""
+		return self._insert_many(db, objs_in, index_elements=index_elements,
+								 update_columns=update_columns or (), batch_size=batch_size,
+								 with_commit=with_commit)
+	
+	def _insert_many(
+			self,
+			db: Session,
+			objs_in: Sequence[Union[CreateSchemaType, Dict[str, Any]]],
+			*,
+			index_elements: Optional[Sequence[str]],
+			update_columns: Optional[Sequence[str]],
+			batch_size: int,
+			with_commit: bool
+	) -> List[BulkRowResult]:
+		table = self.model.__table__
+		pk_columns = list(table.primary_key.columns)
+		rows = self.to_rows(objs_in)
+		results: List[BulkRowResult] = []
+		if not rows:
+			return results
+		batch_size = max(1, min(batch_size, MAX_BIND_PARAMS // max(len(rows[0]), 1)))
+		
+		for start in range(0, len(rows), batch_size):
+			batch = list(enumerate(rows[start:start + batch_size], start))
+			if index_elements:
+				# the same key twice in one statement breaks ON CONFLICT DO UPDATE, the last row wins
+				last_by_key = {tuple(row[c] for c in index_elements): index for index, row in batch}
+				duplicates = {index for index, row in batch
+							  if last_by_key[tuple(row[c] for c in index_elements)] != index}
+				results.extend(BulkRowResult(index=index, status='skipped', detail='Duplicate key in request')
+							   for index in duplicates)
+				batch = [(index, row) for index, row in batch if index not in duplicates]
+			
+			statement = pg_insert(table).values([row for _, row in batch])
+			returning = [*pk_columns, *(table.c[c] for c in index_elements or ())]
+			set_columns = None
+			if update_columns is not None:
+				set_columns = update_columns or [c for c in batch[0][1] if c not in index_elements]
+			# every column is a key: nothing to update, existing rows are skipped by DO NOTHING
+			if set_columns:
+				statement = statement.on_conflict_do_update(
+					index_elements=index_elements,
+					set_={c: statement.excluded[c] for c in set_columns}
+				)
+				# xmax is 0 only for a freshly inserted row version
+				returning.append(literal_column('xmax = 0').label('inserted'))
+			elif index_elements:
+				statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+			
+			try:
+				returned = db.execute(statement.returning(*returning)).all()
+				if with_commit:
+					db.commit()
+			except DBAPIError as e:
+				if not with_commit:
+					raise
+				db.rollback()
+				results.extend(BulkRowResult(index=index, status='error', detail=str(e.orig).strip())
+							   for index, _ in batch)
+				continue
+			
+			def row_id(returned_row) -> Optional[int]:
+				return returned_row[0] if len(pk_columns) == 1 else None
+			
+			if not index_elements:
+				# plain multi-row INSERT returns rows in VALUES order
+				results.extend(BulkRowResult(index=index, status='created', id=row_id(returned_row))
+							   for (index, _), returned_row in zip(batch, returned))
+				continue
+			key_slice = slice(len(pk_columns), len(pk_columns) + len(index_elements))
+			returned_by_key = {tuple(returned_row[key_slice]): returned_row for returned_row in returned}
+			for index, row in batch:
+				returned_row = returned_by_key.get(tuple(row[c] for c in index_elements))
+				if returned_row is None:
+					results.append(BulkRowResult(index=index, status='skipped', detail='Already exists'))
+				elif set_columns and not returned_row.inserted:
+					results.append(BulkRowResult(index=index, status='updated', id=row_id(returned_row)))
+				else:
+					results.append(BulkRowResult(index=index, status='created', id=row_id(returned_row)))
+		return sorted(results, key=lambda result: result.index)
+	
 	def update(
 			self,
 			db: Session,
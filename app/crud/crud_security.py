@@ -1,7 +1,8 @@
 import datetime
-from typing import List
+from typing import Dict, Iterable, List, Set, Tuple
 from uuid import UUID
 
+from sqlalchemy import delete, tuple_
 from sqlalchemy.orm import Session
 
 from app.crud.base import CRUDBase
@@ -20,6 +21,10 @@ class CRUDPermission(CRUDBase[Permission, PermissionCreate, PermissionUpdate]):
     def get_all(self, db: Session) -> List[Permission]:
         return db.query(Permission).all()
 
+    @staticmethod
+    def get_ids_by_name(db: Session) -> Dict[str, int]:
+        return dict(db.query(Permission.name, Permission.id).all())
+
 
 class CRUDRole(CRUDBase[Role, RoleCreate, RoleUpdate]):
     @staticmethod
@@ -29,6 +34,21 @@ class CRUDRole(CRUDBase[Role, RoleCreate, RoleUpdate]):
     def get_all(self, db: Session) -> List[Role]:
         return db.query(Role).all()
 
+    @staticmethod
+    def get_ids_by_name(db: Session) -> Dict[str, int]:
+        return dict(db.query(Role.name, Role.id).all())
+
+    @staticmethod
+    def get_permissions_versions(db: Session) -> Dict[str, int]:
+        return dict(db.query(Role.name, Role.permissions_version).all())
+
+    @staticmethod
+    def bump_permissions_version(db: Session, *, role_ids: Iterable[int]) -> None:
+        """Invalidate permissions claims of tokens issued for these roles"""
+        db.query(Role).filter(Role.id.in_(list(role_ids))).update(
+            {Role.permissions_version: Role.permissions_version + 1}, synchronize_session=False
+        )
+
 
 class CRUDPermissionXRole(CRUDBase[PermissionXRole, PermissionXRoleCreate, PermissionXRoleUpdate]):
     @staticmethod
@@ -37,6 +57,35 @@ class CRUDPermissionXRole(CRUDBase[PermissionXRole, PermissionXRoleCreate, Permi
         return db.query(PermissionXRole).filter(PermissionXRole.permission_id == permission_id,
                                                 PermissionXRole.role_id == role_id).first()
 
+    def create(self, db: Session, obj_in: PermissionXRoleCreate, with_commit: bool = True) -> PermissionXRole:
+        db_obj = super().create(db, obj_in=obj_in, with_commit=False)
+        CRUDRole.bump_permissions_version(db, role_ids=[obj_in.role_id])
+        if with_commit:
+            db.commit()
+            db.refresh(db_obj)
+        return db_obj
+
+    def remove_by_permission_and_role(self, db: Session, *, permission_id: int, role_id: int) -> None:
+        db.query(PermissionXRole).filter(PermissionXRole.permission_id == permission_id,
+                                         PermissionXRole.role_id == role_id).delete()
+        CRUDRole.bump_permissions_version(db, role_ids=[role_id])
+        db.commit()
+
+    @staticmethod
+    def remove_stale(db: Session, *, role_ids: Iterable[int], keep: Iterable[Tuple[int, int]]) -> Set[int]:
+        """
+        One DELETE of links of these roles which are not in keep, without commit
+
+        :param role_ids: roles which permissions are managed
+        :param keep: (permission_id, role_id) pairs to keep
+        :return: ids of roles which lost permissions
+        """
+        statement = delete(PermissionXRole).where(
+            PermissionXRole.role_id.in_(list(role_ids)),
+            tuple_(PermissionXRole.permission_id, PermissionXRole.role_id).not_in(list(keep)),
+        ).returning(PermissionXRole.role_id).execution_options(synchronize_session=False)
+        return set(db.execute(statement).scalars())
+
 
 class CRUDUserXRole(CRUDBase[UserXRole, UserXRoleCreate, UserXRoleUpdate]):
 
@@ -0,0 +1,82 @@
+import html
+from typing import Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import Float, cast, func, literal_column, select, tuple_
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.textbook import SEARCH_CONFIG, Textbook
+from app.schemas.textbook import TextbookCreate, TextbookUpdate
+from app.utils.pagination import decode_cursor, encode_cursor
+
+SEARCH_REGCONFIG = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+# ts_headline copies title as is, so it marks matches with control characters and the result is
+# HTML-escaped before they are turned into <b></b>, see highlight()
+HEADLINE_START, HEADLINE_STOP = '\x02', '\x03'
+HEADLINE_OPTIONS = f'StartSel="{HEADLINE_START}", StopSel="{HEADLINE_STOP}", HighlightAll=true'
+
+
+def highlight(headline: str) -> str:
+    """HTML-escaped headline with matched words wrapped into <b></b>"""
+    return html.escape(headline).replace(HEADLINE_START, '<b>').replace(HEADLINE_STOP, '</b>')
+
+
+class CRUDTextbook(CRUDBase[Textbook, TextbookCreate, TextbookUpdate]):
+    @staticmethod
+    def get_by_slug(db: Session, *, slug: str) -> Optional[Textbook]:
+        return db.query(Textbook).filter(Textbook.slug == slug).first()
+
+    @staticmethod
+    def get_existing_slugs(db: Session, slugs: Iterable[str]) -> Set[str]:
+        """Which of slugs are already in table, one query per call"""
+        return set(db.execute(select(Textbook.slug).where(Textbook.slug.in_(list(slugs)))).scalars())
+
+    @staticmethod
+    def search(
+            db: Session,
+            *,
+            q: str,
+            limit: int = 20,
+            cursor: Optional[str] = None,
+            school_class: Optional[int] = None,
+    ) -> Tuple[List[Tuple[Textbook, float, str]], Optional[str], Optional[str]]:
+        """
+        Full-text search over search_vector (GIN index), best matches first.
+        Keyset paging by (rank, id) descending, the cursor keeps rank of the boundary row.
+
+        :param q: query in web search syntax: words, "phrase", -excluded, or
+        :return: ([(textbook, rank, headline)], next_cursor, prev_cursor)
+        """
+        query = func.websearch_to_tsquery(SEARCH_REGCONFIG, q)
+        # double precision survives JSON round trip exactly, real (float4) doesn't
+        rank = cast(func.ts_rank(Textbook.search_vector, query), Float)
+        headline = func.ts_headline(SEARCH_REGCONFIG, Textbook.title, query, HEADLINE_OPTIONS)
+        keyset = tuple_(rank, Textbook.id)
+
+        statement = select(Textbook, rank, headline).where(Textbook.search_vector.op('@@')(query))
+        if school_class is not None:
+            statement = statement.where(Textbook.school_class == school_class)
+        backwards = False
+        if cursor:
+            direction, key = decode_cursor(cursor)
+            backwards = direction == 'prev'
+            statement = statement.where(keyset > tuple_(*key) if backwards else keyset < tuple_(*key))
+        order_by = (rank, Textbook.id) if backwards else (rank.desc(), Textbook.id.desc())
+        rows = db.execute(statement.order_by(*order_by).limit(limit + 1)).all()
+
+        has_more = len(rows) > limit
+        rows = [(row[0], row[1], highlight(row[2])) for row in rows[:limit]]
+        if not rows:
+            return rows, None, None
+        if backwards:
+            rows.reverse()
+
+        def make_cursor(row: Tuple[Textbook, float, str], direction: str) -> str:
+            return encode_cursor(direction, [row[1], row[0].id])
+
+        next_cursor = make_cursor(rows[-1], 'next') if has_more or backwards else None
+        prev_cursor = make_cursor(rows[0], 'prev') if (has_more if backwards else cursor) else None
+        return rows, next_cursor, prev_cursor
+
+
+textbook = CRUDTextbook(Textbook)
@@ -1,15 +1,32 @@
 import datetime
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
 
-from app.utils.security import get_password_hash, verify_password
+from app.utils.security import get_password_hash, password_hasher, verify_password, verify_password_async
+from app.crud.async_base import AsyncCRUDBase
 from app.crud.base import CRUDBase
+from app.models.security import PermissionXRole, Role, UserXRole
 from app.models.user import User
 from app.schemas.user import UserCreate, UserUpdate
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+
+USER_LOADER_PROFILES = {
+    # user -> role, enough for access_level checks: 1 query
+    'role': (joinedload(User.roles).joinedload(UserXRole.role),),
+    # authentication principal, user -> role -> permissions: 2 queries for any number of permissions
+    'principal': (
+        joinedload(User.roles).joinedload(UserXRole.role)
+        .selectinload(Role.permissions).joinedload(PermissionXRole.permission),
+    ),
+}
 
 
 class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
+    loader_profiles = USER_LOADER_PROFILES
+
     def get_by_email(self, db: Session, *, email: str) -> Optional[User]:  # noqa
         return db.query(User).where(User.email == email).first()
 
@@ -38,6 +55,27 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
 
         return db_obj
 
+    def to_row(self, obj_in: Union[UserCreate, Dict[str, Any]],
+               hashed_password: Optional[str] = None) -> Dict[str, Any]:
+        if isinstance(obj_in, dict):
+            # already prepared column values, e.g. password was hashed by import in process pool
+            return super().to_row(obj_in)
+        return {
+            'email': obj_in.email,
+            'hashed_password': hashed_password or get_password_hash(obj_in.password),
+            'name': obj_in.name,
+            'last_name': obj_in.last_name,
+            'username': obj_in.username,
+            'created_at': datetime.datetime.now(),
+            'last_login_at': datetime.datetime.now(),
+        }
+
+    def to_rows(self, objs_in: Sequence[Union[UserCreate, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Passwords of the batch are hashed in password_hasher pool, not one by one in caller thread"""
+        passwords = [obj_in.password for obj_in in objs_in if not isinstance(obj_in, dict)]
+        hashes = iter(password_hasher.map(get_password_hash, passwords))
+        return [self.to_row(obj_in, None if isinstance(obj_in, dict) else next(hashes)) for obj_in in objs_in]
+
     def update(
             self, db: Session, db_obj: User, obj_in: Union[UserUpdate, Dict[str, Any]]
     ) -> UserUpdate:
@@ -62,6 +100,24 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
     def is_superuser(self, user: User) -> bool:  # noqa
         return user.is_superuser
 
+    @staticmethod
+    def iter_export_rows(db: Session, columns: Sequence[str], yield_per: int = 1000) -> Iterator[tuple]:
+        """
+        Rows of users with role name through server-side cursor: rows are fetched from postgres
+        by yield_per, so memory doesn't depend on table size
+
+        :param columns: User columns to export, 'role' - name of user role
+        """
+        selected = [Role.name.label('role') if c == 'role' else User.__table__.c[c] for c in columns]
+        statement = select(*selected) \
+            .select_from(User) \
+            .outerjoin(UserXRole, UserXRole.user_id == User.id) \
+            .outerjoin(Role, Role.id == UserXRole.role_id) \
+            .order_by(User.id)
+        result = db.execute(statement.execution_options(stream_results=True, max_row_buffer=yield_per))
+        for partition in result.partitions(yield_per):
+            yield from partition
+
     def login_via_soc_nets(self, db: Session, username: str, access_token: str or None = None):
         user_in_db = db.query(User).where(User.username == username).first()
         data = {"last_login_at": str(datetime.datetime.now())}
@@ -70,4 +126,29 @@ class CRUDUser(CRUDBase[User, UserCreate, UserUpdate]):
         return self.update(db, db_obj=user_in_db, obj_in=data)
 
 
+class AsyncCRUDUser(AsyncCRUDBase[User, UserCreate, UserUpdate]):
+    loader_profiles = USER_LOADER_PROFILES
+
+    async def get_by_email(self, db: AsyncSession, *, email: str) -> Optional[User]:  # noqa
+        result = await db.execute(select(User).where(User.email == email))
+        return result.scalars().first()
+
+    async def authenticate(self, db: AsyncSession, *, email: str, password: str) -> Optional[User]:
+        """Same as CRUDUser.authenticate, but bcrypt runs in password_hasher pool"""
+        result = await db.execute(
+            select(User).where(User.email == email).options(*self.loader_options('principal'))
+        )
+        user = result.scalars().first()
+        if not user:
+            return None
+        if not await verify_password_async(password, user.hashed_password):
+            return None
+        user.last_login_at = datetime.datetime.now()
+        return user
+
+    def is_active(self, user: User) -> bool:  # noqa
+        return user.is_active
+
+
 user = CRUDUser(User)
+async_user = AsyncCRUDUser(User)
@@ -6,16 +6,28 @@ from app.conf.settings import cookies_settings, settings
 
 from fastapi import FastAPI
 from fastapi_jwt_auth.exceptions import AuthJWTException
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
 
 from app.routers.api import api_router
-from app.routers.exception_handler import authjwt_exception_handler
+from app.routers.v1.auth.auth import token_keys
+from app.routers.exception_handler import authjwt_exception_handler, dbapi_exception_handler, \
+    pool_timeout_exception_handler
+from app.utils.admission import AdmissionMiddleware
+from app.utils.denylist import token_denylist
+from app.utils.metrics import MetricsMiddleware, metrics_endpoint
+from app.utils.query_budget import QueryBudgetMiddleware
+from app.utils.rate_limit import LoginThrottleMiddleware
 
 app = FastAPI(
-    debug=True,
+    debug=not settings.ON_PRODUCTION,
     title=settings.PROJECT_NAME,
     version=settings.PROJECT_VERSION,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
-    exception_handlers={AuthJWTException: authjwt_exception_handler},
+    exception_handlers={
+        AuthJWTException: authjwt_exception_handler,
+        PoolTimeoutError: pool_timeout_exception_handler,
+        DBAPIError: dbapi_exception_handler,
+    },
 )
 
 
@@ -25,6 +37,17 @@ app.include_router(api_router, prefix=settings.API_V1_STR)
 add_pagination(app)
 
 
+if settings.QUERY_BUDGET_MODE != 'off':
+    app.add_middleware(QueryBudgetMiddleware)
+if settings.ADMISSION_CONTROL:
+    # inside MetricsMiddleware, so shed requests are counted too
+    app.add_middleware(AdmissionMiddleware)
+# outside admission control: rejected login attempts don't queue for auth-cpu slots
+app.add_middleware(LoginThrottleMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+
 origins = [
     "http://localhost",
     "http://0.0.0.0",
@@ -39,11 +62,16 @@ def get_config():
     return cookies_settings
 
 
+@AuthJWT.token_in_denylist_loader
+def check_if_token_in_denylist(decrypted_token: dict) -> bool:
+    # async callers finish the check with deps.jwt_required_async
+    return token_denylist.check(*token_keys(decrypted_token))
+
+
 def run():
     if settings.ON_PRODUCTION:
-        uvicorn.run(app,
-                    host=settings.HOST,
-                    port=settings.PORT)
+        from app.conf.server import run_production
+        run_production()
     else:
         uvicorn.run("main:app", host=settings.HOST, port=settings.PORT, reload=True)
 
@@ -26,6 +26,8 @@ class Role(Base):
     )
     description = Column(String, nullable=False)
     access_level = Column(Integer, nullable=False)
+    # bumped on every change of role permissions, tokens with older version are re-checked in DB
+    permissions_version = Column(Integer, nullable=False, default=1, server_default='1')
     created_at = Column(DateTime, default=datetime.datetime.utcnow())
     updated_at = Column(DateTime)
 
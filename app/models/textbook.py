@@ -1,13 +1,24 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Computed, Index, Integer, String
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 
 from app.conf.db.base_tablename_class import Base
 
+# text search configuration of the catalogue, the same in column, queries and headlines
+SEARCH_CONFIG = 'russian'
+
 
 class Textbook(Base):
-	__table_args__ = {
-		"schema": "data",
-	}
+	__table_args__ = (
+		Index('ix_data_textbook_search_vector', 'search_vector', postgresql_using='gin'),
+		{"schema": "data"},
+	)
 	id = Column(Integer, primary_key=True, autoincrement=True)
-	school_class = Column(Integer, default=5)
+	school_class = Column(Integer, default=5, index=True)
 	title = Column(String)
-	slug = Column(String)
+	slug = Column(String, unique=True, index=True)
+	# new text fields are added to the expression with lower weight: setweight(..., 'B')
+	search_vector = deferred(Column(
+		TSVECTOR,
+		Computed(f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A')", persisted=True),
+	))
@@ -1,6 +1,8 @@
 from fastapi import APIRouter
 
+from app.routers.v1.admin import admin
 from app.routers.v1.auth import auth
+from app.routers.v1.textbooks import textbooks
 from app.routers.v1.users import users
 from app.routers.v1.class_base_view import router2
 
@@ -8,4 +10,7 @@ api_router = APIRouter()
 
 api_router.include_router(auth.router, tags=["Authentication"])
 api_router.include_router(users.router, tags=["Users"])
+api_router.include_router(admin.router, prefix="/admin", tags=["Admin"])
 api_router.include_router(router2, tags=["Test2"])
+api_router.include_router(textbooks.crud_router, tags=["Textbooks"])
+api_router.include_router(textbooks.router, tags=["Textbooks"])
@@ -1,15 +1,21 @@
 import json
-from typing import Generator, Optional
+import threading
+from typing import AsyncGenerator, Callable, Generator, Optional
 
 from fastapi import Depends, HTTPException, status
 from fastapi_jwt_auth import AuthJWT
+from fastapi_jwt_auth.exceptions import RevokedTokenError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app import crud as crud
 from app import models
-from app.conf.db.session import SessionLocal
+from app.conf.db.async_session import AsyncSessionLocal
+from app.conf.db.session import ReadSessionLocal, SessionLocal, set_statement_timeout
 from app.conf.settings import settings
-from app.utils.security import check_for_permission
+from app.utils.denylist import token_denylist
+from app.utils.permissions import check_for_permission_mask, permission_registry
+from app.utils.security import PermissionVersionCache
 
 
 def get_db() -> Generator:
@@ -20,10 +26,113 @@ def get_db() -> Generator:
         db.close()
 
 
-async def get_current_user_or_none(
+def get_read_db() -> Generator:
+    """Session of GET routes: reads from replica while it doesn't lag, writes switch it to primary"""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def db_with_statement_timeout(timeout_ms: int) -> Callable[[], Generator]:
+    """
+    get_db with own statement_timeout, e.g. for a route that must answer fast or not at all:
+
+        db: Session = Depends(deps.db_with_statement_timeout(2000))
+    """
+    def get_db_with_timeout() -> Generator:
+        db = SessionLocal()
+        set_statement_timeout(db, timeout_ms)
+        try:
+            yield db
+        finally:
+            db.close()
+    return get_db_with_timeout
+
+
+# admin reports share the sync pool with the rest of API, but can't take more than this of it
+report_connections = threading.BoundedSemaphore(settings.REPORT_CONNECTIONS)
+
+
+class ReportSlot:
+    """
+    One of REPORT_CONNECTIONS places for a report, 503 if none is free in DB_POOL_TIMEOUT.
+    Released once: on exit or when dropped, e.g. by a stream that was never started
+    """
+
+    def __init__(self):
+        self._released = True
+        if not report_connections.acquire(timeout=settings.DB_POOL_TIMEOUT):
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many reports are running, try again later",
+                                headers={'Retry-After': '5'})
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            report_connections.release()
+
+    def __enter__(self) -> 'ReportSlot':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+def get_report_db() -> Generator:
+    """Session of slow admin reports: limited concurrency, REPORT_STATEMENT_TIMEOUT, reads from replica"""
+    with ReportSlot(), ReadSessionLocal() as db:
+        set_statement_timeout(db, settings.REPORT_STATEMENT_TIMEOUT)
+        yield db
+
+
+def load_permissions_versions() -> dict:
+    with SessionLocal() as db:
+        return crud.role.get_permissions_versions(db)
+
+
+permission_versions = PermissionVersionCache(load_permissions_versions,
+                                             ttl=settings.PERMISSION_VERSION_TTL)
+
+
+async def get_async_db() -> AsyncGenerator:
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def async_db_with_statement_timeout(timeout_ms: int) -> Callable[[], AsyncGenerator]:
+    """Same as db_with_statement_timeout for AsyncSession"""
+    async def get_async_db_with_timeout() -> AsyncGenerator:
+        async with AsyncSessionLocal() as db:
+            set_statement_timeout(db.sync_session, timeout_ms)
+            yield db
+    return get_async_db_with_timeout
+
+
+async def jwt_required_async(Authorize: AuthJWT, refresh: bool = False):
+    """
+    jwt_required() for async code: denylist store is asked with async client, event loop isn't blocked
+
+    :param refresh: require refresh token instead of access one
+    """
+    if refresh:
+        Authorize.jwt_refresh_token_required()
+    else:
+        Authorize.jwt_required()
+    if await token_denylist.confirm():
+        raise RevokedTokenError(status_code=401, message="Token has been revoked")
+
+
+def get_current_user_or_none(
         db: Session = Depends(get_db),
         Authorize: AuthJWT = Depends(),
 ) -> Optional[models.User]:
+    """Plain def: runs in threadpool, so sync Session and denylist store don't block event loop"""
     try:
         Authorize.jwt_required()
     except:
@@ -31,11 +140,11 @@ async def get_current_user_or_none(
     payload_json = Authorize.get_jwt_subject()
     payload = json.loads(payload_json)
 
-    user_in_db = crud.user.get(db, obj_id=payload['id'])
+    user_in_db = crud.user.get(db, obj_id=payload['id'], profile='principal')
     return user_in_db
 
 
-async def get_current_user(
+def get_current_user(
         user_in_db: models.User = Depends(get_current_user_or_none)
 ) -> models.User:
 
@@ -45,7 +154,7 @@ async def get_current_user(
     return user_in_db
 
 
-async def get_current_active_user(
+def get_current_active_user(
         current_user: models.User = Depends(get_current_user),
 ):
     if not crud.user.is_active(current_user):
@@ -53,22 +162,72 @@ async def get_current_active_user(
     return current_user
 
 
-async def get_current_user_permission_list(
-        current_user: models.User = Depends(get_current_user_or_none)
-) -> list:
+async def get_current_user_or_none_async(
+        db: AsyncSession = Depends(get_async_db),
+        Authorize: AuthJWT = Depends(),
+) -> Optional[models.User]:
+    """Same as get_current_user_or_none, but doesn't block event loop. Roles and permissions are loaded"""
+    try:
+        await jwt_required_async(Authorize)
+    except:
+        return None
+    payload_json = Authorize.get_jwt_subject()
+    payload = json.loads(payload_json)
+
+    user_in_db = await crud.async_user.get(db, obj_id=int(payload['id']), profile='principal')
+    return user_in_db
+
+
+async def get_current_user_async(
+        user_in_db: models.User = Depends(get_current_user_or_none_async)
+) -> models.User:
+
+    if not user_in_db:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return user_in_db
+
+
+async def get_current_active_user_async(
+        current_user: models.User = Depends(get_current_user_async),
+):
+    if not crud.async_user.is_active(current_user):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Inactive user")
+    return current_user
+
+
+async def get_current_user_permission_mask(
+        db: AsyncSession = Depends(get_async_db),
+        Authorize: AuthJWT = Depends(),
+) -> int:
+    try:
+        await jwt_required_async(Authorize)
+    except:
+        return 0
+    payload = json.loads(Authorize.get_jwt_subject())
+
+    # AsyncSession takes connection only on first query, so claims path doesn't touch DB
+    if settings.AUTHORIZATION_MODE == 'claims' and 'permissions_mask' in payload and \
+            await permission_versions.is_actual(payload.get('role'), payload.get('permissions_version')):
+        return payload['permissions_mask']
+
+    current_user = await crud.async_user.get(db, obj_id=int(payload['id']), profile='principal')
     if not current_user:
-        return []
+        return 0
     user_permissions = current_user.roles.role.permissions
-    return [p.permission.name for p in user_permissions]
+    return permission_registry.mask(p.permission.name for p in user_permissions)
 
 
 def check_current_user_for_permission(
         permissions_required: tuple
 ):
+    required_mask = permission_registry.mask(permissions_required, strict=True)
+
     # throw exception or return True if permission allowed
     async def check_permissions(
-        users_permissions_list: list = Depends(get_current_user_permission_list)
+        permissions_mask: int = Depends(get_current_user_permission_mask)
     ):
-        check_for_permission(permissions_required, users_permissions_list)
+        check_for_permission_mask(required_mask, permissions_mask)
         return True
     return check_permissions
+
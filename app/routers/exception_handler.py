@@ -1,7 +1,27 @@
 from fastapi import Request
 from fastapi.responses import JSONResponse
 from fastapi_jwt_auth.exceptions import AuthJWTException
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from starlette import status
+
+# SQLSTATE of statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
 
 
 def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     return JSONResponse(status_code=exc.status_code, content={"detail": exc.message})
+
+
+def pool_timeout_exception_handler(request: Request, exc: PoolTimeoutError):
+    """No free DB connection in DB_POOL_TIMEOUT: ask client to retry instead of queueing it further"""
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={"detail": "Service is busy, try again later"},
+                        headers={'Retry-After': '1'})
+
+
+def dbapi_exception_handler(request: Request, exc: DBAPIError):
+    if getattr(exc.orig, 'pgcode', None) != QUERY_CANCELED:
+        raise exc
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={"detail": "Request took too long, try again later"},
+                        headers={'Retry-After': '5'})
@@ -1,23 +1,45 @@
-from typing import Any
-from uuid import UUID
+from typing import Any, Optional, Set
 
-from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi import APIRouter, Depends, File, HTTPException, Body, Query, UploadFile
 from fastapi_pagination import LimitOffsetPage
-from fastapi_pagination.ext.sqlalchemy import paginate
 from psycopg2.errors import UniqueViolation  # noqa
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
 
 from app import crud as crud
 from app import models, schemas
-from app.utils.security import check_for_permission, get_password_hash
+from app.conf.db.session import ReadSessionLocal, SessionLocal, set_statement_timeout
+from app.conf.settings import settings
+from app.conf.permission_settings import Permissions
+from app.utils.counts import count_strategy_param, paginate
+from app.utils.export import EXPORT_FORMATS, encode_rows, gzip_chunks
+from app.utils.permissions import permission_registry
+from app.utils.security import get_password_hash
+from app.utils.user_import import detect_format, job_path, read_job_progress, start_import_job
 from app.routers import deps
+from app.routers.v1.auth.auth import restore_user_tokens, revoke_user_tokens
 from app.schemas.role import RolesType
 
 router = APIRouter()
 
+CHANGE_PROFILE_MASK = permission_registry.mask(Permissions.CHANGE_ANOTHER_USERS_PROFILE.value, strict=True)
+CHANGE_PASSWORD_MASK = permission_registry.mask(Permissions.CHANGE_ANOTHER_USERS_PASSWORD.value, strict=True)
+BLOCK_USERS_MASK = permission_registry.mask(Permissions.BLOCK_USERS.value, strict=True)
+# permission to create users of the role; unknown permission gives empty mask and nobody gets the role
+ROLE_CREATE_MASKS = {
+    RolesType.ADMIN.value: permission_registry.mask('CREATE_ADMINS'),
+    RolesType.CONTENT_MANAGER.value: permission_registry.mask('CREATE_CONTENTS'),
+    RolesType.SEO_SPECIALIST.value: permission_registry.mask('CREATE_SEO'),
+}
+
+
+def creatable_roles(permissions_mask: int) -> Set[str]:
+    """Roles current user may give to new users: create_user and import_users"""
+    return {role for role, required_mask in ROLE_CREATE_MASKS.items()
+            if required_mask and permission_registry.has(permissions_mask, required_mask)}
+
 # todo: refactor all -_-
 
 # note: probably some functionality could be replaced with CRUDEndpointFactory
@@ -25,26 +47,59 @@ router = APIRouter()
 
 @router.get("/users_list", response_model=LimitOffsetPage[schemas.User])
 def get_users(
-        db: Session = Depends(deps.get_db),
-        permissions: list = Depends(deps.get_current_user_permission_list),
+        db: Session = Depends(deps.get_report_db),
+        count_strategy: Optional[str] = Depends(count_strategy_param),
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.GET_USERS_LIST.value,))),
 ) -> Any:
     """
-    Get list of all users. Available for SUPERUSER, ADMIN
+    Get list of all users. Available for SUPERUSER, ADMIN.
+    Total is estimated on big tables, pass count=exact to get exact one
     """
-    check_for_permission('GET_USERS_LIST', permissions)
-    users = paginate(db.query(models.User))
+    users = paginate(db.query(models.User).order_by(models.User.id), count_strategy)
     return users
 
 
+USERS_EXPORT_COLUMNS = ('id', 'email', 'username', 'name', 'middle_name', 'last_name', 'role',
+                        'is_active', 'is_superuser', 'is_subscribed', 'created_at', 'last_login_at')
+
+
+@router.get("/users_export")
+def export_users(
+        export_format: str = Query('ndjson', alias='format', regex='^(ndjson|csv)$'),
+        gzip: bool = False,
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.GET_USERS_LIST.value,))),
+) -> Any:
+    """
+    Export all users as NDJSON or CSV. Rows are streamed from server-side cursor as they arrive,
+    without COUNT(*) and OFFSET. Available for SUPERUSER, ADMIN
+    """
+    slot = deps.ReportSlot()
+
+    def rows():
+        # own session: connection is held only while response is streamed
+        with slot, ReadSessionLocal() as db:
+            set_statement_timeout(db, settings.REPORT_STATEMENT_TIMEOUT)
+            yield from crud.user.iter_export_rows(db, USERS_EXPORT_COLUMNS)
+
+    content = encode_rows(rows(), USERS_EXPORT_COLUMNS, export_format)
+    headers = {'Content-Disposition': f'attachment; filename="users.{export_format}"'}
+    if gzip:
+        content = gzip_chunks(content)
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(content, media_type=EXPORT_FORMATS[export_format], headers=headers)
+
+
 @router.get("/get_roles", response_model=schemas.RolesList)
 def get_all_available_roles(
         db: Session = Depends(deps.get_db),
-        permissions: list = Depends(deps.get_current_user_permission_list),
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.GET_ROLES.value,))),
 ) -> Any:
     """
     Get list of all available roles in system. Available for SUPERUSER, ADMIN
     """
-    check_for_permission('GET_ROLES', permissions)
     roles = crud.role.get_multi(db, skip=0, limit=100)
     all_roles = [r.name for r in roles]
     return {'roles': all_roles}
@@ -55,20 +110,17 @@ def create_user(
         *,
         db: Session = Depends(deps.get_db),
         user_in: schemas.UserCreate,
-        permissions: list = Depends(deps.get_current_user_permission_list),
+        permissions_mask: int = Depends(deps.get_current_user_permission_mask),
 ) -> Any:
     """
     Create New user with access lower than current user access level
     """
 
-    if user_in.role not in [RolesType.ADMIN, RolesType.CONTENT_MANAGER, RolesType.SEO_SPECIALIST]:
+    if user_in.role not in ROLE_CREATE_MASKS:
         raise HTTPException(detail='Incorrect role type. Please check it',
                             status_code=status.HTTP_400_BAD_REQUEST)
-    required_permission = 'CREATE_ADMINS' if user_in.role == RolesType.ADMIN else \
-        'CREATE_CONTENTS' if user_in.role == RolesType.CONTENT_MANAGER else \
-        'CREATE_SEO' if user_in.role == RolesType.SEO_SPECIALIST else None
 
-    if required_permission in permissions:
+    if user_in.role in creatable_roles(permissions_mask):
         user = crud.user.get_by_email(db, email=user_in.email)
         if user:
             raise HTTPException(
@@ -94,35 +146,86 @@ def create_user(
                             status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
+@router.post("/import_users", response_model=schemas.UserImportJob)
+def import_users(
+        file: UploadFile = File(..., description="CSV with header or JSONL, fields of UserCreate and role"),
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.CREATE_TEACHER.value,))),
+        permissions_mask: int = Depends(deps.get_current_user_permission_mask),
+) -> Any:
+    """
+    Start bulk import of users, check progress with GET /import_users/{job_id}.
+    Rows with roles current user can't give (see create_user) are rejected, job takes a report slot
+    """
+    try:
+        fmt = detect_format(file.filename)
+    except ValueError as e:
+        raise HTTPException(detail=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+    allowed_roles = creatable_roles(permissions_mask)
+    if not allowed_roles:
+        raise HTTPException(detail="Method not allowed!", status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+    # held by import thread until the job ends: imports share REPORT_CONNECTIONS with reports
+    return start_import_job(file.file, fmt, allowed_roles=allowed_roles, slot=deps.ReportSlot())
+
+
+@router.get("/import_users/{job_id}", response_model=schemas.UserImportJob)
+def get_import_users_job(
+        job_id: str,
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.CREATE_TEACHER.value,))),
+) -> Any:
+    """
+    Progress of users import job
+    """
+    progress = read_job_progress(job_id)
+    if not progress:
+        raise HTTPException(detail="Import job not found", status_code=status.HTTP_404_NOT_FOUND)
+    return progress
+
+
+@router.get("/import_users/{job_id}/errors")
+def get_import_users_errors(
+        job_id: str,
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.CREATE_TEACHER.value,))),
+) -> Any:
+    """
+    Per-row report of users import job (rejected and skipped rows), CSV
+    """
+    if not read_job_progress(job_id):
+        raise HTTPException(detail="Import job not found", status_code=status.HTTP_404_NOT_FOUND)
+    return FileResponse(job_path(job_id, 'errors.csv'), media_type='text/csv',
+                        filename=f'user_import_{job_id}_errors.csv')
+
+
 @router.get("/{user_id}", response_model=schemas.User)
 def get_user_by_id(
-        user_id: UUID,
+        user_id: int,
         db: Session = Depends(deps.get_db),
-        permissions: list = Depends(deps.get_current_user_permission_list),
-
+        permission_allowed: bool = Depends(deps.check_current_user_for_permission(
+            (Permissions.GET_USERS_LIST.value,))),
 ) -> Any:
     """
     Get a specific user by id.
     """
-    check_for_permission('GET_USER_LIST', permissions)
-    return crud.user.get(db, obj_id=user_id)
+    return crud.user.get(db, obj_id=user_id, profile='principal')
 
 
 @router.put("/{user_id}", response_model=schemas.User)
 def update_user_profile(
         *,
         db: Session = Depends(deps.get_db),
-        user_id: UUID,
+        user_id: int,
         user_in: schemas.UserProfileUpdate,
         current_user: models.User = Depends(deps.get_current_active_user),
-        permissions: list = Depends(deps.get_current_user_permission_list)
+        permissions_mask: int = Depends(deps.get_current_user_permission_mask)
 ) -> Any:
     """
     Update a user profile.
     """
-    user = crud.user.get(db, obj_id=user_id)
+    user = crud.user.get(db, obj_id=user_id, profile='role')
 
-    if 'CHANGE_ANOTHER_USERS_PROFILE' in permissions and \
+    if permission_registry.has(permissions_mask, CHANGE_PROFILE_MASK) and \
             current_user.roles.role.access_level < user.roles.role.access_level:
 
         if not user:
@@ -148,17 +251,17 @@ def update_user_profile(
 def change_another_user_password(
         *,
         db: Session = Depends(deps.get_db),
-        user_id: UUID,
+        user_id: int,
         new_password: str = Body(..., embed=True),
         current_user: models.User = Depends(deps.get_current_active_user),
-        permissions: list = Depends(deps.get_current_user_permission_list)
+        permissions_mask: int = Depends(deps.get_current_user_permission_mask)
 ) -> Any:
     """
     Update a password for another user with access_level lower than current user'.
     """
-    user = crud.user.get(db, obj_id=user_id)
+    user = crud.user.get(db, obj_id=user_id, profile='role')
 
-    if 'CHANGE_ANOTHER_USERS_PASSWORD' in permissions and \
+    if permission_registry.has(permissions_mask, CHANGE_PASSWORD_MASK) and \
             current_user.roles.role.access_level < user.roles.role.access_level:
 
         if not user:
@@ -187,15 +290,15 @@ def change_another_user_password(
 def lock_unlock_users(
         *,
         db: Session = Depends(deps.get_db),
-        user_id: UUID,
+        user_id: int,
         current_user: models.User = Depends(deps.get_current_active_user),
-        permissions: list = Depends(deps.get_current_user_permission_list)
+        permissions_mask: int = Depends(deps.get_current_user_permission_mask)
 ) -> Any:
     """
     Block/Unlock user by SID.
     """
-    user = crud.user.get(db, obj_id=user_id)
-    if 'BLOCK_USERS' in permissions and \
+    user = crud.user.get(db, obj_id=user_id, profile='role')
+    if permission_registry.has(permissions_mask, BLOCK_USERS_MASK) and \
             current_user.roles.role.access_level < user.roles.role.access_level:
 
         if not user:
@@ -203,11 +306,17 @@ def lock_unlock_users(
                 status_code=404,
                 detail="The user with this SID does not exist in the system",
             )
+        # plain def route: denylist store calls below block a threadpool thread, not the event loop
         lock_status = user.is_active
         user.is_active = not lock_status
+        if not lock_status:
+            # before commit: if denylist is unavailable user stays locked instead of unusable
+            restore_user_tokens(user.id)
 
         db.add(user)
         db.commit()
+        if lock_status:
+            revoke_user_tokens(user.id)
 
         locked_message = 'blocked' if lock_status is True else 'unblocked'
         return {'msg': 'User {} {}'.format(user_id, locked_message)}
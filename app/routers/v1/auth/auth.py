@@ -1,18 +1,21 @@
 import json
-from typing import Any
+import time
+from typing import Any, Tuple
 
 from fastapi import APIRouter, Body, Depends, HTTPException, Header, Request
 from fastapi.responses import JSONResponse, Response
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_jwt_auth import AuthJWT
-from fastapi_jwt_auth.exceptions import MissingTokenError
-from sqlalchemy.orm import Session
+from fastapi_jwt_auth.exceptions import AuthJWTException, MissingTokenError, RevokedTokenError
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 from app import crud as crud
 from app import models
 from app import schemas
-from app.utils.security import get_password_hash
+from app.utils.denylist import token_denylist
+from app.utils.permissions import permission_registry
+from app.utils.security import get_password_hash_async
 from app.utils.services import user_agent_parser
 from app.conf.settings import cookies_settings
 from app.routers import deps
@@ -23,26 +26,22 @@ router = APIRouter()
 @router.post('/login', response_model=schemas.MsgLogin)
 async def login(
         request: Request,
-        db: Session = Depends(deps.get_db),
+        db: AsyncSession = Depends(deps.get_async_db),
         form_data: OAuth2PasswordRequestForm = Depends(),
         Authorize: AuthJWT = Depends(),
         user_agent: str = Header(None),
 ) -> Any:
-    user = crud.user.authenticate(
+    user = await crud.async_user.authenticate(
         db, email=form_data.username, password=form_data.password
     )
     if not user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Incorrect email or password")
-    elif not crud.user.is_active(user):
+    elif not crud.async_user.is_active(user):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Inactive user")
 
-    payload = {
-        'id': str(user.id),
-        'role': user.roles.role.name,
-        'permissions': [p.permission.name for p in user.roles.role.permissions]
-    }
+    payload = make_token_payload(user)
 
     access_token = Authorize.create_access_token(
         subject=json.dumps(payload)
@@ -66,18 +65,34 @@ async def login(
 
 @router.post("/refresh_token", response_model=schemas.Msg)
 async def update_access_token(
+        db: AsyncSession = Depends(deps.get_async_db),
         Authorize: AuthJWT = Depends()
 ) -> Any:
+    # revoked (logged out or already used) refresh token is rejected here with 401, see app.utils.denylist
     try:
-        Authorize.jwt_refresh_token_required()
+        await deps.jwt_required_async(Authorize, refresh=True)
     except MissingTokenError:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Refresh token not found")
 
-    user_id = Authorize.get_jwt_subject()
-
-    updated_access_token = Authorize.create_access_token(subject=user_id)
-    updated_refresh_token = Authorize.create_refresh_token(subject=user_id)
+    # refresh token is single use: a stolen copy stops working once either side renews. Claim is atomic
+    # in the store, of two concurrent renewals with one token only the first gets new tokens
+    raw_token = Authorize.get_raw_jwt()
+    if not await token_denylist.revoke_async(raw_token['jti'], raw_token['exp']):
+        raise RevokedTokenError(status_code=401, message="Token has been revoked")
+    subject = raw_token['sub']
+    payload = json.loads(subject)
+
+    # permissions claims changed since login - take actual ones, else reuse subject without DB
+    if not await deps.permission_versions.is_actual(payload.get('role'), payload.get('permissions_version')):
+        user = await crud.async_user.get(db, obj_id=int(payload['id']), profile='principal')
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        subject = json.dumps(make_token_payload(user))
+
+    updated_access_token = Authorize.create_access_token(subject=subject)
+    updated_refresh_token = Authorize.create_refresh_token(subject=subject)
 
     response = JSONResponse({'msg': "Success tokens renewal"},
                             status_code=status.HTTP_200_OK)
@@ -90,9 +105,19 @@ async def update_access_token(
 
 
 @router.post("/logout", response_model=schemas.Msg)
-def logout(Authorize: AuthJWT = Depends()):
+def logout(request: Request, Authorize: AuthJWT = Depends()):
     Authorize.jwt_required()
 
+    # cookies are removed only in this browser, copies of the tokens must stop working too.
+    # revoke_token doesn't raise, cookies are cleared even with denylist store down
+    revoke_token(Authorize.get_raw_jwt())
+    refresh_token = request.cookies.get(Authorize._refresh_cookie_key)
+    if refresh_token:
+        try:
+            revoke_token(Authorize.get_raw_jwt(refresh_token))
+        except AuthJWTException:
+            pass  # expired or forged refresh token is not valid anyway
+
     res = JSONResponse({"msg": "Successfully logout"}, status_code=status.HTTP_200_OK)
 
     remove_cookie(Authorize, res, Authorize._access_cookie_key,
@@ -105,20 +130,66 @@ def logout(Authorize: AuthJWT = Depends()):
 @router.post("/reset_password", response_model=schemas.Msg)
 async def reset_password(
         new_password: str = Body(..., embed=True),
-        current_user: models.User = Depends(deps.get_current_active_user),
-        db: Session = Depends(deps.get_db)
+        current_user: models.User = Depends(deps.get_current_active_user_async),
+        db: AsyncSession = Depends(deps.get_async_db)
 ) -> Any:
     """
     Reset Password from Personal Account (Use in Admin Panel Only - JWT required)
     """
-    hashed_password = get_password_hash(new_password)
+    hashed_password = await get_password_hash_async(new_password)
     current_user.hashed_password = hashed_password
     db.add(current_user)
-    db.commit()
+    await db.commit()
 
     return JSONResponse({"msg": "Password updated successfully"}, status_code=status.HTTP_200_OK)
 
 
+def make_token_payload(user: models.User) -> dict:
+    """
+    JWT subject with permissions claims, user must be loaded with roles -> permissions
+
+    :param user: user with loaded roles
+    """
+    return {
+        'id': str(user.id),
+        'role': user.roles.role.name,
+        'permissions_version': user.roles.role.permissions_version,
+        'permissions_mask': permission_registry.mask(p.permission.name for p in user.roles.role.permissions)
+    }
+
+
+def revoke_token(raw_token: dict):
+    """
+    Put token into denylist until its expiration, blocks on denylist store: for sync routes only
+
+    :param raw_token: verified claims of the token
+    """
+    token_denylist.revoke(raw_token['jti'], raw_token['exp'])
+
+
+def token_keys(raw_token: dict) -> Tuple[str, ...]:
+    """Denylist keys of token: token is revoked by its jti or with all tokens of its user"""
+    return raw_token['jti'], user_key(json.loads(raw_token['sub'])['id'])
+
+
+def user_key(user_id: Any) -> str:
+    return f'user:{user_id}'
+
+
+def revoke_user_tokens(user_id: Any):
+    """
+    Every token issued to user stops working, e.g. user is locked or deleted: permissions claims
+    of access token would be trusted until it expires otherwise. Blocks on denylist store: for sync
+    routes only
+    """
+    token_denylist.revoke(user_key(user_id), time.time() + cookies_settings.auth_refresh_token_lifetime)
+
+
+def restore_user_tokens(user_id: Any):
+    """Undo revoke_user_tokens when user is unlocked, raises if denylist store is unavailable"""
+    token_denylist.restore(user_key(user_id))
+
+
 def remove_cookie(jwt_service: AuthJWT, response: Response, cookie_key: str,
                   cookie_path: str, http_only: bool = True):
     """
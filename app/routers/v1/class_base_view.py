@@ -1,7 +1,7 @@
-from typing import Type, Tuple, Generic, TypeVar
+from typing import Callable, Hashable, List, Type, Tuple, Generic, TypeVar
 
-from fastapi import Depends
-from fastapi_pagination import LimitOffsetPage, paginate
+from fastapi import Depends, Query, Request
+from fastapi_pagination import LimitOffsetPage
 from fastapi_utils.cbv import cbv
 from fastapi_utils.inferring_router import InferringRouter
 from pydantic import BaseModel
@@ -12,6 +12,11 @@ from app.conf.db.base_tablename_class import Base
 from app.conf.permission_settings import Permissions
 from app.crud.base import CRUDBase
 from app.routers.deps import *
+from app.schemas.bulk import BulkResult
+from app.schemas.pagination import CursorPage
+from app.utils.cache import TTLLRUCache
+from app.utils.conditional import conditional_response, latest, make_etag
+from app.utils.counts import COUNT_STRATEGIES, count_strategy_param, paginate
 
 # note: dict is mutable type, DANGER
 default_permission_map = {
@@ -29,7 +34,17 @@ def CRUDEndpointFactory(
         UpdateSchema: Type[BaseModel],
         ResponseSchema: Type[BaseModel],
         crud_obj: CRUDBase,
-        permission_map: dict = default_permission_map  # noqa
+        permission_map: dict = default_permission_map,  # noqa
+        pagination: str = 'keyset',
+        sort_column: str = 'id',
+        sort_descending: bool = False,
+        upsert_keys: Optional[Tuple[str, ...]] = None,
+        cache: Optional[TTLLRUCache] = None,
+        cache_key: Optional[Callable[[Base], Hashable]] = None,
+        version_column: Optional[str] = None,
+        cache_control: Optional[str] = None,
+        count_strategy: Optional[str] = None,
+        on_delete: Optional[Callable[[int], None]] = None,
 ):
     """
     :param Model: SQLAlchemy model class
@@ -39,13 +54,46 @@ def CRUDEndpointFactory(
     :param crud_obj: CRUD-object which implement crud logic
     :param permission_map: Dict with keys 'single', 'list', 'create', 'update', 'delete' and values
      like tuple of strs of permissions for each
+    :param pagination: 'keyset' - list endpoint returns CursorPage with next/prev cursors,
+     'offset' - LimitOffsetPage with LIMIT/OFFSET and COUNT(*) on the database side
+    :param sort_column: indexed column of Model used to sort list in keyset mode
+    :param sort_descending: keyset list goes from the biggest sort_column values
+    :param upsert_keys: unique columns of Model, if set bulk endpoint updates existing rows
+     instead of failing on them
+    :param cache: read cache of these objects kept outside of the factory, create/update/delete
+     invalidate its entries, bulk clears it
+    :param cache_key: key of object in cache, required with cache
+    :param version_column: column of Model changed on every write (version counter, updated_at), GET
+     routes take ETag from it and answer 304 without serialization; if not set ETag is a hash of body
+    :param cache_control: Cache-Control header of GET routes, e.g. 'private, no-cache'
+    :param count_strategy: how 'offset' list computes total by default, see app.utils.counts,
+     client can override it with count query parameter
+    :param on_delete: called with obj_id after object is deleted
     """
+    if pagination not in ('keyset', 'offset'):
+        raise ValueError(f"Unknown pagination mode '{pagination}'")
+    if count_strategy is not None and count_strategy not in COUNT_STRATEGIES:
+        raise ValueError(f"Unknown count strategy '{count_strategy}'")
     router = InferringRouter()
     ModelType = TypeVar("ModelType", bound=Model)
     CreateSchemaType = TypeVar("CreateSchemaType", bound=CreateSchema)
     UpdateSchemaType = TypeVar("UpdateSchemaType", bound=UpdateSchema)
     ResponseSchemaType = TypeVar("ResponseSchemaType", bound=ResponseSchema)
     prefix = '/' + Model.__tablename__ + 's'
+    if cache is not None and cache_key is None:
+        raise ValueError("cache_key is required with cache")
+    if sort_column not in Model.__table__.columns:
+        raise ValueError(f"{Model.__name__} has no column '{sort_column}'")
+    if version_column is not None and not hasattr(Model, version_column):
+        raise ValueError(f"{Model.__name__} has no column '{version_column}'")
+
+    def row_version(obj: Base):
+        return obj.id, getattr(obj, version_column)
+
+    def invalidate(*keys: Hashable):
+        if cache is not None:
+            for key in keys:
+                cache.pop(key)
 
     @cbv(router)
     class BaseView(Generic[ModelType, CreateSchemaType, UpdateSchemaType, ResponseSchemaType]):
@@ -58,22 +106,68 @@ def CRUDEndpointFactory(
         def get_single(
                 self,
                 obj_id: int,
+                request: Request,
+                db: Session = Depends(get_read_db),
                 permission_allowed: bool = Depends(check_current_user_for_permission(permission_map['single']))
         ) -> ResponseSchemaType:
-            """Get single object by id"""
+            """Get single object by id, supports If-None-Match/If-Modified-Since"""
             # check_for_permission(permission_map['single'], permissions)
-            model_obj = self.__crud_obj.get(self.__db, obj_id=obj_id)
-            return ResponseSchema.from_orm(model_obj)
-
-        @router.get(__prefix + '_list')
-        def get_list(
-                self,
-                permission_allowed: bool = Depends(check_current_user_for_permission(permission_map['list']))
-        ) -> LimitOffsetPage[ResponseSchemaType]:
-            """Get Paginated list of objects"""
-            # note: could work much quicker if will be implemented self-made pagination
-            model_objs = self.__crud_obj.get_all(self.__db)
-            return paginate(model_objs)  # noqa
+            model_obj = self.__crud_obj.get(db, obj_id=obj_id)
+            if not model_obj:
+                raise HTTPException(
+                    detail=f"Object with id '{obj_id}' was not found",
+                    status_code=status.HTTP_404_NOT_FOUND
+                )
+            return conditional_response(
+                request,
+                lambda: ResponseSchema.from_orm(model_obj),
+                etag=make_etag(row_version(model_obj)) if version_column else None,
+                last_modified=latest([getattr(model_obj, version_column)]) if version_column else None,
+                cache_control=cache_control,
+            )
+
+        if pagination == 'keyset':
+            @router.get(__prefix + '_list')
+            def get_list(
+                    self,
+                    request: Request,
+                    limit: int = Query(50, ge=1, le=100, description="Page size limit"),
+                    cursor: Optional[str] = Query(None, description="next_cursor/prev_cursor of another page"),
+                    db: Session = Depends(get_read_db),
+                    permission_allowed: bool = Depends(check_current_user_for_permission(permission_map['list']))
+            ) -> CursorPage[ResponseSchema]:
+                """Get keyset-paginated list of objects, supports If-None-Match/If-Modified-Since"""
+                model_objs, next_cursor, prev_cursor = self.__crud_obj.get_page(
+                    db, limit=limit, cursor=cursor, sort_column=sort_column, descending=sort_descending
+                )
+                # next_cursor/prev_cursor depend on rows outside the page (a row appended after the last
+                # page gives it next_cursor), so they are part of the tag. No Last-Modified: dates of
+                # the rows on the page don't change when that happens
+                etag = make_etag(limit, cursor, next_cursor, prev_cursor,
+                                 [row_version(obj) for obj in model_objs]) if version_column else None
+                return conditional_response(
+                    request,
+                    lambda: CursorPage(
+                        items=[ResponseSchema.from_orm(obj) for obj in model_objs],
+                        limit=limit,
+                        next_cursor=next_cursor,
+                        prev_cursor=prev_cursor,
+                    ),
+                    etag=etag,
+                    cache_control=cache_control,
+                )
+        else:
+            @router.get(__prefix + '_list')
+            def get_list(
+                    self,
+                    request: Request,
+                    count: Optional[str] = Depends(count_strategy_param),
+                    db: Session = Depends(get_read_db),
+                    permission_allowed: bool = Depends(check_current_user_for_permission(permission_map['list']))
+            ) -> LimitOffsetPage[ResponseSchema]:
+                """Get Paginated list of objects, supports If-None-Match (ETag is a hash of the page)"""
+                page = paginate(self.__crud_obj.query_all(db), count or count_strategy)
+                return conditional_response(request, lambda: page, cache_control=cache_control)
 
         @router.post(__prefix)
         def create(
@@ -83,8 +177,25 @@ def CRUDEndpointFactory(
         ) -> ResponseSchemaType:
             """ Create an object if user has enough rights """
             created_obj = self.__crud_obj.create(self.__db, obj_in)
+            if cache is not None:
+                invalidate(cache_key(created_obj))
             return ResponseSchema.from_orm(created_obj)
 
+        @router.post(__prefix + '/bulk')
+        def create_bulk(
+                self,
+                objs_in: List[CreateSchemaType],
+                permission_allowed: bool = Depends(check_current_user_for_permission(permission_map['create']))
+        ) -> BulkResult:
+            """ Create (or upsert) many objects with batched multi-row inserts, returns outcome of every row """
+            if upsert_keys:
+                rows = self.__crud_obj.upsert_many(self.__db, objs_in, index_elements=upsert_keys)
+            else:
+                rows = self.__crud_obj.create_many(self.__db, objs_in)
+            if cache is not None:
+                cache.clear()
+            return BulkResult.from_rows(rows)
+
         @router.put(__prefix)
         def update(
                 self,
@@ -99,7 +210,10 @@ def CRUDEndpointFactory(
                     detail=f"Object with id '{obj_id}' was not found, changes aborted",
                     status_code=status.HTTP_400_BAD_REQUEST
                 )
+            old_key = cache_key(model_obj) if cache is not None else None
             created_obj = self.__crud_obj.update(self.__db, model_obj, obj_in)
+            if cache is not None:
+                invalidate(old_key, cache_key(created_obj))
             return ResponseSchema.from_orm(created_obj)
 
         @router.delete(__prefix)
@@ -109,7 +223,13 @@ def CRUDEndpointFactory(
                 permission_allowed: bool = Depends(check_current_user_for_permission(permission_map['delete']))
         ) -> ResponseSchemaType:
             """ Delete object with id=obj_id from database if user has enough rights"""
+            model_obj = self.__crud_obj.get(self.__db, obj_id) if cache is not None else None
+            old_key = cache_key(model_obj) if model_obj is not None else None
             removed_obj = self.__crud_obj.remove(self.__db, obj_id)
+            if old_key is not None:
+                invalidate(old_key)
+            if on_delete is not None:
+                on_delete(obj_id)
             return removed_obj
 
     return router
@@ -119,11 +239,14 @@ def CRUDEndpointFactory(
 from app.models import User
 from app.schemas import User as UserResponse, UserCreate, UserProfileUpdate
 from app.crud import user
+from app.routers.v1.auth.auth import revoke_user_tokens
 
 router2 = CRUDEndpointFactory(
     User,
     UserCreate,
     UserProfileUpdate,
     UserResponse,
-    user
+    user,
+    # permissions claims of deleted user's tokens must not be trusted
+    on_delete=revoke_user_tokens,
 )
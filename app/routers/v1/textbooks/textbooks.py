@@ -0,0 +1,82 @@
+from typing import Any, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.orm import Session
+from starlette import status
+
+from app import crud as crud
+from app import models, schemas
+from app.routers import deps
+from app.conf.settings import settings
+from app.routers.v1.class_base_view import CRUDEndpointFactory
+from app.utils.admission import admission_controller
+from app.utils.cache import TTLLRUCache
+from app.utils.conditional import conditional_response
+
+# public pages read textbooks by slug all the time, changes through crud_router invalidate it,
+# ETL loads (other process) don't: their updates show up when entries expire
+textbook_cache = TTLLRUCache(maxsize=4096, ttl=300)
+# hits don't wait for admission control, misses and unknown slugs queue as db-read
+admission_controller.add_cached(f'(?:GET|HEAD) {settings.API_V1_STR}/textbooks/(?!search$)(?P<key>[^/]+)',
+                                textbook_cache)
+
+crud_router = CRUDEndpointFactory(
+    models.Textbook,
+    schemas.TextbookCreate,
+    schemas.TextbookUpdate,
+    schemas.Textbook,
+    crud.textbook,
+    upsert_keys=('slug',),
+    cache=textbook_cache,
+    cache_key=lambda textbook: textbook.slug,
+    cache_control='private, no-cache',
+)
+
+router = APIRouter()
+
+
+# declared before /textbooks/{slug}, otherwise 'search' is taken for a slug
+@router.get("/textbooks/search", response_model=schemas.CursorPage[schemas.TextbookSearchHit])
+def search_textbooks(
+        q: str = Query(..., min_length=1, max_length=200, description="Words, \"phrase\", -excluded, or"),
+        school_class: Optional[int] = None,
+        limit: int = Query(20, ge=1, le=100, description="Page size limit"),
+        cursor: Optional[str] = Query(None, description="next_cursor/prev_cursor of another page"),
+        db: Session = Depends(deps.get_db),
+) -> Any:
+    """
+    Full-text search of textbooks, best matches first, public
+    """
+    rows, next_cursor, prev_cursor = crud.textbook.search(
+        db, q=q, limit=limit, cursor=cursor, school_class=school_class
+    )
+    return schemas.CursorPage[schemas.TextbookSearchHit](
+        items=[
+            schemas.TextbookSearchHit(**schemas.Textbook.from_orm(textbook).dict(), rank=rank, headline=headline)
+            for textbook, rank, headline in rows
+        ],
+        limit=limit,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+    )
+
+
+@router.get("/textbooks/{slug}", response_model=schemas.Textbook)
+def get_textbook_by_slug(
+        slug: str,
+        request: Request,
+        db: Session = Depends(deps.get_db),
+) -> Any:
+    """
+    Get textbook by slug, public, supports If-None-Match
+    """
+    # taken before the read: entry invalidated by an update during the read isn't overwritten by old row
+    generation = textbook_cache.generation
+    textbook = textbook_cache.get(slug)
+    if textbook is None:
+        textbook_in_db = crud.textbook.get_by_slug(db, slug=slug)
+        if not textbook_in_db:
+            raise HTTPException(detail="Textbook not found", status_code=status.HTTP_404_NOT_FOUND)
+        textbook = schemas.Textbook.from_orm(textbook_in_db)
+        textbook_cache.set(slug, textbook, generation=generation)
+    return conditional_response(request, lambda: textbook, cache_control='public, max-age=60')
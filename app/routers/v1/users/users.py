@@ -13,7 +13,7 @@ router = APIRouter()
 
 
 @router.put("/me", response_model=schemas.UserProfileUpdate)
-async def update_user_me(
+def update_user_me(
         *,
         db: Session = Depends(deps.get_db),
         name: str = Body(None),
@@ -40,9 +40,9 @@ async def update_user_me(
     return user
 
 
-@router.get("/me")
+@router.get("/me", response_model=schemas.User)
 async def get_user_me(
-        current_user: models.User = Depends(deps.get_current_active_user)
+        current_user: models.User = Depends(deps.get_current_active_user_async)
 ) -> Any:
     """
     Get current user info.
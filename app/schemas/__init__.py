@@ -4,3 +4,7 @@ from .role import Role, RoleCreate, RoleInDB, RoleUpdate, RolesList
 from .permission import Permission, PermissionCreate, PermissionUpdate
 from .security import (PermissionXRole, PermissionXRoleCreate, PermissionXRoleUpdate,
                        UserXRole, UserXRoleCreate, UserXRoleUpdate)
+from .pagination import CursorPage
+from .bulk import BulkResult, BulkRowResult
+from .user_import import UserImportJob
+from .textbook import Textbook, TextbookCreate, TextbookSearchHit, TextbookUpdate
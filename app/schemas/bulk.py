@@ -0,0 +1,29 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class BulkRowResult(BaseModel):
+    """Результат для одной строки bulk-запроса, index - позиция строки во входном списке"""
+    index: int
+    status: str  # created / updated / skipped / error
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class BulkResult(BaseModel):
+    created: int = 0
+    updated: int = 0
+    skipped: int = 0
+    errors: int = 0
+    rows: List[BulkRowResult] = []
+
+    @classmethod
+    def from_rows(cls, rows: List[BulkRowResult]) -> 'BulkResult':
+        result = cls(rows=rows)
+        for row in rows:
+            if row.status == 'error':
+                result.errors += 1
+            else:
+                setattr(result, row.status, getattr(result, row.status) + 1)
+        return result
@@ -0,0 +1,15 @@
+from typing import Generic, List, Optional, TypeVar
+
+from pydantic.generics import GenericModel
+
+T = TypeVar("T")
+
+
+class CursorPage(GenericModel, Generic[T]):
+    """
+    Страница keyset-пагинации, для перехода между страницами передается next_cursor/prev_cursor
+    """
+    items: List[T]
+    limit: int
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
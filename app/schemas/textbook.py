@@ -0,0 +1,35 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class TextbookBase(BaseModel):
+    school_class: Optional[int] = None
+    title: Optional[str] = None
+    slug: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
+
+# Properties to receive via API on creation
+class TextbookCreate(TextbookBase):
+    school_class: int = 5
+    title: str
+    slug: str
+
+
+# Properties to receive via API on update
+class TextbookUpdate(TextbookBase):
+    pass
+
+
+# Additional properties to return via API
+class Textbook(TextbookBase):
+    id: int
+
+
+# Search hit with rank and HTML-escaped title where matched words are wrapped into <b></b>
+class TextbookSearchHit(Textbook):
+    rank: float
+    headline: str
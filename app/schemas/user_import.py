@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class UserImportJob(BaseModel):
+    """Состояние задачи импорта пользователей"""
+    id: str
+    status: str  # running / finished / failed
+    processed: int
+    created: int
+    skipped: int
+    errors: int
+    rows_per_sec: float
+    started_at: datetime
+    finished_at: Optional[datetime]
+    detail: Optional[str]
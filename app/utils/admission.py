@@ -0,0 +1,244 @@
+"""
+Admission control: every request of a concurrency class waits for a free slot of the class in a bounded
+FIFO queue, requests that can't get one in time are shed with 503 + Retry-After before doing any work.
+Overloaded bcrypt or DB pool then delays only its own class.
+
+    auth-cpu - routes hashing passwords with bcrypt: /login, /reset_password, creating users,
+               admin password change, users import
+    db-read  - other GET/HEAD routes
+    db-write - other routes with body
+    no class - cheap routes: metrics, docs, logout and textbooks by slug which are in cache, they
+               don't queue at all. Cache misses (and unknown slugs) go to DB, so they queue as db-read
+"""
+import asyncio
+import math
+import re
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Pattern, Tuple
+
+from starlette import status
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.conf.settings import settings
+from app.utils.cache import TTLLRUCache
+from app.utils.metrics import WAIT_BUCKETS, Registry, registry
+
+
+class ConcurrencyClass:
+    def __init__(self, name: str, limit: int, max_queue: int, queue_timeout: float):
+        """
+        :param limit: requests of the class processed at once
+        :param max_queue: requests waiting for a slot, the next one is rejected at once
+        :param queue_timeout: seconds a request may wait, after that it is shed
+        """
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # moving average of processing time, Retry-After is estimated from it
+        self.service_time = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        drain = (self.queued + 1) * self.service_time / self.limit
+        return max(1, math.ceil(drain))
+
+    async def acquire(self) -> Optional[str]:
+        """:return: None if admitted, else reason of shedding: 'queue_full' or 'deadline'"""
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return None
+        if len(self._waiters) >= self.max_queue:
+            return 'queue_full'
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over right at the deadline, give it to the next one
+                self.release()
+            else:
+                waiter.cancel()
+            return 'deadline'
+        except asyncio.CancelledError:
+            # client went away while waiting
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                _discard(self._waiters, waiter)
+            registry.observe('admission_queue_wait_seconds', (('class', self.name),),
+                             time.perf_counter() - started_at)
+        return None
+
+    def release(self, service_time: Optional[float] = None):
+        if service_time is not None:
+            self.service_time += (service_time - self.service_time) * 0.1
+        # slot goes straight to the first waiter still waiting, in_flight stays the same
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'limit': self.limit,
+            'max_queue': self.max_queue,
+            'queue_timeout': self.queue_timeout,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'service_time': self.service_time,
+        }
+
+
+def _discard(waiters: Deque[asyncio.Future], waiter: asyncio.Future):
+    try:
+        waiters.remove(waiter)
+    except ValueError:
+        pass
+
+
+def default_classes() -> Dict[str, ConcurrencyClass]:
+    """
+    bcrypt can't run faster than hasher workers; reads often don't hold a connection for the whole request,
+    so they get twice the pool
+    """
+    auth_limit = settings.ADMISSION_AUTH_LIMIT or settings.PASSWORD_HASH_WORKERS
+    read_limit = settings.ADMISSION_DB_READ_LIMIT or settings.POOL_SIZE * 2
+    write_limit = settings.ADMISSION_DB_WRITE_LIMIT or settings.POOL_SIZE
+    factor = settings.ADMISSION_QUEUE_FACTOR
+    return {
+        'auth-cpu': ConcurrencyClass('auth-cpu', auth_limit, auth_limit * factor,
+                                     settings.ADMISSION_AUTH_QUEUE_TIMEOUT),
+        'db-read': ConcurrencyClass('db-read', read_limit, read_limit * factor, settings.ADMISSION_QUEUE_TIMEOUT),
+        'db-write': ConcurrencyClass('db-write', write_limit, write_limit * factor, settings.ADMISSION_QUEUE_TIMEOUT),
+    }
+
+
+class AdmissionController:
+    def __init__(
+            self,
+            classes: Dict[str, ConcurrencyClass],
+            routes: Dict[str, str],
+            exempt: Iterable[str] = (),
+            cheap: Iterable[str] = (),
+            patterns: Iterable[Tuple[str, str]] = (),
+    ):
+        """
+        :param classes: concurrency classes by name
+        :param routes: path -> class name, other paths get db-read or db-write by method
+        :param exempt: path prefixes that are never queued (metrics, docs)
+        :param cheap: regular expressions of "METHOD path" that are never queued, e.g. logout
+        :param patterns: (regular expression of "METHOD path", class name) for routes with path parameters
+        """
+        self.classes = classes
+        self.routes = routes
+        self.exempt = tuple(exempt)
+        self.cheap = re.compile('|'.join(f'(?:{pattern})' for pattern in cheap)) if cheap else None
+        self.patterns = [(re.compile(pattern), name) for pattern, name in patterns]
+        self.cached: List[Tuple[Pattern, TTLLRUCache]] = []
+
+    def add_cached(self, pattern: str, cache: TTLLRUCache):
+        """
+        Requests matching pattern don't queue while their entry is in cache, misses are classified as usual
+
+        :param pattern: regular expression of "METHOD path" with group 'key' - key of cache
+        """
+        self.cached.append((re.compile(pattern), cache))
+
+    def classify(self, scope: Scope) -> Optional[ConcurrencyClass]:
+        path = scope['path']
+        name = self.routes.get(path)
+        if name is None:
+            if path.startswith(self.exempt):
+                return None
+            method = scope['method']
+            request_line = f'{method} {path}'
+            for pattern, pattern_name in self.patterns:
+                if pattern.fullmatch(request_line):
+                    return self.classes.get(pattern_name)
+            if self.cheap is not None and self.cheap.fullmatch(request_line):
+                return None
+            for pattern, cache in self.cached:
+                match = pattern.fullmatch(request_line)
+                if match and match.group('key') in cache:
+                    return None
+            name = 'db-read' if method in ('GET', 'HEAD') else 'db-write'
+        return self.classes.get(name)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: concurrency_class.stats() for name, concurrency_class in self.classes.items()}
+
+    def collect(self, target: Registry):
+        for name, concurrency_class in self.classes.items():
+            labels = (('class', name),)
+            target.set('admission_in_flight', labels, concurrency_class.in_flight)
+            target.set('admission_queued', labels, concurrency_class.queued)
+            target.set('admission_limit', labels, concurrency_class.limit)
+
+
+registry.gauge('admission_in_flight', 'Requests of concurrency class being processed')
+registry.gauge('admission_queued', 'Requests waiting for a slot of concurrency class')
+registry.gauge('admission_limit', 'Slots of concurrency class')
+registry.counter('admission_shed_total', 'Requests rejected with 503 by class and reason (queue_full, deadline)')
+registry.histogram('admission_queue_wait_seconds', 'Time waiting for a slot of concurrency class', WAIT_BUCKETS)
+
+admission_controller = AdmissionController(
+    default_classes(),
+    {
+        settings.API_V1_STR + '/login': 'auth-cpu',
+        settings.API_V1_STR + '/reset_password': 'auth-cpu',
+        settings.API_V1_STR + '/admin/create_user': 'auth-cpu',
+        settings.API_V1_STR + '/admin/import_users': 'auth-cpu',
+    },
+    exempt=('/metrics', '/docs', '/redoc', settings.API_V1_STR + '/openapi.json'),
+    cheap=(
+        f'POST {settings.API_V1_STR}/logout',
+    ),
+    patterns=(
+        (f'PUT {settings.API_V1_STR}/admin/password/[^/]+', 'auth-cpu'),
+        (f'POST {settings.API_V1_STR}/users(?:/bulk)?', 'auth-cpu'),
+    ),
+)
+registry.collectors.append(admission_controller.collect)
+
+
+class AdmissionMiddleware:
+    def __init__(self, app: ASGIApp, controller: AdmissionController = admission_controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        concurrency_class = self.controller.classify(scope) if scope['type'] == 'http' else None
+        if concurrency_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        shed_reason = await concurrency_class.acquire()
+        if shed_reason is not None:
+            registry.inc('admission_shed_total', (('class', concurrency_class.name), ('reason', shed_reason)))
+            response = JSONResponse({'detail': 'Server is busy, try again later'},
+                                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    headers={'Retry-After': str(concurrency_class.retry_after())})
+            await response(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            concurrency_class.release(time.perf_counter() - started_at)
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class TTLLRUCache:
+    """
+    In-process LRU cache with TTL. Lives in one worker: invalidation doesn't reach other workers,
+    their copies expire after ttl seconds.
+
+    Every invalidation bumps generation. A reader that filled a miss from DB passes generation taken
+    before the read to set: if an update invalidated the cache meanwhile, its possibly old value is dropped.
+    """
+    _missing = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()  # sync endpoints run in threadpool
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, self._missing)
+            if item is self._missing or item[1] < time.monotonic():
+                if item is not self._missing:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Fresh entry is in cache, doesn't count as hit and doesn't move it in LRU order"""
+        with self._lock:
+            item = self._data.get(key, self._missing)
+            return item is not self._missing and item[1] >= time.monotonic()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None) -> bool:
+        """:return: False if value wasn't stored: cache was invalidated after generation was taken"""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
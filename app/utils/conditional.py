@@ -0,0 +1,96 @@
+"""
+Conditional GET: strong ETag, Last-Modified, 304 Not Modified.
+"""
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Callable, Iterable, Optional
+
+from fastapi.encoders import jsonable_encoder
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+def make_etag(*parts: Any) -> str:
+    """Strong ETag from row versions (id, updated_at, ...), parts must change on every write"""
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def body_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def render(content: Any) -> bytes:
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match uses weak comparison, so W/ prefix of client's tags is ignored"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+def not_modified_since(request: Request, last_modified: Optional[datetime]) -> bool:
+    """If-Modified-Since is checked only when client didn't send If-None-Match"""
+    header = request.headers.get('if-modified-since')
+    if last_modified is None or not header or 'if-none-match' in request.headers:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return _as_utc(last_modified).replace(microsecond=0) <= since
+
+
+def latest(values: Iterable[Any]) -> Optional[datetime]:
+    dates = [value for value in values if isinstance(value, datetime)]
+    return max(dates, key=_as_utc) if dates else None
+
+
+def _as_utc(value: datetime) -> datetime:
+    # naive datetimes are stored in server local time
+    return value.astimezone(timezone.utc)
+
+
+def conditional_response(
+        request: Request,
+        content: Callable[[], Any],
+        *,
+        etag: Optional[str] = None,
+        last_modified: Optional[datetime] = None,
+        cache_control: Optional[str] = None,
+) -> Response:
+    """
+    JSON response or 304 if client already has this representation.
+
+    :param content: builds response content, is not called when etag is known and matches
+    :param etag: ETag from row versions, if not set it is a hash of serialized body
+    :param last_modified: time of the latest change of the content, if known
+    :param cache_control: Cache-Control header value
+    """
+    headers = {}
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(_as_utc(last_modified), usegmt=True)
+
+    body = None
+    if etag is None:
+        body = render(content())
+        etag = body_etag(body)
+    headers['ETag'] = etag
+
+    if etag_matches(request, etag) or not_modified_since(request, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if body is None:
+        body = render(content())
+    return Response(body, media_type='application/json', headers=headers)
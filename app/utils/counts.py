@@ -0,0 +1,151 @@
+"""
+Totals for LimitOffsetPage without COUNT(*) over the whole table on every page request.
+
+    exact    - SELECT count(*), sequential scan on big tables
+    estimate - planner estimate: pg_class.reltuples for the whole table, EXPLAIN rows for filtered query
+    cached   - exact count kept for COUNT_CACHE_TTL seconds, commits writing the table drop it
+    auto     - exact while the estimate is below EXACT_COUNT_THRESHOLD, estimate above it
+"""
+import itertools
+import json
+from typing import Any, Dict, Optional, Set
+
+from fastapi import Query as QueryParam
+from fastapi_pagination.api import create_page, resolve_params
+from fastapi_pagination.bases import AbstractPage, AbstractParams
+from fastapi_pagination.ext.sqlalchemy import paginate_query
+from sqlalchemy import Table, event, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query, Session
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app.conf.settings import settings
+from app.utils.cache import TTLLRUCache
+
+COUNT_STRATEGIES = ('auto', 'exact', 'estimate', 'cached')
+
+count_cache = TTLLRUCache(maxsize=1024, ttl=settings.COUNT_CACHE_TTL)
+# table -> generation, bumped on commit of a write; old cache keys become unreachable and age out
+_generations: Dict[str, int] = {}
+_generation_counter = itertools.count(1)
+
+
+def count_strategy_param(
+        count: Optional[str] = QueryParam(
+            None, regex=f"^({'|'.join(COUNT_STRATEGIES)})$", description="How to compute total of the page"
+        )
+) -> Optional[str]:
+    return count
+
+
+def _table_name(query: Query) -> str:
+    table = query.column_descriptions[0]['entity'].__table__
+    return table.fullname
+
+
+def _is_whole_table(query: Query) -> bool:
+    """Rows of query are all rows of one table: no filter, join, DISTINCT, GROUP BY or LIMIT"""
+    statement = query.statement
+    froms = statement.get_final_froms()
+    return (
+        statement.whereclause is None
+        and len(query.column_descriptions) == 1
+        and len(froms) == 1 and isinstance(froms[0], Table)
+        and not statement._distinct and not statement._group_by_clauses
+        and statement._limit_clause is None and statement._offset_clause is None
+    )
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of statement, its parameters stay bound"""
+    inherit_cache = False
+
+    def __init__(self, statement: Any):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element: Explain, compiler: Any, **kw: Any) -> str:
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def exact_count(query: Query) -> int:
+    return query.order_by(None).count()
+
+
+def estimated_count(db: Session, query: Query) -> int:
+    """Planner estimate, costs a catalog lookup. -1 in reltuples means table was never analyzed"""
+    if _is_whole_table(query):
+        estimate = db.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+            {'table': _table_name(query)},
+        ).scalar()
+        if estimate is not None and estimate >= 0:
+            return estimate
+    plan = db.execute(Explain(query.order_by(None).statement)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def cached_count(query: Query) -> int:
+    table = _table_name(query)
+    statement = query.order_by(None).statement.compile()
+    key = (table, _generations.get(table, 0), str(statement), repr(sorted(statement.params.items())))
+    total = count_cache.get(key)
+    if total is None:
+        total = exact_count(query)
+        count_cache.set(key, total)
+    return total
+
+
+def count(db: Session, query: Query, strategy: Optional[str] = None) -> int:
+    """
+    Total rows of query by strategy, settings.COUNT_STRATEGY if not set
+
+    :param query: ORM query over one model
+    :param strategy: one of COUNT_STRATEGIES
+    """
+    strategy = strategy or settings.COUNT_STRATEGY
+    if strategy == 'exact':
+        return exact_count(query)
+    if strategy == 'cached':
+        return cached_count(query)
+    estimate = estimated_count(db, query)
+    if strategy == 'estimate' or estimate >= settings.EXACT_COUNT_THRESHOLD:
+        return estimate
+    return exact_count(query)
+
+
+def paginate(query: Query, strategy: Optional[str] = None, params: Optional[AbstractParams] = None) -> AbstractPage:
+    """Same as fastapi_pagination.ext.sqlalchemy.paginate, but total is taken by count strategy"""
+    params = resolve_params(params)
+    total = count(query.session, query, strategy)
+    items = list(paginate_query(query, params))
+    return create_page(items, total, params)
+
+
+def invalidate_counts(*tables: str):
+    for table in tables:
+        _generations[table] = next(_generation_counter)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed_tables(session: Session, flush_context: Any):
+    tables: Set[str] = session.info.setdefault('count_tables', set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        tables.add(obj.__table__.fullname)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_executed_tables(orm_execute_state: Any):
+    # bulk INSERT/UPDATE/DELETE statements don't go through flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None:
+            orm_execute_state.session.info.setdefault('count_tables', set()).add(table.fullname)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_tables(session: Session):
+    invalidate_counts(*session.info.pop('count_tables', ()))
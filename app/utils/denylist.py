@@ -0,0 +1,420 @@
+"""
+Revoked tokens: jti is kept in the store until the token would expire anyway, a bloom filter of
+revoked jti in every worker answers "not revoked" without a round trip, only its positives (revoked
+tokens and rare false positives) are checked in the store.
+
+With Redis store workers follow a stream of revocations and add them to their filters, the filter is
+rebuilt from unexpired jti every TOKEN_DENYLIST_REBUILD_INTERVAL to drop expired ones. Memory store is
+for one worker, its filter is rebuilt on revocation once the interval has passed.
+
+Besides jti, keys like user:<id> revoke all tokens of a user (locked or deleted) until restore().
+
+In event loop the store is never asked synchronously: check() answers from the filter and leaves a
+positive to confirm() with async client, see deps.jwt_required_async.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.conf.settings import settings
+from app.utils.metrics import Registry, registry
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        :param capacity: expected number of items
+        :param error_rate: false positive rate at capacity
+        """
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # double hashing over one blake2b digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return ((h1 + i * h2) % size for i in range(self.hashes))
+
+    def add(self, item: str):
+        bits = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class MemoryDenylistStore:
+    shared = False
+
+    def __init__(self, prune_interval: float = 60):
+        """:param prune_interval: expired jti are dropped on add at most this often, seconds"""
+        self.prune_interval = prune_interval
+        self._expires: Dict[str, float] = {}  # jti -> unix time of token expiration
+        self._pruned_at = time.monotonic()
+
+    def add(self, jti: str, expires_at: float) -> bool:
+        """:return: False if jti is in denylist already"""
+        if time.monotonic() - self._pruned_at > self.prune_interval:
+            self.active()
+        if self.contains(jti):
+            return False
+        self._expires[jti] = expires_at
+        return True
+
+    async def add_async(self, jti: str, expires_at: float) -> bool:
+        return self.add(jti, expires_at)
+
+    def contains(self, jti: str) -> bool:
+        expires_at = self._expires.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    async def contains_async(self, jti: str) -> bool:
+        return self.contains(jti)
+
+    def remove(self, jti: str):
+        self._expires.pop(jti, None)
+
+    def active(self) -> List[str]:
+        now = time.time()
+        self._pruned_at = time.monotonic()
+        self._expires = {jti: expires_at for jti, expires_at in self._expires.items() if expires_at > now}
+        return list(self._expires)
+
+
+class RedisDenylistStore:
+    """
+    <prefix><jti> with TTL - the denylist itself, <prefix>all - sorted set of jti by expiration to rebuild
+    filters, <prefix>log - stream of revocations followed by workers
+    """
+    shared = True
+
+    def __init__(self, client: Any = None, async_client: Any = None, prefix: str = 'revoked:',
+                 log_length: int = 100000):
+        """
+        :param client: redis.Redis or compatible fake, by default two are created on first use from
+         REDIS_HOST/REDIS_PORT: one with short timeouts for checks, one blocking on XREAD for follow()
+        :param async_client: redis.asyncio.Redis or compatible fake for checks in event loop,
+         by default created on first use
+        :param log_length: approximate length the revocation stream is trimmed to
+        """
+        self._client = client
+        self._follow_client = client
+        self._async_client = async_client
+        self.prefix = prefix
+        self.log_length = log_length
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            self._client = _connect(socket_timeout=0.1)
+        return self._client
+
+    @property
+    def follow_client(self) -> Any:
+        if self._follow_client is None:
+            self._follow_client = _connect(socket_timeout=None)
+        return self._follow_client
+
+    @property
+    def async_client(self) -> Any:
+        if self._async_client is None:
+            import redis.asyncio
+
+            self._async_client = redis.asyncio.Redis(host=settings.REDIS_HOST, port=int(settings.REDIS_PORT),
+                                                     socket_connect_timeout=0.1, socket_timeout=0.1)
+        return self._async_client
+
+    def add(self, jti: str, expires_at: float) -> bool:
+        """:return: False if jti is in denylist already, SET NX makes it atomic across workers"""
+        ttl = math.ceil(expires_at - time.time())
+        if ttl <= 0:
+            return True
+        if not self.client.set(self.prefix + jti, 1, ex=ttl, nx=True):
+            return False
+        self._announce(self.client.pipeline(), jti, expires_at).execute()
+        return True
+
+    async def add_async(self, jti: str, expires_at: float) -> bool:
+        ttl = math.ceil(expires_at - time.time())
+        if ttl <= 0:
+            return True
+        if not await self.async_client.set(self.prefix + jti, 1, ex=ttl, nx=True):
+            return False
+        await self._announce(self.async_client.pipeline(), jti, expires_at).execute()
+        return True
+
+    def _announce(self, pipeline: Any, jti: str, expires_at: float) -> Any:
+        pipeline.zadd(self.prefix + 'all', {jti: expires_at})
+        pipeline.xadd(self.prefix + 'log', {'jti': jti}, maxlen=self.log_length, approximate=True)
+        return pipeline
+
+    def contains(self, jti: str) -> bool:
+        return bool(self.client.exists(self.prefix + jti))
+
+    async def contains_async(self, jti: str) -> bool:
+        return bool(await self.async_client.exists(self.prefix + jti))
+
+    def remove(self, jti: str):
+        # filters of workers keep it until rebuild, their positives are answered by the store
+        pipeline = self.client.pipeline()
+        pipeline.delete(self.prefix + jti)
+        pipeline.zrem(self.prefix + 'all', jti)
+        pipeline.execute()
+
+    def active(self) -> List[str]:
+        self.follow_client.zremrangebyscore(self.prefix + 'all', '-inf', time.time())
+        return [_decode(jti) for jti in self.follow_client.zrange(self.prefix + 'all', 0, -1)]
+
+    def last_event_id(self) -> str:
+        last = self.follow_client.xrevrange(self.prefix + 'log', count=1)
+        return _decode(last[0][0]) if last else '0-0'
+
+    def follow(self, last_id: str, timeout: float) -> Tuple[str, List[str]]:
+        """:return: id of the last seen revocation and jti revoked after last_id, waits up to timeout for them"""
+        response = self.follow_client.xread({self.prefix + 'log': last_id}, count=1000, block=int(timeout * 1000))
+        jtis = []
+        for _, events in response or ():
+            for event_id, fields in events:
+                last_id = _decode(event_id)
+                jtis.append(_decode(fields.get(b'jti', fields.get('jti'))))
+        return last_id, jtis
+
+
+def _connect(socket_timeout: Optional[float]) -> Any:
+    import redis
+
+    return redis.Redis(host=settings.REDIS_HOST, port=int(settings.REDIS_PORT),
+                       socket_connect_timeout=0.1, socket_timeout=socket_timeout)
+
+
+def _decode(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# jti left by check() in event loop for confirm() of the same request
+_unconfirmed: ContextVar[Tuple[str, ...]] = ContextVar('token_denylist_unconfirmed', default=())
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class TokenDenylist:
+    def __init__(self, store: Any, capacity: int, error_rate: float, rebuild_interval: float):
+        """
+        :param store: MemoryDenylistStore, RedisDenylistStore or compatible
+        :param capacity: revoked unexpired tokens the filter is sized for
+        :param error_rate: share of not revoked tokens that still go to the store
+        :param rebuild_interval: seconds between filter rebuilds from the store
+        """
+        self.store = store
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.filter = BloomFilter(capacity, error_rate)
+        # shared store: until the filter is loaded every check goes to the store
+        self.ready = not store.shared
+        self.store_checks = 0
+        self._store_down_until = 0.0
+        self._rebuild_at = time.monotonic() + rebuild_interval
+        # revocations the store didn't take, sync thread retries them
+        self._pending: Dict[str, float] = {}
+        self._pid: Optional[int] = None
+
+    def revoke(self, jti: str, expires_at: float) -> bool:
+        """
+        Never raises: with the store down the token is revoked in this worker until the store is back.
+        Blocks on the store, in event loop use revoke_async
+
+        :return: False if jti was revoked already, e.g. refresh token used twice
+        """
+        if not self._before_revoke(jti):
+            return False
+        try:
+            return self.store.add(jti, expires_at)
+        except Exception as e:
+            return self._queue(jti, expires_at, e)
+
+    async def revoke_async(self, jti: str, expires_at: float) -> bool:
+        if not self._before_revoke(jti):
+            return False
+        try:
+            return await self.store.add_async(jti, expires_at)
+        except Exception as e:
+            return self._queue(jti, expires_at, e)
+
+    def _before_revoke(self, jti: str) -> bool:
+        self.ensure_started()
+        if jti in self._pending:
+            return False
+        if not self.store.shared and time.monotonic() > self._rebuild_at:
+            self._rebuild()
+        self.filter.add(jti)
+        return True
+
+    def _queue(self, jti: str, expires_at: float, e: Exception) -> bool:
+        logger.warning('Token denylist store failed, revocation is queued: %s', e)
+        self._pending[jti] = expires_at
+        return True
+
+    def restore(self, jti: str):
+        """Take key out of denylist, raises if the store fails"""
+        self._pending.pop(jti, None)
+        self.store.remove(jti)
+
+    def _local(self, jti: str) -> Optional[bool]:
+        """Answer without the store, None if it must be asked"""
+        if self.ready and jti not in self.filter:
+            return False
+        if jti in self._pending:
+            return True
+        # store is unreachable: trust the filter, tokens it doesn't know pass
+        if time.monotonic() < self._store_down_until:
+            return self.ready
+        return None
+
+    def _store_failed(self, e: Exception) -> bool:
+        logger.warning('Token denylist store failed: %s', e)
+        self._store_down_until = time.monotonic() + 1
+        return self.ready
+
+    def is_revoked(self, jti: str) -> bool:
+        self.ensure_started()
+        revoked = self._local(jti)
+        if revoked is not None:
+            return revoked
+        self.store_checks += 1
+        try:
+            return self.store.contains(jti)
+        except Exception as e:
+            return self._store_failed(e)
+
+    async def is_revoked_async(self, jti: str) -> bool:
+        self.ensure_started()
+        revoked = self._local(jti)
+        if revoked is not None:
+            return revoked
+        self.store_checks += 1
+        try:
+            return await self.store.contains_async(jti)
+        except Exception as e:
+            return self._store_failed(e)
+
+    def check(self, *keys: str) -> bool:
+        """
+        Denylist loader of AuthJWT: token is revoked if any of its keys is. In event loop keys that
+        need the store pass here and are checked by confirm() right after jwt_required()
+        """
+        # memory store is asked in place, it doesn't block
+        if not self.store.shared or not _in_event_loop():
+            return any(self.is_revoked(key) for key in keys)
+        self.ensure_started()
+        unconfirmed = []
+        for key in keys:
+            revoked = self._local(key)
+            if revoked:
+                return True
+            if revoked is None:
+                unconfirmed.append(key)
+        _unconfirmed.set(tuple(unconfirmed))
+        return False
+
+    async def confirm(self) -> bool:
+        """:return: True if token left by check() in this request is revoked"""
+        keys = _unconfirmed.get()
+        if not keys:
+            return False
+        _unconfirmed.set(())
+        for key in keys:
+            if await self.is_revoked_async(key):
+                return True
+        return False
+
+    def ensure_started(self):
+        """Sync thread is started lazily in every worker"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        if self.store.shared:
+            threading.Thread(target=self._run, name='token-denylist', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._sync()
+            except Exception as e:
+                logger.warning('Token denylist sync failed: %s', e)
+                time.sleep(1)
+
+    def _rebuild(self):
+        rebuilt = BloomFilter(self.capacity, self.error_rate)
+        for jti in self.store.active():
+            rebuilt.add(jti)
+        for jti in list(self._pending):
+            rebuilt.add(jti)
+        self.filter = rebuilt
+        self._rebuild_at = time.monotonic() + self.rebuild_interval
+        if rebuilt.count > self.capacity:
+            logger.warning('Token denylist has %s tokens, filter is sized for %s', rebuilt.count, self.capacity)
+
+    def _flush_pending(self):
+        for jti, expires_at in list(self._pending.items()):
+            self.store.add(jti, expires_at)
+            del self._pending[jti]
+
+    def _sync(self):
+        self._flush_pending()
+        # position is taken before the snapshot, revocations in between come through the stream
+        last_id = self.store.last_event_id()
+        self._rebuild()
+        self.ready = True
+        while time.monotonic() < self._rebuild_at:
+            last_id, jtis = self.store.follow(last_id, timeout=1)
+            for jti in jtis:
+                self.filter.add(jti)
+            self._flush_pending()
+
+    def collect(self, target: Registry):
+        target.set('token_denylist_filter_items', (), self.filter.count)
+        target.set('token_denylist_store_checks', (), self.store_checks)
+
+
+def make_denylist_store(backend: str) -> Any:
+    if backend == 'memory':
+        return MemoryDenylistStore()
+    if backend == 'redis':
+        return RedisDenylistStore()
+    raise ValueError(f"Unknown token denylist backend '{backend}'")
+
+
+token_denylist = TokenDenylist(
+    make_denylist_store(settings.TOKEN_DENYLIST_BACKEND),
+    capacity=settings.TOKEN_DENYLIST_CAPACITY,
+    error_rate=settings.TOKEN_DENYLIST_ERROR_RATE,
+    rebuild_interval=settings.TOKEN_DENYLIST_REBUILD_INTERVAL,
+)
+registry.gauge('token_denylist_filter_items', 'Revoked tokens in bloom filter of this worker')
+registry.gauge('token_denylist_store_checks', 'Token checks that went past the filter to the store')
+registry.collectors.append(token_denylist.collect)
@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+import zlib
+from typing import Any, Iterable, Iterator, Sequence
+
+from fastapi.encoders import jsonable_encoder
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# rows are sent in chunks of about this size instead of one write per row
+CHUNK_SIZE = 64 * 1024
+
+
+def encode_rows(rows: Iterable[Sequence[Any]], columns: Sequence[str], fmt: str) -> Iterator[bytes]:
+    """
+    Сериализует строки по мере поступления в NDJSON/CSV, отдает куски по ~CHUNK_SIZE байт.
+
+    :param rows: итератор кортежей значений в порядке columns
+    :param columns: названия колонок
+    :param fmt: 'ndjson' или 'csv'
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+
+    for row in rows:
+        values = jsonable_encoder(tuple(row))
+        if writer:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False))
+            buffer.write('\n')
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Streaming gzip, nothing is buffered except zlib window"""
+    compressor = zlib.compressobj(wbits=31)  # 31 - gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,411 @@
+"""
+Prometheus text metrics without prometheus_client.
+
+MetricsMiddleware counts requests, latency and SQL statements per route, engine events feed pool
+metrics. Every worker keeps its own registry; with METRICS_DIR set workers also dump snapshots
+there every METRICS_FLUSH_INTERVAL seconds and /metrics of any worker merges all live snapshots:
+counters and histograms are summed, gauges are merged as declared (sum, max or min).
+/metrics is served to METRICS_ALLOWED_NETWORKS or with METRICS_TOKEN only.
+"""
+import ipaddress
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Mount
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.conf.settings import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class RequestStats:
+    """Per-request counters, shared with threadpool through contextvar (context is copied, object is not)"""
+    __slots__ = ('queries',)
+
+    def __init__(self):
+        self.queries = 0
+
+
+current_request_stats: ContextVar[Optional[RequestStats]] = ContextVar('current_request_stats', default=None)
+
+
+GAUGE_MERGES: Dict[str, Callable[[float, float], float]] = {
+    'sum': lambda a, b: a + b,
+    'max': max,
+    'min': min,
+}
+
+
+class Registry:
+    """
+    Counters, gauges and histograms of one process. One uncontended lock around a few dict
+    updates: the event loop is the main writer, pool events come from threadpool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.help: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.gauge_merge: Dict[str, Callable[[float, float], float]] = {}
+        self.histograms: Dict[str, Dict[Labels, List[float]]] = {}  # bucket counts..., sum, count
+        self.buckets: Dict[str, Tuple[float, ...]] = {}
+        self.collectors: List[Callable[['Registry'], None]] = []
+
+    def counter(self, name: str, doc: str):
+        self.help[name] = ('counter', doc)
+        self.counters[name] = {}
+
+    def gauge(self, name: str, doc: str, merge: str = 'sum'):
+        """
+        :param merge: how values of workers are merged: 'sum' for amounts (connections, requests),
+         'max' or 'min' for state every worker observes on its own (replica lag, health)
+        """
+        self.help[name] = ('gauge', doc)
+        self.gauges[name] = {}
+        self.gauge_merge[name] = GAUGE_MERGES[merge]
+
+    def histogram(self, name: str, doc: str, buckets: Tuple[float, ...]):
+        self.help[name] = ('histogram', doc)
+        self.histograms[name] = {}
+        self.buckets[name] = buckets
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1):
+        with self._lock:
+            series = self.counters[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def add(self, name: str, labels: Labels = (), value: float = 1):
+        with self._lock:
+            series = self.gauges[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name: str, labels: Labels, value: float):
+        with self._lock:
+            self.gauges[name][labels] = value
+
+    def observe(self, name: str, labels: Labels, value: float):
+        buckets = self.buckets[name]
+        index = bisect_left(buckets, value)
+        with self._lock:
+            series = self.histograms[name].get(labels)
+            if series is None:
+                series = self.histograms[name][labels] = [0] * (len(buckets) + 3)
+            series[index] += 1  # non-cumulative here, cumulated on render
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        for collect in self.collectors:
+            collect(self)
+        with self._lock:
+            return {
+                'counters': {name: [[list(k), v] for k, v in s.items()] for name, s in self.counters.items()},
+                'gauges': {name: [[list(k), v] for k, v in s.items()] for name, s in self.gauges.items()},
+                'histograms': {name: [[list(k), list(v)] for k, v in s.items()] for name, s in self.histograms.items()},
+            }
+
+
+registry = Registry()
+registry.counter('http_requests_total', 'Requests by route, method and status')
+registry.histogram('http_request_duration_seconds', 'Request latency by route and method', LATENCY_BUCKETS)
+registry.gauge('http_requests_in_flight', 'Requests being processed')
+registry.histogram('http_request_db_queries', 'SQL statements per request by route', QUERY_BUCKETS)
+registry.gauge('db_pool_checked_out', 'Connections checked out of pool')
+registry.gauge('db_pool_overflow', 'Connections over pool_size (negative - not yet opened part of pool)')
+registry.gauge('db_pool_size', 'pool_size of engine')
+registry.histogram('db_pool_checkout_wait_seconds', 'Time waiting for connection from pool', WAIT_BUCKETS)
+registry.histogram('db_pool_hold_seconds', 'Time connection stays checked out', LATENCY_BUCKETS)
+registry.counter('db_pool_exhausted_total', 'Checkouts that found no free connection and had to wait')
+registry.counter('db_pool_timeouts_total', 'Checkouts failed after pool_timeout')
+# every worker checks replicas itself: sum of 0/1 flags or of lags means nothing.
+# Replica is healthy if no worker sees it otherwise, lag is the worst seen
+registry.gauge('db_replica_healthy', '1 if replica is reachable and not behind more than REPLICA_MAX_LAG',
+               merge='min')
+registry.gauge('db_replica_lag_seconds', 'Replication lag of replica, -1 if unknown', merge='max')
+registry.counter('db_replica_fallbacks_total', 'Read sessions sent to primary because no replica was available')
+
+
+def merge_snapshots(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Dict[Labels, Any]]:
+    """Merge series of several workers: sum counters and histograms, gauges by their merge function"""
+    merged: Dict[str, Dict[Labels, Any]] = {}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges', 'histograms'):
+            for name, series in snapshot.get(kind, {}).items():
+                target = merged.setdefault(name, {})
+                merge = registry.gauge_merge.get(name, GAUGE_MERGES['sum'])
+                for labels, value in series:
+                    key = tuple(tuple(pair) for pair in labels)
+                    current = target.get(key)
+                    if current is None:
+                        target[key] = list(value) if kind == 'histograms' else value
+                    elif kind == 'histograms':
+                        target[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        target[key] = merge(current, value) if kind == 'gauges' else current + value
+    return merged
+
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (f'{k}="{_escape(str(v))}"' for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(merged: Dict[str, Dict[Labels, Any]]) -> str:
+    lines = []
+    for name, (kind, doc) in registry.help.items():
+        lines.append(f'# HELP {name} {doc}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(merged.get(name, {}).items()):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(registry.buckets[name] + (float('inf'),), value):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter:
+    """Dumps registry of this worker to METRICS_DIR/<pid>.json, started lazily after fork"""
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self._pid: Optional[int] = None
+
+    def ensure_started(self):
+        if not self.directory or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, name='metrics-snapshot', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def write(self):
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def read_others(self) -> List[Dict[str, Any]]:
+        snapshots = []
+        for name in os.listdir(self.directory):
+            pid, extension = os.path.splitext(name)
+            if extension != '.json' or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not _is_alive(int(pid)):
+                _remove(os.path.join(self.directory, name))
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+snapshot_writer = SnapshotWriter(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: route label is the path template of matched route, not raw URL"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_paths: Dict[Any, str] = {}
+
+    def _route_path(self, scope: Scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return '<unmatched>'
+        path = self._route_paths.get(endpoint)
+        if path is None:
+            self._route_paths.update(_endpoint_paths(scope['app'].routes))
+            path = self._route_paths.setdefault(endpoint, '<unknown>')
+        return path
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        snapshot_writer.ensure_started()
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500
+        started_at = time.perf_counter()
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        registry.add('http_requests_in_flight')
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            registry.add('http_requests_in_flight', value=-1)
+            current_request_stats.reset(token)
+            route = (('method', scope['method']), ('route', self._route_path(scope)))
+            registry.inc('http_requests_total', route + (('status', str(status_code)),))
+            registry.observe('http_request_duration_seconds', route, elapsed)
+            registry.observe('http_request_db_queries', route[1:], stats.queries)
+
+
+def _endpoint_paths(routes: Iterable[Any], prefix: str = '') -> Dict[Any, str]:
+    paths = {}
+    for route in routes:
+        if isinstance(route, Mount):
+            paths.update(_endpoint_paths(route.routes, prefix + route.path))
+        elif getattr(route, 'endpoint', None) is not None:
+            paths[route.endpoint] = prefix + route.path
+    return paths
+
+
+METRICS_NETWORKS = [ipaddress.ip_network(network.strip())
+                    for network in settings.METRICS_ALLOWED_NETWORKS.split(',') if network.strip()]
+
+
+def metrics_allowed(request: Request) -> bool:
+    """Client is in METRICS_ALLOWED_NETWORKS or sent METRICS_TOKEN"""
+    if settings.METRICS_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and secrets.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+            return True
+    if request.client is None:
+        return False
+    try:
+        address = ipaddress.ip_address(request.client.host)
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_NETWORKS)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    if not metrics_allowed(request):
+        return PlainTextResponse('Forbidden', status_code=status.HTTP_403_FORBIDDEN)
+    snapshots = [registry.snapshot()]
+    if snapshot_writer.directory:
+        snapshots.extend(snapshot_writer.read_others())
+    return Response(render(merge_snapshots(snapshots)), media_type='text/plain; version=0.0.4')
+
+
+class TimedPoolMixin:
+    """Measures how long checkout waits for a free connection, counts exhausted pool and timeouts"""
+    metrics_label = 'sync'
+
+    def _do_get(self):
+        labels = (('engine', self.metrics_label),)
+        if self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow:
+            registry.inc('db_pool_exhausted_total', labels)
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            registry.inc('db_pool_timeouts_total', labels)
+            logger.warning('%s pool is exhausted: %s connections checked out for %.1f s',
+                           self.metrics_label, self.checkedout(), self._timeout)
+            raise
+        finally:
+            registry.observe('db_pool_checkout_wait_seconds', labels, time.perf_counter() - started_at)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    metrics_label = 'sync'
+
+
+class TimedAsyncQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    metrics_label = 'async'
+
+
+def instrument_engine(engine: Engine, label: str):
+    """
+    Pool gauges are read at scrape time, hold time is measured from checkout to checkin,
+    statements are counted into current request.
+
+    :param engine: sync engine (async_engine.sync_engine for AsyncEngine)
+    :param label: value of 'engine' label
+    """
+    def collect(target: Registry):
+        pool = engine.pool  # replaced on dispose()
+        if not isinstance(pool, QueuePool):
+            return
+        labels = (('engine', label),)
+        target.set('db_pool_checked_out', labels, pool.checkedout())
+        target.set('db_pool_overflow', labels, pool.overflow())
+        target.set('db_pool_size', labels, pool.size())
+
+    registry.collectors.append(collect)
+    if isinstance(engine.pool, TimedPoolMixin):
+        engine.pool.metrics_label = label
+
+    @event.listens_for(engine, 'checkout')
+    def start_hold(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checked_out_at'] = time.perf_counter()
+
+    @event.listens_for(engine, 'checkin')
+    def end_hold(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('checked_out_at', None)
+        if checked_out_at is not None:
+            registry.observe('db_pool_hold_seconds', (('engine', label),), time.perf_counter() - checked_out_at)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.queries += 1
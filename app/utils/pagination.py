@@ -0,0 +1,33 @@
+import base64
+import binascii
+import json
+from typing import Any, List, Tuple
+
+from fastapi import HTTPException
+from starlette import status
+
+CURSOR_DIRECTIONS = ('next', 'prev')
+
+
+def encode_cursor(direction: str, key: List[Any]) -> str:
+    """
+    Упаковывает направление и ключ последней/первой записи страницы в непрозрачную строку.
+
+    :param direction: 'next' или 'prev'
+    :param key: значения колонки сортировки и id записи
+    """
+    raw = json.dumps({'d': direction, 'k': key}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, List[Any]]:
+    """throw 400 if cursor was corrupted, else return (direction, key)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        direction, key = payload['d'], payload['k']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(detail="Invalid cursor", status_code=status.HTTP_400_BAD_REQUEST)
+    if direction not in CURSOR_DIRECTIONS or not isinstance(key, list) or len(key) != 2:
+        raise HTTPException(detail="Invalid cursor", status_code=status.HTTP_400_BAD_REQUEST)
+    return direction, key
@@ -0,0 +1,54 @@
+from typing import Dict, Iterable, List, Tuple
+
+from fastapi import HTTPException
+from starlette import status
+
+from app.conf.permission_settings import PERMISSION_X_ROLE, Permissions
+
+
+class PermissionRegistry:
+    """
+    Gives each permission a stable bit (its position in Permissions, so new permissions must be
+    appended to the end of enum) and keeps precomputed role -> bitmask table.
+    Permission set is one int: check is one AND, token claim is a couple of bytes instead of list of names.
+    """
+
+    def __init__(self, permissions: Iterable[str], permission_x_role: Dict[str, Tuple[str, ...]]):
+        self.bits: Dict[str, int] = {name: 1 << i for i, name in enumerate(permissions)}
+        self.role_masks: Dict[str, int] = {
+            role: self.mask(role_permissions) for role, role_permissions in permission_x_role.items()
+        }
+
+    def mask(self, permissions: str | Iterable[str], strict: bool = False) -> int:
+        """
+        Bitmask of permissions
+
+        :param permissions: permission name or iterable of names
+        :param strict: raise ValueError on unknown name (use for required permissions),
+         else unknown names are ignored
+        """
+        if isinstance(permissions, str):
+            permissions = (permissions,)
+        mask = 0
+        for name in permissions:
+            if strict and name not in self.bits:
+                raise ValueError(f"Unknown permission '{name}'")
+            mask |= self.bits.get(name, 0)
+        return mask
+
+    def names(self, mask: int) -> List[str]:
+        return [name for name, bit in self.bits.items() if mask & bit]
+
+    @staticmethod
+    def has(mask: int, required_mask: int) -> bool:
+        return mask & required_mask == required_mask
+
+
+permission_registry = PermissionRegistry([p.value for p in Permissions], PERMISSION_X_ROLE)
+
+
+def check_for_permission_mask(required_mask: int, mask: int):
+    """throw error if even one required bit is not set in mask"""
+    if mask & required_mask != required_mask:
+        raise HTTPException(detail="Method not allowed!",
+                            status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -0,0 +1,19 @@
+"""
+pytest fixtures of the app, enable with `pytest -p app.utils.pytest_plugin`
+or `pytest_plugins = ['app.utils.pytest_plugin']` in conftest.py
+"""
+import pytest
+
+from app.utils.query_budget import capture_queries
+
+
+@pytest.fixture
+def assert_max_queries():
+    """
+    Fails the test if the block runs more SQL statements than allowed, message lists repeated ones:
+
+        def test_me(client, assert_max_queries):
+            with assert_max_queries(3):
+                client.get('/api/v1/me')
+    """
+    return capture_queries
@@ -0,0 +1,202 @@
+"""
+Per-request SQL budget and N+1 detector.
+
+Cursor events of instrumented engines feed QueryTracker of the current request: count, DB time,
+statements grouped by normalised SQL (literals and IN-lists removed, so N+1 lazy loads fall into
+one group). QUERY_BUDGET_MODE 'log' logs requests over budget, 'raise' fails the statement that
+exceeds it, 'off' disables the middleware. Statements slower than SLOW_QUERY_SECONDS are kept
+with their EXPLAIN plan.
+"""
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.conf.settings import settings
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERALS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'%\(\w+\)s|\$\d+|:\w+|\?')
+_IN_LISTS = re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.IGNORECASE)
+_VALUES_LISTS = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+_SPACES = re.compile(r'\s+')
+
+
+def normalise_sql(statement: str) -> str:
+    """SELECT ... WHERE id = 5 and WHERE id = %(id_1)s -> WHERE id = ?"""
+    statement = _STRING_LITERALS.sub('?', statement)
+    statement = _PLACEHOLDERS.sub('?', statement)
+    statement = _NUMBERS.sub('?', statement)
+    statement = _IN_LISTS.sub('IN (...)', statement)
+    statement = _VALUES_LISTS.sub(r'\1, ...', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class SlowQuery:
+    __slots__ = ('statement', 'parameters', 'seconds', 'plan')
+
+    def __init__(self, statement: str, parameters: Any, seconds: float, plan: Optional[str]):
+        self.statement = statement
+        self.parameters = parameters
+        self.seconds = seconds
+        self.plan = plan
+
+
+class QueryTracker:
+    def __init__(self, budget: Optional[int] = None, raise_on_exceed: bool = False):
+        """
+        :param budget: max statements, None - unlimited
+        :param raise_on_exceed: raise QueryBudgetExceeded from the statement over budget
+        """
+        self.budget = budget
+        self.raise_on_exceed = raise_on_exceed
+        self.count = 0
+        self.seconds = 0.0
+        self.groups: Dict[str, List[float]] = {}  # normalised sql -> [count, seconds]
+        self.slow: List[SlowQuery] = []
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.count > self.budget
+
+    def record(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        group = self.groups.setdefault(normalise_sql(statement), [0, 0.0])
+        group[0] += 1
+        group[1] += seconds
+        if self.raise_on_exceed and self.budget is not None and self.count == self.budget + 1:
+            raise QueryBudgetExceeded(self.describe())
+
+    def repeated(self, threshold: int = 2) -> List[Tuple[str, int, float]]:
+        """Groups executed at least threshold times, most frequent first: likely N+1"""
+        return sorted(
+            ((sql, int(count), seconds) for sql, (count, seconds) in self.groups.items() if count >= threshold),
+            key=lambda group: -group[1],
+        )
+
+    def describe(self) -> str:
+        lines = [f'{self.count} statements (budget {self.budget}), {self.seconds * 1000:.1f} ms in DB']
+        for sql, count, seconds in self.repeated(settings.QUERY_REPEAT_THRESHOLD)[:5]:
+            lines.append(f'  {count}x {seconds * 1000:.1f} ms: {sql[:300]}')
+        for slow in self.slow:
+            lines.append(f'  slow {slow.seconds * 1000:.1f} ms: {slow.statement[:300]}')
+            if slow.plan:
+                lines.append('    ' + slow.plan.replace('\n', '\n    '))
+        return '\n'.join(lines)
+
+
+current_tracker: ContextVar[Optional[QueryTracker]] = ContextVar('current_query_tracker', default=None)
+# trackers of capture_queries(), see every statement of the process regardless of context
+_global_trackers: Set[QueryTracker] = set()
+
+
+def _explain(cursor: Any, statement: str, parameters: Any) -> Optional[str]:
+    try:
+        explain_cursor = cursor.connection.cursor()
+        explain_cursor.execute('EXPLAIN ' + statement, parameters)
+        plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+        explain_cursor.close()
+        return plan
+    except Exception as e:  # plan is best effort, statement itself has succeeded
+        return f'EXPLAIN failed: {e}'
+
+
+def instrument_queries(engine: Engine):
+    """:param engine: sync engine (async_engine.sync_engine for AsyncEngine)"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_started_at'].pop()
+        tracker = current_tracker.get()
+        if tracker is None and not _global_trackers:
+            return
+        slow = None
+        if seconds >= settings.SLOW_QUERY_SECONDS:
+            plan = None
+            if settings.SLOW_QUERY_EXPLAIN and not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+                plan = _explain(cursor, statement, parameters)
+            slow = SlowQuery(statement, parameters, seconds, plan)
+            logger.warning('Slow statement %.1f ms: %s\n%s', seconds * 1000, statement, plan or '')
+        for target in ([tracker] if tracker is not None else []) + list(_global_trackers):
+            if slow is not None:
+                target.slow.append(slow)
+            target.record(statement, seconds)
+
+    @event.listens_for(engine, 'handle_error')
+    def drop_timer(exception_context):
+        started_at = exception_context.connection.info.get('query_started_at') \
+            if exception_context.connection is not None else None
+        if started_at:
+            started_at.pop()
+
+
+@contextmanager
+def capture_queries(budget: Optional[int] = None) -> Iterator[QueryTracker]:
+    """
+    Count statements of all instrumented engines inside the block, e.g. in tests where the app runs
+    in another thread. Fails on exit if budget is exceeded.
+    """
+    tracker = QueryTracker(budget)
+    _global_trackers.add(tracker)
+    try:
+        yield tracker
+    finally:
+        _global_trackers.discard(tracker)
+    if tracker.over_budget:
+        raise QueryBudgetExceeded(tracker.describe())
+
+
+def query_budget(budget: int):
+    """
+    Dependency overriding QUERY_BUDGET for one route:
+
+        @router.get('/me', dependencies=[Depends(query_budget(3))])
+    """
+
+    async def set_budget():
+        tracker = current_tracker.get()
+        if tracker is not None:
+            tracker.budget = budget
+    return set_budget
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, app: ASGIApp, budget: int = settings.QUERY_BUDGET, mode: str = settings.QUERY_BUDGET_MODE):
+        """
+        :param budget: statements per request
+        :param mode: 'log' or 'raise'
+        """
+        self.app = app
+        self.budget = budget
+        self.mode = mode
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        tracker = QueryTracker(self.budget, raise_on_exceed=self.mode == 'raise')
+        token = current_tracker.set(tracker)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_tracker.reset(token)
+            repeated = tracker.repeated(settings.QUERY_REPEAT_THRESHOLD)
+            if tracker.over_budget or repeated:
+                logger.warning('%s %s: %s', scope['method'], scope['path'], tracker.describe())
@@ -0,0 +1,201 @@
+"""
+Token buckets: capacity tokens at most, refilled at rate tokens per second, every attempt takes one.
+
+MemoryBucketStore keeps buckets of one worker, RedisBucketStore shares them between workers and
+servers (one Lua script call per bucket). Any object with async take() can be used instead, e.g. a
+memory store in tests.
+
+LoginThrottleMiddleware checks /login attempts before admission control, so rejected ones neither
+wait in auth-cpu queue nor take its slots.
+"""
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.conf.settings import settings
+from app.utils.cache import TTLLRUCache
+from app.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBucketStore:
+    def __init__(self, max_keys: int = 100000):
+        """:param max_keys: least recently used buckets over this number are forgotten (so become full)"""
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()  # key -> tokens, updated_at
+
+    async def take(self, key: str, capacity: float, rate: float, now: Optional[float] = None) -> float:
+        """:return: 0 if token is taken, else seconds until the next one"""
+        now = time.monotonic() if now is None else now
+        tokens, updated_at = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+# KEYS[1] bucket; ARGV capacity, rate, now. Bucket expires when it would be full again anyway
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated_at, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBucketStore:
+    def __init__(self, client: Any = None, prefix: str = 'bucket:'):
+        """
+        :param client: redis.asyncio.Redis or compatible fake, by default created on first use
+         from REDIS_HOST/REDIS_PORT (after fork, so every worker has its own connections)
+        :param prefix: prefix of bucket keys
+        """
+        self._client = client
+        self._script = None
+        self.prefix = prefix
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            import redis.asyncio
+
+            self._client = redis.asyncio.Redis(host=settings.REDIS_HOST, port=int(settings.REDIS_PORT),
+                                               socket_timeout=0.1, socket_connect_timeout=0.1)
+        return self._client
+
+    async def take(self, key: str, capacity: float, rate: float, now: Optional[float] = None) -> float:
+        if self._script is None:
+            self._script = self.client.register_script(TAKE_SCRIPT)
+        # wall clock: buckets are shared between hosts
+        now = time.time() if now is None else now
+        wait = await self._script(keys=[self.prefix + key], args=[capacity, rate, now])
+        return float(wait)
+
+
+def make_bucket_store(backend: str) -> Any:
+    if backend == 'memory':
+        return MemoryBucketStore()
+    if backend == 'redis':
+        return RedisBucketStore(prefix='login:')
+    raise ValueError(f"Unknown bucket store backend '{backend}'")
+
+
+class LoginThrottle:
+    """
+    Per-IP and per-account buckets checked before password is verified. Key rejected by the store is
+    remembered in process until its next token, so repeated attempts don't even reach the store
+    """
+
+    def __init__(self, store: Any, ip_burst: int, ip_per_minute: float,
+                 account_burst: int, account_per_minute: float):
+        """
+        :param store: MemoryBucketStore, RedisBucketStore or compatible
+        :param ip_burst: attempts from one IP in a row
+        :param ip_per_minute: attempts per minute from one IP after the burst
+        :param account_burst: attempts for one account in a row, from any IPs
+        :param account_per_minute: attempts per minute for one account after the burst
+        """
+        self.store = store
+        self.ip_limit = (ip_burst, ip_per_minute / 60)
+        self.account_limit = (account_burst, account_per_minute / 60)
+        self.blocked = TTLLRUCache(maxsize=10000)  # key -> monotonic time of the next token
+
+    async def check(self, ip: Optional[str], username: str) -> Tuple[Optional[str], float]:
+        """
+        :return: (None, 0) if attempt is allowed, else ('ip' or 'account', seconds to wait).
+         Store errors let the attempt through: login must not depend on Redis
+        """
+        account = hashlib.blake2b(username.strip().lower().encode(), digest_size=16).hexdigest()
+        for scope, key, (capacity, rate) in (('ip', f'ip:{ip}', self.ip_limit),
+                                             ('account', f'account:{account}', self.account_limit)):
+            blocked_until = self.blocked.get(key)
+            if blocked_until is not None:
+                return scope, blocked_until - time.monotonic()
+            try:
+                wait = await self.store.take(key, capacity, rate)
+            except Exception as e:
+                logger.warning('Login throttle store failed, attempt is allowed: %s', e)
+                return None, 0.0
+            if wait > 0:
+                self.blocked.set(key, time.monotonic() + wait, ttl=wait)
+                return scope, wait
+        return None, 0.0
+
+
+login_throttle: Optional[LoginThrottle] = None if settings.LOGIN_THROTTLE_BACKEND == 'off' else LoginThrottle(
+    make_bucket_store(settings.LOGIN_THROTTLE_BACKEND),
+    ip_burst=settings.LOGIN_IP_BURST,
+    ip_per_minute=settings.LOGIN_IP_PER_MINUTE,
+    account_burst=settings.LOGIN_ACCOUNT_BURST,
+    account_per_minute=settings.LOGIN_ACCOUNT_PER_MINUTE,
+)
+registry.counter('login_throttled_total', 'Login attempts rejected before password check, by ip or account')
+
+
+class LoginThrottleMiddleware:
+    def __init__(self, app: ASGIApp, throttle: Optional[LoginThrottle] = None, path: Optional[str] = None):
+        """
+        :param throttle: login_throttle by default
+        :param path: login route, API_V1_STR/login by default
+        """
+        self.app = app
+        self.throttle = throttle or login_throttle
+        self.path = path or settings.API_V1_STR + '/login'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if self.throttle is None or scope['type'] != 'http' or scope['path'] != self.path \
+                or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+
+        # login form is small: read it here and give the same body to the route
+        request = Request(scope, receive)
+        body = await request.body()
+        form = await request.form()
+        scope_name, wait = await self.throttle.check(request.client.host if request.client else None,
+                                                     str(form.get('username', '')))
+        if scope_name is not None:
+            registry.inc('login_throttled_total', (('scope', scope_name),))
+            response = JSONResponse({'detail': 'Too many login attempts, try again later'},
+                                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                    headers={'Retry-After': str(max(1, math.ceil(wait)))})
+            await response(scope, receive, send)
+            return
+
+        body_sent = False
+
+        async def replay() -> Message:
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        await self.app(scope, replay, send)
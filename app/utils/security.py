@@ -1,12 +1,103 @@
-from typing import List, Optional, Tuple
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from fastapi import HTTPException
 from passlib.context import CryptContext
 from starlette import status
+from starlette.concurrency import run_in_threadpool
+
+from app.conf.settings import settings
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
+class PasswordHasherPool:
+	"""
+	Bounded thread pool for bcrypt (releases GIL), keeps ~100-300ms of CPU per hash off the event loop.
+	If more than max_workers + max_queue jobs are pending, new ones are rejected with 503 at once.
+	"""
+	
+	def __init__(self, max_workers: int, max_queue: int):
+		self.max_workers = max_workers
+		self.max_pending = max_workers + max_queue
+		self._executor: Optional[ThreadPoolExecutor] = None
+		self._lock = threading.Lock()
+		self.pending = 0
+		self.completed = 0
+		self.rejected = 0
+		self.wait_time_total = 0.0
+		self.wait_time_max = 0.0
+	
+	@property
+	def executor(self) -> ThreadPoolExecutor:
+		# created lazily: must not be inherited by forked workers
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+												thread_name_prefix='password-hasher')
+		return self._executor
+	
+	async def run(self, func: Callable, *args: Any) -> Any:
+		if self.pending >= self.max_pending:
+			self.rejected += 1
+			raise HTTPException(detail="Server is busy, try again later",
+								status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+								headers={'Retry-After': '1'})
+		with self._lock:
+			self.pending += 1
+		enqueued_at = time.perf_counter()
+		
+		def job():
+			waited = time.perf_counter() - enqueued_at
+			with self._lock:
+				self.wait_time_total += waited
+				self.wait_time_max = max(self.wait_time_max, waited)
+			return func(*args)
+		
+		try:
+			return await asyncio.get_running_loop().run_in_executor(self.executor, job)
+		finally:
+			with self._lock:
+				self.pending -= 1
+				self.completed += 1
+	
+	def map(self, func: Callable, items: List[Any]) -> List[Any]:
+		"""
+		Blocking map for sync code (threadpool routes): items go to the pool max_workers at a time,
+		so jobs of async callers wait for one window, not for the whole list
+		"""
+		results = []
+		for start in range(0, len(items), self.max_workers):
+			window = items[start:start + self.max_workers]
+			with self._lock:
+				self.pending += len(window)
+			try:
+				results.extend(self.executor.map(func, window))
+			finally:
+				with self._lock:
+					self.pending -= len(window)
+					self.completed += len(window)
+		return results
+	
+	def stats(self) -> Dict[str, Any]:
+		return {
+			'max_workers': self.max_workers,
+			'max_pending': self.max_pending,
+			'pending': self.pending,
+			'queued': max(self.pending - self.max_workers, 0),
+			'completed': self.completed,
+			'rejected': self.rejected,
+			'wait_time_avg': self.wait_time_total / self.completed if self.completed else 0.0,
+			'wait_time_max': self.wait_time_max,
+		}
+
+
+password_hasher = PasswordHasherPool(max_workers=settings.PASSWORD_HASH_WORKERS,
+									 max_queue=settings.PASSWORD_HASH_QUEUE_SIZE)
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
 	return pwd_context.verify(plain_password, hashed_password)
 
@@ -17,6 +108,49 @@ def get_password_hash(password: str or None) -> Optional[str]:
 	return pwd_context.hash(password)
 
 
+class PermissionVersionCache:
+	"""
+	In-process copy of {role name: permissions version}, reloaded not often than once per ttl seconds.
+	Token permission claims are trusted only while their version equals the cached one.
+	"""
+	
+	def __init__(self, loader: Callable[[], Dict[str, int]], ttl: float):
+		self.loader = loader
+		self.ttl = ttl
+		self._versions: Dict[str, int] = {}
+		self._loaded_at: Optional[float] = None
+	
+	async def get(self, role: str) -> Optional[int]:
+		now = time.monotonic()
+		if self._loaded_at is None or now - self._loaded_at > self.ttl:
+			# concurrent requests keep using old copy while one of them reloads it
+			self._loaded_at = now
+			try:
+				self._versions = await run_in_threadpool(self.loader)
+			except Exception:
+				self._loaded_at = None
+				raise
+		return self._versions.get(role)
+	
+	async def is_actual(self, role: Optional[str], version: Optional[int]) -> bool:
+		if role is None or version is None:
+			return False
+		return await self.get(role) == version
+	
+	def invalidate(self):
+		self._loaded_at = None
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+	return await password_hasher.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str or None) -> Optional[str]:
+	if password is None:
+		return None
+	return await password_hasher.run(get_password_hash, password)
+
+
 def check_for_permission(required_rights: str | Tuple, permissions: List[str]):
 	"""throw error if even one right not included in required permissions """
 	if isinstance(required_rights, str):
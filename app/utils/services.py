@@ -1,13 +1,47 @@
-from typing import Any, List, Optional, Type
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type
 
 from fastapi import Request
 from pydantic import BaseModel
-from user_agents import parse
 
 from app import models
+from app.conf.settings import settings
+from app.utils.metrics import Registry, registry
 
 
-def user_agent_parser(user_agent: str, request: Request):
+@lru_cache(maxsize=settings.USER_AGENT_CACHE_SIZE)
+def parse_user_agent(user_agent: str) -> Tuple[str, str, str, str, str]:
+    """
+    (browser, browser version, device, os, os version) of raw User-Agent.
+    Clients send a few distinct strings over and over, so results are kept in LRU cache;
+    user_agents with its regex set is imported on the first miss instead of app start.
+    """
+    from user_agents import parse
+
+    user_agent_data = parse(user_agent)
+    return (user_agent_data.browser[0], user_agent_data.browser[2], user_agent_data.device[0],
+            user_agent_data.os[0], user_agent_data.os[2])
+
+
+def user_agent_cache_stats() -> Dict[str, int]:
+    info = parse_user_agent.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
+
+
+def _collect_user_agent_cache(target: Registry):
+    stats = user_agent_cache_stats()
+    target.set('user_agent_cache_hits', (), stats['hits'])
+    target.set('user_agent_cache_misses', (), stats['misses'])
+    target.set('user_agent_cache_size', (), stats['size'])
+
+
+registry.gauge('user_agent_cache_hits', 'Hits of parsed User-Agent cache')
+registry.gauge('user_agent_cache_misses', 'Misses of parsed User-Agent cache')
+registry.gauge('user_agent_cache_size', 'Entries in parsed User-Agent cache')
+registry.collectors.append(_collect_user_agent_cache)
+
+
+def user_agent_parser(user_agent: Optional[str], request: Request):
     """
     Вспомогательная функция для получения устройства, ос пользователя и ip.
     
@@ -17,11 +51,10 @@ def user_agent_parser(user_agent: str, request: Request):
     ip_address = request.scope.get('root_path')
     agent_from_user = f'{request.headers.get("Agent", "")}/ '
     platform_from_user = f'{request.headers.get("platform", "")}/ '
-    user_agent_data = parse(user_agent)
-    agent = (f'{agent_from_user}{user_agent_data.browser[0]}'
-             f'{user_agent_data.browser[2]}')
-    platform = (f'{platform_from_user}{user_agent_data.device[0]}',
-                f' {user_agent_data.os[0]}{user_agent_data.os[2]}')
+    browser, browser_version, device, os, os_version = parse_user_agent(user_agent or '')
+    agent = f'{agent_from_user}{browser}{browser_version}'
+    platform = (f'{platform_from_user}{device}',
+                f' {os}{os_version}')
     return agent, platform, ip_address
 
 
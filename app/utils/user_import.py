@@ -0,0 +1,339 @@
+"""
+Потоковый импорт пользователей из CSV/JSONL.
+
+Файл читается построчно, строки валидируются схемой UserCreate, пароли хешируются в пуле процессов
+(хеши следующей пачки считаются, пока текущая пишется в базу), пользователи и их роли пишутся
+пачками INSERT ... ON CONFLICT ... RETURNING. В памяти одновременно не больше двух пачек.
+
+    python -m app.utils.user_import users.csv --errors errors.csv
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from typing import Any, BinaryIO, Callable, Collection, ContextManager, Dict, Iterator, List, Optional, TextIO, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.conf.db.session import SessionLocal
+from app.conf.permission_settings import Roles
+from app.conf.settings import settings
+from app.schemas import UserCreate
+from app.utils.security import get_password_hash
+
+SUPPORTED_FORMATS = ('csv', 'jsonl')
+DEFAULT_ROLE = Roles.USER.value
+REPORT_HEADER = ('line', 'email', 'status', 'detail')
+
+
+def detect_format(filename: Optional[str]) -> str:
+    extension = os.path.splitext(filename or '')[1].lstrip('.').lower()
+    if extension == 'ndjson':
+        extension = 'jsonl'
+    if extension not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unsupported file format '{extension}', expected one of {SUPPORTED_FORMATS}")
+    return extension
+
+
+def iter_records(stream: BinaryIO, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """
+    Генератор (номер строки, dict) по бинарному потоку, без чтения файла целиком.
+    Для нераспарсившейся строки вместо dict отдается исключение.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, {key: value for key, value in record.items() if value not in ('', None)}
+    else:
+        for line_number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, e
+
+
+class ImportProgress:
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = 'running'
+        self.processed = 0
+        self.created = 0
+        self.skipped = 0
+        self.errors = 0
+        self.started_at = datetime.now()
+        self.finished_at: Optional[datetime] = None
+        self.detail: Optional[str] = None
+
+    @property
+    def rows_per_sec(self) -> float:
+        elapsed = ((self.finished_at or datetime.now()) - self.started_at).total_seconds()
+        return round(self.processed / elapsed, 1) if elapsed else 0.0
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'processed': self.processed,
+            'created': self.created,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'rows_per_sec': self.rows_per_sec,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'detail': self.detail,
+        }
+
+
+class UserImporter:
+    def __init__(
+            self,
+            error_report: TextIO,
+            *,
+            job_id: Optional[str] = None,
+            processes: int = settings.USER_IMPORT_PROCESSES,
+            batch_size: int = settings.USER_IMPORT_BATCH_SIZE,
+            session_factory: Callable[[], Session] = SessionLocal,
+            on_progress: Optional[Callable[[ImportProgress], None]] = None,
+            allowed_roles: Optional[Collection[str]] = None,
+    ):
+        """
+        :param error_report: text file for per-row report (rejected and skipped rows)
+        :param processes: size of process pool for bcrypt
+        :param batch_size: rows per INSERT and per commit
+        :param on_progress: called after every committed batch
+        :param allowed_roles: roles rows may have, other rows are rejected; None - any existing role
+        """
+        self.report = csv.writer(error_report)
+        self.report.writerow(REPORT_HEADER)
+        self.progress = ImportProgress(job_id or uuid.uuid4().hex)
+        self.processes = processes
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self.on_progress = on_progress
+        self.allowed_roles = allowed_roles
+        self.role_ids: Dict[str, int] = {}
+
+    def run(self, stream: BinaryIO, fmt: str) -> ImportProgress:
+        with self.session_factory() as db, \
+                ProcessPoolExecutor(max_workers=self.processes, mp_context=get_context('spawn')) as executor:
+            self.role_ids = crud.role.get_ids_by_name(db)
+            pending = None
+            for batch in self._batches(iter_records(stream, fmt)):
+                # hashes of this batch are computed while previous one is inserted
+                passwords = [user_in.password for _, user_in, _ in batch]
+                chunksize = max(1, len(passwords) // (self.processes * 4))
+                hashes = executor.map(get_password_hash, passwords, chunksize=chunksize)
+                if pending:
+                    self._insert_batch(db, *pending)
+                pending = (batch, hashes)
+            if pending:
+                self._insert_batch(db, *pending)
+
+        self.progress.status = 'finished'
+        self.progress.finished_at = datetime.now()
+        self._notify()
+        return self.progress
+
+    def _batches(self, records: Iterator[Tuple[int, Any]]) -> Iterator[List[Tuple[int, UserCreate, str]]]:
+        batch = []
+        for line, record in records:
+            self.progress.processed += 1
+            user_in, role = self._validate(line, record)
+            if user_in is None:
+                continue
+            batch.append((line, user_in, role))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _validate(self, line: int, record: Any) -> Tuple[Optional[UserCreate], Optional[str]]:
+        if isinstance(record, Exception):
+            self._reject(line, None, f'Invalid row: {record}')
+            return None, None
+        if not isinstance(record, dict):
+            self._reject(line, None, 'Invalid row: object expected')
+            return None, None
+        try:
+            user_in = UserCreate(**record)
+        except ValidationError as e:
+            errors = '; '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+            self._reject(line, record.get('email'), errors)
+            return None, None
+        role = user_in.role or DEFAULT_ROLE
+        if role not in self.role_ids:
+            self._reject(line, user_in.email, f"Unknown role '{role}'")
+            return None, None
+        if self.allowed_roles is not None and role not in self.allowed_roles:
+            self._reject(line, user_in.email, f"Not allowed to create users with role '{role}'")
+            return None, None
+        return user_in, role
+
+    def _insert_batch(self, db: Session, batch: List[Tuple[int, UserCreate, str]], hashes: Iterator[str]):
+        now = datetime.now()
+        rows = [{
+            'email': user_in.email,
+            'hashed_password': hashed_password,
+            'name': user_in.name,
+            'last_name': user_in.last_name,
+            'username': user_in.username,
+            'created_at': now,
+            'last_login_at': now,
+        } for (_, user_in, _), hashed_password in zip(batch, hashes)]
+
+        try:
+            with db.begin_nested():
+                outcomes = self._insert_rows(db, batch, rows)
+        except DBAPIError:
+            # some row breaks a constraint other than email uniqueness, find it row by row
+            outcomes = []
+            for item, row in zip(batch, rows):
+                try:
+                    with db.begin_nested():
+                        outcomes.extend(self._insert_rows(db, [item], [row]))
+                except DBAPIError as e:
+                    outcomes.append((item, 'error', str(e.orig).strip()))
+        db.commit()
+
+        for (line, user_in, _), status, detail in outcomes:
+            if status == 'created':
+                self.progress.created += 1
+            elif status == 'skipped':
+                self.progress.skipped += 1
+                self.report.writerow((line, user_in.email, status, detail))
+            else:
+                self._reject(line, user_in.email, detail)
+        self._notify()
+
+    def _insert_rows(self, db: Session, batch: List[Tuple[int, UserCreate, str]],
+                     rows: List[Dict[str, Any]]) -> List[Tuple[Tuple[int, UserCreate, str], str, Optional[str]]]:
+        results = crud.user.create_many(db, rows, conflict_columns=('email',),
+                                        batch_size=self.batch_size, with_commit=False)
+        links = [{
+            'user_id': result.id,
+            'role_id': self.role_ids[batch[result.index][2]],
+            'updated_at': rows[result.index]['created_at'],
+        } for result in results if result.status == 'created']
+        if links:
+            crud.user_x_role.create_many(db, links, batch_size=self.batch_size, with_commit=False)
+        return [(batch[result.index], result.status, result.detail) for result in results]
+
+    def _reject(self, line: int, email: Optional[str], detail: str):
+        self.progress.errors += 1
+        self.report.writerow((line, email, 'error', detail))
+
+    def _notify(self):
+        if self.on_progress:
+            self.on_progress(self.progress)
+
+
+def job_path(job_id: str, suffix: str) -> str:
+    return os.path.join(settings.USER_IMPORT_REPORTS_DIR, f'{job_id}.{suffix}')
+
+
+def read_job_progress(job_id: str) -> Optional[Dict[str, Any]]:
+    """Progress is kept in file, so any worker on the host can answer about any job"""
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    try:
+        with open(job_path(job_id, 'json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def start_import_job(
+        upload: BinaryIO,
+        fmt: str,
+        *,
+        allowed_roles: Optional[Collection[str]] = None,
+        slot: Optional[ContextManager] = None,
+) -> Dict[str, Any]:
+    """
+    Copy upload to disk (constant memory) and run import in background thread
+
+    :param upload: binary file-like object with CSV/JSONL
+    :param fmt: 'csv' or 'jsonl'
+    :param allowed_roles: see UserImporter
+    :param slot: acquired concurrency slot, e.g. ReportSlot, exited when the job ends
+    :return: initial progress of the job
+    """
+    slot = slot or nullcontext()
+    job_id = uuid.uuid4().hex
+    source_path = job_path(job_id, fmt)
+    try:
+        os.makedirs(settings.USER_IMPORT_REPORTS_DIR, exist_ok=True)
+        with open(source_path, 'wb') as source:
+            shutil.copyfileobj(upload, source)
+    except BaseException:
+        slot.__exit__(None, None, None)
+        raise
+
+    def save_progress(progress: ImportProgress):
+        tmp_path = job_path(job_id, 'json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(progress.dict(), f)
+        os.replace(tmp_path, job_path(job_id, 'json'))
+
+    def run():
+        with slot, open(job_path(job_id, 'errors.csv'), 'w', newline='') as report, \
+                open(source_path, 'rb') as source:
+            importer = UserImporter(report, job_id=job_id, on_progress=save_progress, allowed_roles=allowed_roles)
+            try:
+                importer.run(source, fmt)
+            except Exception as e:
+                logging.exception('User import %s failed', job_id)
+                importer.progress.status = 'failed'
+                importer.progress.finished_at = datetime.now()
+                importer.progress.detail = str(e)
+                save_progress(importer.progress)
+            finally:
+                os.remove(source_path)
+
+    progress = ImportProgress(job_id)
+    save_progress(progress)
+    threading.Thread(target=run, name=f'user-import-{job_id}', daemon=True).start()
+    return progress.dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import of users from CSV/JSONL file')
+    parser.add_argument('path', help='CSV (with header) or JSONL file with UserCreate fields and optional role')
+    parser.add_argument('--format', choices=SUPPORTED_FORMATS, help='detected by extension by default')
+    parser.add_argument('--errors', default='user_import_errors.csv', help='per-row report path')
+    parser.add_argument('--processes', type=int, default=settings.USER_IMPORT_PROCESSES)
+    parser.add_argument('--batch-size', type=int, default=settings.USER_IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    def log_progress(progress: ImportProgress):
+        logging.info('processed %s, created %s, skipped %s, errors %s, %s rows/sec',
+                     progress.processed, progress.created, progress.skipped, progress.errors,
+                     progress.rows_per_sec)
+
+    with open(args.errors, 'w', newline='') as report, open(args.path, 'rb') as source:
+        importer = UserImporter(report, processes=args.processes, batch_size=args.batch_size,
+                                on_progress=log_progress)
+        importer.run(source, args.format or detect_format(args.path))
+
+
+if __name__ == '__main__':
+    main()
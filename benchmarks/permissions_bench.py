@@ -0,0 +1,55 @@
+"""
+Micro-benchmark: list-membership permission check vs bitmask check
+
+    python -m benchmarks.permissions_bench
+"""
+import json
+import timeit
+
+from fastapi import HTTPException
+
+from app.conf.permission_settings import PERMISSION_X_ROLE, Permissions, Roles
+from app.utils.permissions import check_for_permission_mask, permission_registry
+from app.utils.security import check_for_permission
+
+NUMBER = 200_000
+
+
+def bench(title: str, stmt, number: int = NUMBER):
+    seconds = timeit.timeit(stmt, number=number)
+    print(f'{title:<40} {seconds / number * 1e9:>8.0f} ns/check')
+
+
+def run():
+    required = (Permissions.EDIT_OBJECT.value, Permissions.GET_OBJECT_LIST.value)
+    granted = list(PERMISSION_X_ROLE[Roles.SUPERUSER.value])
+    denied = list(PERMISSION_X_ROLE[Roles.USER.value])
+
+    required_mask = permission_registry.mask(required, strict=True)
+    granted_mask = permission_registry.role_masks[Roles.SUPERUSER.value]
+    denied_mask = permission_registry.role_masks[Roles.USER.value]
+
+    def denied_list():
+        try:
+            check_for_permission(required, denied)
+        except HTTPException:
+            pass
+
+    def denied_bits():
+        try:
+            check_for_permission_mask(required_mask, denied_mask)
+        except HTTPException:
+            pass
+
+    bench('list, allowed', lambda: check_for_permission(required, granted))
+    bench('bitmask, allowed', lambda: check_for_permission_mask(required_mask, granted_mask))
+    bench('list, denied', denied_list)
+    bench('bitmask, denied', denied_bits)
+
+    list_claim = json.dumps({'permissions': granted})
+    mask_claim = json.dumps({'permissions_mask': granted_mask})
+    print(f'token claim size: list {len(list_claim)} bytes, bitmask {len(mask_claim)} bytes')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,32 @@
+"""
+    python -m etl catalogue.csv --checkpoint catalogue.checkpoint.json
+    python -m etl textbooks_dir/ --dry-run
+"""
+import argparse
+import json
+import logging
+
+from etl.pipeline import TextbookPipeline
+from etl.readers import READERS
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load textbooks into data.textbook')
+    parser.add_argument('source', help='CSV/JSONL file or directory of CSV/JSONL/JSON files')
+    parser.add_argument('--reader', choices=sorted(READERS), help='detected by source by default')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--checkpoint', help='checkpoint file, interrupted load resumes from it')
+    parser.add_argument('--on-existing', choices=('update', 'skip'), default='update',
+                        help='what to do with textbooks whose slug is already in DB')
+    parser.add_argument('--dry-run', action='store_true', help='compare with DB, but write nothing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    pipeline = TextbookPipeline(args.source, reader=args.reader, batch_size=args.batch_size,
+                                checkpoint_path=args.checkpoint, on_existing=args.on_existing,
+                                dry_run=args.dry_run)
+    print(json.dumps(pipeline.run(), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import json
+import os
+from typing import Any, Dict, Optional
+
+from etl.readers import Position
+
+
+class Checkpoint:
+    """
+    Position of the last committed record and counters of the load, kept in JSON file.
+    File is replaced atomically, so an interrupted load never leaves a broken checkpoint.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+
+    def load(self) -> Dict[str, Any]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def position(self) -> Optional[Position]:
+        position = self.load().get('position')
+        return tuple(position) if position else None
+
+    def save(self, position: Position, counters: Dict[str, int]):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'position': list(position), 'counters': counters}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,124 @@
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.conf.db.session import SessionLocal
+from etl.checkpoint import Checkpoint
+from etl.readers import Position, Record, get_reader
+from etl.stages import PipelineStats, batched, normalise
+
+logger = logging.getLogger(__name__)
+
+# (records of batch, rows to insert, rows to update)
+DedupedBatch = Tuple[List[Record], List[Dict[str, Any]], List[Dict[str, Any]]]
+# status of BulkRowResult -> counter
+RESULT_COUNTERS = {'created': 'inserted', 'updated': 'updated', 'skipped': 'skipped'}
+
+
+class TextbookPipeline:
+    def __init__(
+            self,
+            source: str,
+            *,
+            reader: Optional[str] = None,
+            batch_size: int = 1000,
+            checkpoint_path: Optional[str] = None,
+            on_existing: str = 'update',
+            dry_run: bool = False,
+            session_factory: Callable[[], Session] = SessionLocal,
+    ):
+        """
+        Load textbooks into data.textbook: read -> normalise -> dedupe -> write, all stages are
+        generators, so only one batch is in memory. Rows are written with multi-row
+        INSERT ... ON CONFLICT (slug), one statement per batch.
+
+        Writes bypass textbook_cache of API workers (it lives in their processes): GET /textbooks/{slug}
+        may return the old version of an updated textbook until its entry expires, see ttl of
+        textbook_cache in app.routers.v1.textbooks.
+
+        :param source: file or directory
+        :param reader: 'csv', 'jsonl', 'dir', detected by source by default
+        :param checkpoint_path: JSON file with position of last committed batch, load resumes from it
+        :param on_existing: 'update' - overwrite textbooks with the same slug, 'skip' - leave them
+        :param dry_run: read and compare with DB, but write nothing (checkpoint neither)
+        """
+        if on_existing not in ('update', 'skip'):
+            raise ValueError(f"Unknown on_existing mode '{on_existing}'")
+        self.source = source
+        self.reader = get_reader(source, reader)
+        self.batch_size = batch_size
+        self.checkpoint = Checkpoint(None if dry_run else checkpoint_path)
+        self.on_existing = on_existing
+        self.dry_run = dry_run
+        self.session_factory = session_factory
+        self.stats = PipelineStats()
+        self.counters = {'inserted': 0, 'updated': 0, 'skipped': 0, 'rejected': 0}
+
+    def run(self) -> Dict[str, Any]:
+        saved = self.checkpoint.load()
+        start_after = self.checkpoint.position()
+        self.counters.update(saved.get('counters', {}))
+        if start_after:
+            logger.info('Resuming after %s:%s', *start_after)
+
+        last_position = None
+
+        def track(records: Iterator[Record]) -> Iterator[Record]:
+            nonlocal last_position
+            for record in records:
+                last_position = record.position
+                yield record
+
+        with self.session_factory() as db:
+            records = self.stats.meter('read').wrap(track(self.reader(self.source, start_after)))
+            records = self.stats.meter('normalise').wrap(normalise(records, self._reject))
+            batches = self.stats.meter('dedupe').wrap(
+                self._dedupe(db, batched(records, self.batch_size)), rows=lambda item: len(item[0])
+            )
+            written = self.stats.meter('write').wrap(self._write(db, batches), rows=len)
+            for batch in written:
+                self.checkpoint.save(batch[-1].position, self.counters)
+                logger.info('%s: %s', batch[-1].position, self.counters)
+        if last_position:
+            # rejected records after the last batch must not be read again either
+            self.checkpoint.save(last_position, self.counters)
+
+        return {'dry_run': self.dry_run, 'counters': self.counters, 'stages': self.stats.report()}
+
+    def _reject(self, position: Position, reason: str):
+        self.counters['rejected'] += 1
+        logger.warning('Rejected %s:%s - %s', *position, reason)
+
+    def _dedupe(self, db: Session, batches: Iterator[List[Record]]) -> Iterator[DedupedBatch]:
+        for batch in batches:
+            # the same slug twice in a batch - the last record wins
+            by_slug = {record.data['slug']: record.data for record in batch}
+            self.counters['skipped'] += len(batch) - len(by_slug)
+            existing = crud.textbook.get_existing_slugs(db, by_slug)
+            new_rows = [row for slug, row in by_slug.items() if slug not in existing]
+            existing_rows = [row for slug, row in by_slug.items() if slug in existing]
+            if self.on_existing == 'skip':
+                self.counters['skipped'] += len(existing_rows)
+                existing_rows = []
+            yield batch, new_rows, existing_rows
+
+    def _write(self, db: Session, batches: Iterator[DedupedBatch]) -> Iterator[List[Record]]:
+        for batch, new_rows, existing_rows in batches:
+            if self.dry_run:
+                self.counters['inserted'] += len(new_rows)
+                self.counters['updated'] += len(existing_rows)
+                yield batch
+                continue
+            if self.on_existing == 'update':
+                results = crud.textbook.upsert_many(db, new_rows + existing_rows, index_elements=('slug',),
+                                                    batch_size=self.batch_size, with_commit=False)
+            else:
+                # slug taken since dedupe is skipped, not failed
+                results = crud.textbook.create_many(db, new_rows, conflict_columns=('slug',),
+                                                    batch_size=self.batch_size, with_commit=False)
+            db.commit()
+            for result in results:
+                self.counters[RESULT_COUNTERS[result.status]] += 1
+            yield batch
@@ -0,0 +1,91 @@
+"""
+Readers yield Record(position, data) one by one, nothing is read into memory as a whole.
+Position is (file, line), records of one reader come in increasing position order,
+so a checkpoint is just the position of the last loaded record.
+"""
+import csv
+import json
+import os
+from typing import Any, Callable, Dict, Iterator, NamedTuple, Optional, Tuple
+
+Position = Tuple[str, int]
+
+
+class Record(NamedTuple):
+    position: Position
+    data: Any  # dict or exception if row could not be parsed
+
+
+def read_csv(path: str, start_after: Optional[Position] = None) -> Iterator[Record]:
+    skip_to = start_after[1] if start_after and start_after[0] == path else 0
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            if reader.line_num <= skip_to:
+                continue
+            yield Record((path, reader.line_num), {k: v for k, v in row.items() if v not in ('', None)})
+
+
+def read_jsonl(path: str, start_after: Optional[Position] = None) -> Iterator[Record]:
+    skip_to = start_after[1] if start_after and start_after[0] == path else 0
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if line_number <= skip_to or not line.strip():
+                continue
+            try:
+                yield Record((path, line_number), json.loads(line))
+            except ValueError as e:
+                yield Record((path, line_number), e)
+
+
+def read_json(path: str, start_after: Optional[Position] = None) -> Iterator[Record]:
+    """One record per file"""
+    if start_after and start_after[0] == path:
+        return
+    with open(path, encoding='utf-8') as f:
+        try:
+            yield Record((path, 1), json.load(f))
+        except ValueError as e:
+            yield Record((path, 1), e)
+
+
+FILE_READERS: Dict[str, Callable[..., Iterator[Record]]] = {
+    '.csv': read_csv,
+    '.jsonl': read_jsonl,
+    '.ndjson': read_jsonl,
+    '.json': read_json,
+}
+
+
+def read_directory(path: str, start_after: Optional[Position] = None) -> Iterator[Record]:
+    """All supported files of directory (recursively) in sorted order, reader is chosen by extension"""
+    files = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(path)
+        for name in names
+        if os.path.splitext(name)[1].lower() in FILE_READERS
+    )
+    for file_path in files:
+        if start_after and file_path < start_after[0]:
+            continue
+        reader = FILE_READERS[os.path.splitext(file_path)[1].lower()]
+        yield from reader(file_path, start_after)
+
+
+READERS: Dict[str, Callable[..., Iterator[Record]]] = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+    'dir': read_directory,
+}
+
+
+def get_reader(path: str, kind: Optional[str] = None) -> Callable[..., Iterator[Record]]:
+    """Reader by name or, if kind is not set, by path: directory or file extension"""
+    if kind:
+        return READERS[kind]
+    if os.path.isdir(path):
+        return read_directory
+    try:
+        return FILE_READERS[os.path.splitext(path)[1].lower()]
+    except KeyError:
+        raise ValueError(f"Can't choose reader for '{path}', set it explicitly: {sorted(READERS)}")
@@ -0,0 +1,111 @@
+"""
+Generator stages of the pipeline, each takes an iterator and yields further.
+Rejected records are passed to on_reject callback and dropped from the stream.
+"""
+import re
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from etl.readers import Position, Record
+
+TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '',
+    'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+SLUG_SEPARATORS = re.compile(r'[^a-z0-9]+')
+SPACES = re.compile(r'\s+')
+
+Reject = Callable[[Position, str], None]
+
+
+def slugify(text: str) -> str:
+    transliterated = ''.join(TRANSLIT.get(char, char) for char in text.lower())
+    return SLUG_SEPARATORS.sub('-', transliterated).strip('-')
+
+
+def normalise(records: Iterator[Record], on_reject: Reject) -> Iterator[Record]:
+    """
+    Textbook record -> dict(title, school_class, slug) with cleaned values.
+    Slug is generated from title and class if it is not set.
+    """
+    for record in records:
+        data = record.data
+        if isinstance(data, Exception) or not isinstance(data, dict):
+            on_reject(record.position, f'Invalid row: {data}')
+            continue
+        title = SPACES.sub(' ', str(data.get('title') or '')).strip()
+        if not title:
+            on_reject(record.position, 'Empty title')
+            continue
+        try:
+            school_class = int(data.get('school_class') or 5)
+        except (TypeError, ValueError):
+            on_reject(record.position, f"Invalid school_class '{data.get('school_class')}'")
+            continue
+        slug = slugify(str(data['slug'])) if data.get('slug') else f'{slugify(title)}-{school_class}'
+        if not slug:
+            on_reject(record.position, 'Empty slug')
+            continue
+        yield Record(record.position, {'title': title, 'school_class': school_class, 'slug': slug})
+
+
+def batched(records: Iterator[Record], size: int) -> Iterator[List[Record]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class StageMeter:
+    """
+    Counts items and time spent in next() of wrapped iterator. Time of stage includes time of
+    all stages before it, PipelineStats subtracts them to get time of the stage itself.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def wrap(self, iterator: Iterator[Any], rows: Optional[Callable[[Any], int]] = None) -> Iterator[Any]:
+        while True:
+            started_at = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds += time.perf_counter() - started_at
+                return
+            self.seconds += time.perf_counter() - started_at
+            self.items += 1
+            self.rows += rows(item) if rows else 1
+            yield item
+
+
+class PipelineStats:
+    def __init__(self):
+        self.meters: List[StageMeter] = []
+
+    def meter(self, name: str) -> StageMeter:
+        meter = StageMeter(name)
+        self.meters.append(meter)
+        return meter
+
+    def report(self) -> List[Dict[str, Any]]:
+        result, upstream_seconds = [], 0.0
+        for meter in self.meters:
+            own_seconds = max(meter.seconds - upstream_seconds, 0.0)
+            upstream_seconds = meter.seconds
+            result.append({
+                'stage': meter.name,
+                'rows': meter.rows,
+                'seconds': round(own_seconds, 3),
+                'rows_per_sec': round(meter.rows / own_seconds, 1) if own_seconds else None,
+            })
+        return result
@@ -0,0 +1,83 @@
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi_jwt_auth import AuthJWT
+
+import app.main  # noqa: F401 - loads AuthJWT config
+from app.routers.v1.admin import admin
+from app.routers.v1.auth import auth
+from app.utils.denylist import MemoryDenylistStore, TokenDenylist
+from app.utils.user_import import UserImporter
+
+
+class FakeSession:
+    def __init__(self):
+        self.commits = 0
+
+    def add(self, obj):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+
+def make_user(user_id: int, access_level: int, is_active: bool = True):
+    return SimpleNamespace(id=user_id, is_active=is_active,
+                           roles=SimpleNamespace(role=SimpleNamespace(access_level=access_level)))
+
+
+@pytest.fixture
+def denylist(monkeypatch):
+    denylist = TokenDenylist(MemoryDenylistStore(), capacity=1000, error_rate=0.001, rebuild_interval=3600)
+    monkeypatch.setattr(auth, 'token_denylist', denylist)
+    return denylist
+
+
+def issue_tokens(user_id: int):
+    authorize = AuthJWT()
+    subject = json.dumps({'id': str(user_id)})
+    return [authorize.get_raw_jwt(token) for token in
+            (authorize.create_access_token(subject=subject), authorize.create_refresh_token(subject=subject))]
+
+
+def lock(monkeypatch, user):
+    monkeypatch.setattr(admin.crud.user, 'get', lambda db, obj_id, profile=None: user)
+    return admin.lock_unlock_users(db=FakeSession(), user_id=user.id, current_user=make_user(1, 1),
+                                   permissions_mask=admin.BLOCK_USERS_MASK)
+
+
+def test_lock_revokes_access_and_refresh_tokens(monkeypatch, denylist):
+    user = make_user(42, 3)
+    tokens = issue_tokens(user.id)
+    other_tokens = issue_tokens(43)
+
+    assert lock(monkeypatch, user) == {'msg': 'User 42 blocked'}
+    assert not user.is_active
+    for raw_token in tokens:
+        assert denylist.check(*auth.token_keys(raw_token))
+    for raw_token in other_tokens:
+        assert not denylist.check(*auth.token_keys(raw_token))
+
+    assert lock(monkeypatch, user) == {'msg': 'User 42 unblocked'}
+    assert user.is_active
+    for raw_token in issue_tokens(user.id):
+        assert not denylist.check(*auth.token_keys(raw_token))
+
+
+def test_creatable_roles_need_create_permission_of_the_role(monkeypatch):
+    monkeypatch.setattr(admin, 'ROLE_CREATE_MASKS', {'TEACHER': admin.BLOCK_USERS_MASK, 'SUPERUSER': 0})
+    assert admin.creatable_roles(admin.BLOCK_USERS_MASK) == {'TEACHER'}
+    assert admin.creatable_roles(admin.CHANGE_PROFILE_MASK) == set()
+
+
+def test_import_rejects_roles_user_cannot_give():
+    report = io.StringIO()
+    importer = UserImporter(report, allowed_roles={'USER'})
+    importer.role_ids = {'USER': 1, 'TEACHER': 2}
+    user_in, role = importer._validate(2, {'email': 'student@example.com', 'password': 'secret'})
+    assert role == 'USER'
+    assert importer._validate(3, {'email': 'teacher@example.com', 'password': 'secret', 'role': 'TEACHER'}) == \
+        (None, None)
+    assert "Not allowed to create users with role 'TEACHER'" in report.getvalue()
@@ -0,0 +1,105 @@
+import asyncio
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.utils.admission import AdmissionController, AdmissionMiddleware, ConcurrencyClass
+from app.utils.cache import TTLLRUCache
+
+
+def make_controller(cache: TTLLRUCache = None) -> AdmissionController:
+    controller = AdmissionController(
+        {name: ConcurrencyClass(name, 1, 1, 0.1) for name in ('auth-cpu', 'db-read', 'db-write')},
+        {'/login': 'auth-cpu'},
+        exempt=('/metrics',),
+        cheap=('POST /logout',),
+        patterns=(('PUT /admin/password/[^/]+', 'auth-cpu'),),
+    )
+    if cache is not None:
+        controller.add_cached('GET /textbooks/(?!search$)(?P<key>[^/]+)', cache)
+    return controller
+
+
+def classify(controller: AdmissionController, method: str, path: str):
+    concurrency_class = controller.classify({'type': 'http', 'method': method, 'path': path})
+    return concurrency_class.name if concurrency_class else None
+
+
+def test_classify_routes():
+    controller = make_controller()
+    assert classify(controller, 'POST', '/login') == 'auth-cpu'
+    assert classify(controller, 'PUT', '/admin/password/42') == 'auth-cpu'
+    assert classify(controller, 'GET', '/admin/password/42') == 'db-read'
+    assert classify(controller, 'POST', '/logout') is None
+    assert classify(controller, 'GET', '/metrics') is None
+    assert classify(controller, 'GET', '/users_list') == 'db-read'
+    assert classify(controller, 'DELETE', '/users') == 'db-write'
+
+
+def test_classify_only_cache_hits_are_exempt():
+    cache = TTLLRUCache()
+    controller = make_controller(cache)
+    assert classify(controller, 'GET', '/textbooks/algebra-7') == 'db-read'
+    cache.set('algebra-7', object())
+    assert classify(controller, 'GET', '/textbooks/algebra-7') is None
+    assert classify(controller, 'GET', '/textbooks/random-slug') == 'db-read'
+    assert classify(controller, 'GET', '/textbooks/search') == 'db-read'
+    # classification doesn't count as cache hit
+    assert cache.stats()['hits'] == 0
+
+
+def test_waiters_are_admitted_in_order():
+    async def run():
+        concurrency_class = ConcurrencyClass('db-read', 1, 2, 1)
+        assert await concurrency_class.acquire() is None
+        order = []
+
+        async def wait(name):
+            assert await concurrency_class.acquire() is None
+            order.append(name)
+
+        first, second = asyncio.create_task(wait('first')), asyncio.create_task(wait('second'))
+        await asyncio.sleep(0)
+        assert concurrency_class.queued == 2
+        concurrency_class.release()
+        await first
+        concurrency_class.release()
+        await second
+        concurrency_class.release()
+        return order, concurrency_class.in_flight
+
+    assert asyncio.run(run()) == (['first', 'second'], 0)
+
+
+def test_shed_when_queue_is_full_or_deadline_passes():
+    async def run():
+        concurrency_class = ConcurrencyClass('db-read', 1, 1, 0.05)
+        await concurrency_class.acquire()
+        waiter = asyncio.create_task(concurrency_class.acquire())
+        await asyncio.sleep(0)
+        full = await concurrency_class.acquire()
+        deadline = await waiter
+        return full, deadline, concurrency_class.queued, concurrency_class.in_flight
+
+    assert asyncio.run(run()) == ('queue_full', 'deadline', 0, 1)
+
+
+def test_middleware_sheds_with_retry_after():
+    controller = make_controller()
+    busy = controller.classes['db-read']
+    busy.in_flight = busy.limit
+    busy.max_queue = 0
+
+    async def ok(request):
+        return JSONResponse({'ok': True})
+
+    app = Starlette(routes=[Route('/users_list', ok), Route('/logout', ok, methods=['POST'])])
+    app.add_middleware(AdmissionMiddleware, controller=controller)
+    client = TestClient(app)
+
+    response = client.get('/users_list')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert client.post('/logout').status_code == 200
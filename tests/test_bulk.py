@@ -0,0 +1,46 @@
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import declarative_base
+
+from app.crud.base import CRUDBase
+from app.utils.security import PasswordHasherPool
+
+Base = declarative_base()
+
+
+class Tag(Base):
+    __tablename__ = 'tag'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
+
+class RecordingSession:
+    """Keeps compiled statements, returns no rows: every row conflicts"""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        return self
+
+    def all(self):
+        return []
+
+    def commit(self):
+        pass
+
+
+def test_upsert_of_key_columns_only_does_nothing_on_conflict():
+    db = RecordingSession()
+    results = CRUDBase(Tag).upsert_many(db, [{'name': 'algebra'}, {'name': 'geometry'}], index_elements=('name',))
+    assert 'ON CONFLICT (name) DO NOTHING' in db.statements[0]
+    assert [(result.status, result.detail) for result in results] == [('skipped', 'Already exists')] * 2
+
+
+def test_hasher_pool_map_keeps_order():
+    pool = PasswordHasherPool(max_workers=2, max_queue=0)
+    assert pool.map(str.upper, ['a', 'b', 'c', 'd', 'e']) == ['A', 'B', 'C', 'D', 'E']
+    assert pool.stats()['pending'] == 0
+    assert pool.stats()['completed'] == 5
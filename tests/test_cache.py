@@ -0,0 +1,38 @@
+from app.utils.cache import TTLLRUCache
+
+
+def test_set_after_invalidation_is_dropped():
+    cache = TTLLRUCache()
+    # reader misses and goes to DB
+    generation = cache.generation
+    assert cache.get('algebra-7') is None
+    # update commits and invalidates while reader still has the old row
+    cache.pop('algebra-7')
+    assert not cache.set('algebra-7', 'old', generation=generation)
+    assert cache.get('algebra-7') is None
+
+    # next reader caches the new row
+    generation = cache.generation
+    assert cache.set('algebra-7', 'new', generation=generation)
+    assert cache.get('algebra-7') == 'new'
+
+
+def test_clear_bumps_generation():
+    cache = TTLLRUCache()
+    generation = cache.generation
+    cache.clear()
+    assert not cache.set('key', 'value', generation=generation)
+    assert cache.set('key', 'value')
+
+
+def test_lru_and_ttl():
+    cache = TTLLRUCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    cache.set('d', 4, ttl=-1)
+    assert 'd' not in cache
+    assert cache.get('d') is None
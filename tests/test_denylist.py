@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+
+from app.utils.denylist import BloomFilter, MemoryDenylistStore, RedisDenylistStore, TokenDenylist
+
+
+class CountingStore(MemoryDenylistStore):
+    def __init__(self):
+        super().__init__()
+        self.checks = 0
+
+    def contains(self, jti: str) -> bool:
+        self.checks += 1
+        return super().contains(jti)
+
+
+class BrokenStore:
+    shared = True
+
+    def add(self, jti: str, expires_at: float) -> bool:
+        raise ConnectionError('store is down')
+
+    async def add_async(self, jti: str, expires_at: float) -> bool:
+        raise ConnectionError('store is down')
+
+    def contains(self, jti: str) -> bool:
+        raise ConnectionError('store is down')
+
+
+def make_denylist(store, rebuild_interval: float = 3600) -> TokenDenylist:
+    return TokenDenylist(store, capacity=1000, error_rate=0.001, rebuild_interval=rebuild_interval)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, 0.01)
+    items = [f'jti-{i}' for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_filter_negative_does_not_reach_store():
+    store = CountingStore()
+    denylist = make_denylist(store)
+    denylist.revoke('revoked', time.time() + 60)
+    store.checks = 0
+    assert not denylist.is_revoked('not-revoked')
+    assert store.checks == 0
+    assert denylist.is_revoked('revoked')
+    assert store.checks == 1
+
+
+def test_false_positive_is_answered_by_store():
+    store = CountingStore()
+    denylist = make_denylist(store)
+    # every bit set: filter says yes for any jti
+    denylist.filter.bits = bytearray(b'\xff' * len(denylist.filter.bits))
+    assert not denylist.is_revoked('never-revoked')
+    assert store.checks == 1
+
+
+def test_expired_tokens_rotate_out():
+    store = MemoryDenylistStore(prune_interval=0)
+    denylist = make_denylist(store, rebuild_interval=0)
+    denylist.revoke('expired', time.time() - 1)
+    denylist.revoke('active', time.time() + 60)
+    # the second revocation pruned the store and rebuilt the filter without the expired one
+    assert list(store._expires) == ['active']
+    assert denylist.filter.count == 1
+    assert not denylist.is_revoked('expired')
+    assert denylist.is_revoked('active')
+
+
+def test_revoke_is_claimed_once():
+    denylist = make_denylist(MemoryDenylistStore())
+    assert denylist.revoke('jti', time.time() + 60)
+    assert not denylist.revoke('jti', time.time() + 60)
+    assert not asyncio.run(denylist.revoke_async('jti', time.time() + 60))
+
+
+def test_revoke_with_store_down_is_kept_locally():
+    denylist = make_denylist(BrokenStore())
+    denylist.ensure_started = lambda: None  # no sync thread in test
+    assert denylist.revoke('jti', time.time() + 60)
+    assert denylist.is_revoked('jti')
+    assert not denylist.revoke('jti', time.time() + 60)
+
+
+def test_restore_takes_key_out():
+    denylist = make_denylist(MemoryDenylistStore())
+    denylist.revoke('user:1', time.time() + 60)
+    assert denylist.check('user:1')
+    denylist.restore('user:1')
+    assert not denylist.check('user:1')
+
+
+def make_redis_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    return RedisDenylistStore(client=fakeredis.FakeRedis(server=server),
+                              async_client=fakeredis.aioredis.FakeRedis(server=server))
+
+
+def test_redis_claim_is_atomic_across_workers():
+    store = make_redis_store()
+    workers = [make_denylist(store) for _ in range(2)]
+    for denylist in workers:
+        denylist.ensure_started = lambda: None
+
+    async def refresh_twice():
+        return await asyncio.gather(*(denylist.revoke_async('refresh-jti', time.time() + 60)
+                                      for denylist in workers))
+
+    assert sorted(asyncio.run(refresh_twice())) == [False, True]
+
+
+def test_check_in_event_loop_leaves_store_to_confirm():
+    store = make_redis_store()
+    denylist = make_denylist(store)
+    denylist.ensure_started = lambda: None
+    denylist.revoke('revoked', time.time() + 60)
+
+    async def check(jti: str):
+        return denylist.check(jti), await denylist.confirm()
+
+    # filter isn't loaded yet: nothing is asked synchronously, confirm() asks the store
+    assert asyncio.run(check('revoked')) == (False, True)
+    assert asyncio.run(check('other')) == (False, False)
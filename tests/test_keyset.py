@@ -0,0 +1,71 @@
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy.orm import Session, declarative_base
+
+from app.crud.base import CRUDBase
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'item'
+
+    id = Column(Integer, primary_key=True)
+    score = Column(Integer, nullable=False)
+
+
+crud_item = CRUDBase(Item)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        # many ties on score, id breaks them
+        session.add_all([Item(id=i, score=i % 3) for i in range(1, 24)])
+        session.commit()
+        yield session
+
+
+def walk(db, limit: int, **kwargs):
+    """Go through all pages forward, then back from the last one"""
+    forward, pages = [], []
+    cursor = None
+    while True:
+        objs, next_cursor, prev_cursor = crud_item.get_page(db, limit=limit, cursor=cursor, **kwargs)
+        pages.append([obj.id for obj in objs])
+        forward.extend(obj.id for obj in objs)
+        if next_cursor is None:
+            break
+        cursor = next_cursor
+    backward_pages = [pages[-1]]
+    while prev_cursor is not None:
+        objs, _, prev_cursor = crud_item.get_page(db, limit=limit, cursor=prev_cursor, **kwargs)
+        backward_pages.append([obj.id for obj in objs])
+    return forward, pages, backward_pages[::-1]
+
+
+@pytest.mark.parametrize('sort_column', ['id', 'score'])
+@pytest.mark.parametrize('descending', [False, True])
+def test_cursor_round_trip(db, sort_column, descending):
+    expected = sorted(db.query(Item).all(), key=lambda item: (getattr(item, sort_column), item.id),
+                      reverse=descending)
+    forward, pages, backward_pages = walk(db, 5, sort_column=sort_column, descending=descending)
+    assert forward == [item.id for item in expected]
+    assert all(len(page) == 5 for page in pages[:-1])
+    assert backward_pages == pages
+
+
+def test_ties_are_not_lost_or_repeated_on_page_border(db):
+    forward, _, _ = walk(db, 2, sort_column='score')
+    assert len(forward) == len(set(forward)) == 23
+    assert forward[:8] == [3, 6, 9, 12, 15, 18, 21, 1]
+
+
+def test_unknown_sort_column_is_422(db):
+    for sort_column in ('password', 'metadata', '__init__'):
+        with pytest.raises(HTTPException) as error:
+            crud_item.get_page(db, sort_column=sort_column)
+        assert error.value.status_code == 422
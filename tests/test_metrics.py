@@ -0,0 +1,60 @@
+from starlette.applications import Starlette
+from starlette.testclient import TestClient
+
+from app.conf.settings import settings
+from app.utils import metrics
+from app.utils.metrics import merge_snapshots
+
+
+def worker_snapshot(healthy: int, lag: float, checked_out: int, requests: int):
+    replica = [['replica', 'replica-1']]
+    return {
+        'counters': {'http_requests_total': [[[], requests]]},
+        'gauges': {
+            'db_replica_healthy': [[replica, healthy]],
+            'db_replica_lag_seconds': [[replica, lag]],
+            'db_pool_checked_out': [[[['engine', 'sync']], checked_out]],
+        },
+        'histograms': {},
+    }
+
+
+def test_replica_gauges_are_not_summed():
+    merged = merge_snapshots([worker_snapshot(1, 0.5, 3, 10), worker_snapshot(0, 4.0, 2, 5),
+                              worker_snapshot(1, 1.0, 1, 1)])
+    replica = (('replica', 'replica-1'),)
+    assert merged['db_replica_healthy'][replica] == 0
+    assert merged['db_replica_lag_seconds'][replica] == 4.0
+    assert merged['db_pool_checked_out'][(('engine', 'sync'),)] == 6
+    assert merged['http_requests_total'][()] == 16
+
+
+def make_client(monkeypatch, networks: str, token: str = '') -> TestClient:
+    monkeypatch.setattr(metrics, 'METRICS_NETWORKS', [metrics.ipaddress.ip_network(n) for n in networks.split(',')])
+    monkeypatch.setattr(settings, 'METRICS_TOKEN', token)
+    monkeypatch.setattr(metrics.snapshot_writer, 'directory', '')
+    app = Starlette()
+    app.add_route('/metrics', metrics.metrics_endpoint)
+    return TestClient(app)
+
+
+def test_metrics_require_allowed_network_or_token(monkeypatch):
+    # TestClient connects as host 'testclient', which is in no network
+    client = make_client(monkeypatch, '127.0.0.0/8', token='scrape-token')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-token'})
+    assert response.status_code == 200
+    assert '# TYPE db_replica_healthy gauge' in response.text
+
+
+def test_metrics_without_token_are_closed_outside_networks(monkeypatch):
+    client = make_client(monkeypatch, '10.0.0.0/8')
+    assert client.get('/metrics', headers={'Authorization': 'Bearer '}).status_code == 403
+
+
+def test_metrics_allowed_network():
+    request = type('FakeRequest', (), {'headers': {}, 'client': type('Client', (), {'host': '127.0.0.1'})})()
+    assert metrics.metrics_allowed(request)
+    request.client.host = '203.0.113.7'
+    assert not metrics.metrics_allowed(request)
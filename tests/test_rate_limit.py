@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.utils.rate_limit import LoginThrottle, LoginThrottleMiddleware, MemoryBucketStore, RedisBucketStore
+
+
+class FakeStore:
+    """Memory buckets on a clock the test moves, counts calls"""
+
+    def __init__(self):
+        self.buckets = MemoryBucketStore()
+        self.now = 0.0
+        self.calls = 0
+
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        self.calls += 1
+        return await self.buckets.take(key, capacity, rate, now=self.now)
+
+
+class BrokenStore:
+    async def take(self, key: str, capacity: float, rate: float) -> float:
+        raise ConnectionError('store is down')
+
+
+def make_throttle(store) -> LoginThrottle:
+    return LoginThrottle(store, ip_burst=3, ip_per_minute=60, account_burst=2, account_per_minute=6)
+
+
+def test_memory_bucket_burst_and_refill():
+    store = MemoryBucketStore()
+
+    async def take(now: float) -> float:
+        return await store.take('key', capacity=2, rate=0.5, now=now)
+
+    assert asyncio.run(take(0)) == 0
+    assert asyncio.run(take(0)) == 0
+    assert asyncio.run(take(0)) == pytest.approx(2)
+    # half a token came in a second
+    assert asyncio.run(take(1)) == pytest.approx(1)
+    assert asyncio.run(take(3)) == 0
+
+
+def test_memory_bucket_forgets_least_recently_used():
+    store = MemoryBucketStore(max_keys=1)
+    asyncio.run(store.take('a', capacity=1, rate=1, now=0))
+    asyncio.run(store.take('b', capacity=1, rate=1, now=0))
+    assert asyncio.run(store.take('a', capacity=1, rate=1, now=0)) == 0
+
+
+def test_throttle_limits_account_from_any_ip():
+    throttle = make_throttle(FakeStore())
+    assert asyncio.run(throttle.check('10.0.0.1', 'user@example.com')) == (None, 0)
+    assert asyncio.run(throttle.check('10.0.0.2', ' User@Example.com')) == (None, 0)
+    scope, wait = asyncio.run(throttle.check('10.0.0.3', 'user@example.com'))
+    assert scope == 'account'
+    assert wait == pytest.approx(10)
+
+
+def test_throttle_limits_ip_over_accounts():
+    throttle = make_throttle(FakeStore())
+    for i in range(3):
+        assert asyncio.run(throttle.check('10.0.0.1', f'user{i}@example.com')) == (None, 0)
+    scope, wait = asyncio.run(throttle.check('10.0.0.1', 'other@example.com'))
+    assert scope == 'ip'
+    assert wait == pytest.approx(1)
+
+
+def test_blocked_key_does_not_reach_store():
+    store = FakeStore()
+    throttle = make_throttle(store)
+    for i in range(3):
+        asyncio.run(throttle.check(f'10.0.0.{i}', 'user@example.com'))
+    calls = store.calls
+    assert asyncio.run(throttle.check('10.0.0.9', 'user@example.com'))[0] == 'account'
+    # IP bucket is taken, the blocked account one is answered in process
+    assert store.calls == calls + 1
+
+
+def test_throttle_fails_open():
+    throttle = make_throttle(BrokenStore())
+    for _ in range(10):
+        assert asyncio.run(throttle.check('10.0.0.1', 'user@example.com')) == (None, 0)
+
+
+def test_redis_store_matches_memory_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    redis_store = RedisBucketStore(client=fakeredis.aioredis.FakeRedis())
+    memory_store = MemoryBucketStore()
+
+    async def take_both(now: float):
+        return (await redis_store.take('key', capacity=2, rate=0.5, now=now),
+                await memory_store.take('key', capacity=2, rate=0.5, now=now))
+
+    async def run():
+        for now in (0, 0, 0, 1, 3, 3):
+            redis_wait, memory_wait = await take_both(now)
+            assert redis_wait == pytest.approx(memory_wait)
+
+    asyncio.run(run())
+
+
+def make_client(throttle: LoginThrottle) -> TestClient:
+    async def login(request):
+        form = await request.form()
+        return JSONResponse({'username': form['username']})
+
+    app = Starlette(routes=[Route('/login', login, methods=['POST'])])
+    app.add_middleware(LoginThrottleMiddleware, throttle=throttle, path='/login')
+    return TestClient(app)
+
+
+def test_middleware_rejects_before_route():
+    client = make_client(make_throttle(FakeStore()))
+    for _ in range(2):
+        response = client.post('/login', data={'username': 'user@example.com', 'password': 'x'})
+        assert response.status_code == 200
+        # the route gets the form the middleware has read
+        assert response.json() == {'username': 'user@example.com'}
+    response = client.post('/login', data={'username': 'user@example.com', 'password': 'x'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '10'